@@ -3,8 +3,27 @@ import logging
 import json
 import requests
 from datetime import datetime, timezone
-from flask import Flask, render_template, jsonify, request, Response
+from flask import Flask, render_template, jsonify, request, Response, stream_with_context
 import os
+import queue
+import threading
+import time
+import hashlib
+import gzip
+from functools import lru_cache
+from ha_states import StateIndex
+from response_cache import SingleFlightCache
+from suffix_match import compile_suffixes
+from metrics import REGISTRY, CONTENT_TYPE as METRICS_CONTENT_TYPE
+
+try:
+    import orjson  # 選用：/devices 回應序列化比較快
+except ImportError:
+    orjson = None
+try:
+    import brotli  # 選用：有安裝就多支援 Content-Encoding: br
+except ImportError:
+    brotli = None
 
 # ---------------- 可自訂的查詢預設值 ----------------
 # 以下為 /devices API 的預設查詢條件，
@@ -18,6 +37,13 @@ import os
 #   → 取出所有 entity_id 以 sensor.zp2_ 開頭，且結尾為 _p25 或 _co2 的實體
 #
 #   若網址沒帶 prefix/suffix/query/limit，則使用以下預設值。
+#
+# 📦 選用參數：
+#   fields=<欄位1>,<欄位2>  → 只回傳這些 suffix 的值（裝置清單仍依全部 suffix 判斷）
+#   format=columnar         → 欄位式格式：裝置 id 只列一次，每個欄位一個值陣列與一個時間陣列（epoch 秒）
+#     {"generated_at":..., "requested":..., "format":"columnar",
+#      "devices":["id1","id2"], "columns":{"_action":{"v":["idle",null],"t":[1760000000,null]}}}
+#   回應會依 Accept-Encoding 以 br（有安裝 brotli 時）或 gzip 壓縮
 
 DEFAULT_QUERY  = ""                   # 關鍵字（比對 entity_id 或 friendly_name）
 DEFAULT_PREFIX = "sensor.testprint_"  # entity_id 開頭條件，例：sensor.zp2_*
@@ -42,6 +68,41 @@ HEADERS = {
 if not SUPERVISOR_TOKEN:
     logging.warning("⚠️ SUPERVISOR_TOKEN 未提供，請確認 add-on 啟用了 homeassistant_api: true")
 
+# 本地 HA state 索引：整份載入一次，之後靠 websocket state_changed（或 TTL 到期）更新。
+# STATES_TTL = 沒有 websocket 時，資料最多沿用幾秒才重新整份抓。
+# 單一程序模式（runtime.py）下跟 run.py 共用同一份索引。
+STATES_TTL = 30
+STATE_INDEX = StateIndex.shared(BASE_URL, SUPERVISOR_TOKEN, ttl=STATES_TTL)
+
+# /devices 回應快取：同樣的 (prefix, suffix, query, limit, format, fields, 壓縮方式) 在 TTL 內共用一份結果，
+# 同時進來的相同請求只會算一次（single-flight）；最多保留 DEVICES_CACHE_SIZE 組條件。
+DEVICES_CACHE_TTL = 5
+DEVICES_CACHE_SIZE = 64
+DEVICES_CACHE = SingleFlightCache(DEVICES_CACHE_TTL, DEVICES_CACHE_SIZE)
+# 小於這個大小的回應不壓縮（壓了也省不了多少，還多花 CPU）
+COMPRESS_MIN_BYTES = 1024
+
+# /devices/stream（SSE）推送設定：
+#   STREAM_HEARTBEAT_SEC → 沒有變動時多久送一次心跳
+#   STREAM_POLL_SEC      → 沒有 websocket 時多久檢查一次 TTL 是否到期
+#   STREAM_QUEUE_SIZE    → 每個連線最多累積幾批差異，超過就改送完整 snapshot
+#   STREAM_RETRY_MS      → 斷線後瀏覽器多久重連
+STREAM_HEARTBEAT_SEC = 15
+STREAM_POLL_SEC = 2
+STREAM_QUEUE_SIZE = 100
+STREAM_RETRY_MS = 3000
+
+# ---------------- 指標（/metrics） ----------------
+# 本程序的指標以 dashboard_ 為前綴；/metrics 也會一併輸出 run.py、OTA server 寫出的指標檔。
+DEVICES_SECONDS = REGISTRY.histogram(
+    "devices_request_seconds", "/devices 回應時間", ("status",), namespace="dashboard"
+)
+REGISTRY.counter(
+    "devices_cache_total", "/devices 回應快取結果", ("result",),
+    fn=lambda: {(k,): v for k, v in DEVICES_CACHE.stats().items() if k in ("hits", "misses", "coalesced")},
+    namespace="dashboard",
+)
+
 # ---------------- Flask HTTP 設定 ----------------
 # Flask 在容器內監聽的 IP 與 Port。
 # HTTP_HOST = "0.0.0.0" → 允許所有網路介面連線（外部可訪問）
@@ -50,14 +111,11 @@ HTTP_HOST = "0.0.0.0"
 HTTP_PORT = 8099
 
 # ---------------- 核心：查清單 / 讀欄位 ----------------
-def _get_all_states():
-    """GET /api/states 取回全部實體狀態。"""
+def _get_all_states(prefix=""):
+    """從本地索引取回實體狀態；有 prefix 時只取 entity_id 以它開頭的部分。"""
     if not HEADERS.get("Authorization"):
         raise RuntimeError("HA Token 未設定（HEADERS 無 Authorization）")
-    url = f"{BASE_URL}/states"
-    resp = requests.get(url, headers=HEADERS, timeout=5)
-    resp.raise_for_status()
-    return resp.json()
+    return STATE_INDEX.with_prefix(prefix)
 
 def _parse_suffixes_from_request():
     """支援 ?suffix=a&suffix=b 與 ?suffix=a,b 兩種寫法；沒帶就用 DEFAULT_SUFFIX（亦可逗號）"""
@@ -70,6 +128,13 @@ def _parse_suffixes_from_request():
         suffixes = [x.strip() for x in (DEFAULT_SUFFIX or "").split(",") if x.strip()]
     return suffixes
 
+def _parse_fields_from_request():
+    """?fields=a,b 或 ?fields=a&fields=b；沒帶回空清單（= 全部欄位）"""
+    fields = []
+    for s in request.args.getlist("fields"):
+        fields.extend([x.strip() for x in s.split(",") if x.strip()])
+    return fields
+
 def _match_suffix(entity_id: str, suffixes: list[str]):
     """
     從 entity_id 尾端判斷命中的 suffix。
@@ -77,17 +142,11 @@ def _match_suffix(entity_id: str, suffixes: list[str]):
       matched_suffix = 例如 'cttm_usedwatercontrol'
       trailing       = 真正要從尾端裁掉的字串（可能是 '_'+suffix 或 suffix）
     無命中回 (None, None)
+    比對用的 trie 依 suffix 組合快取（見 suffix_match.py），多個命中時取清單中最前面的。
     """
     if not suffixes:
         return None, None
-    for s in suffixes:
-        if not s:
-            continue
-        if entity_id.endswith("_" + s):
-            return s, "_" + s
-        if entity_id.endswith(s):
-            return s, s
-    return None, None
+    return compile_suffixes(tuple(suffixes)).match(entity_id)
 
 # ---------------- Flask API ----------------
 app = Flask(
@@ -104,74 +163,364 @@ def status_page():
 def health():
     return jsonify({"ok": True, "ha_base": BASE_URL})
 
+def _device_metric(eid, s, query, matcher):
+    """
+    單一實體 → (device_label, matched_suffix, metric)；不符合條件回 None。
+    s 為 None（實體被移除）時 metric 為 None，且略過關鍵字比對。
+    """
+    # 關鍵字（entity_id 或 friendly_name）
+    if query and s is not None:
+        name = (s.get("attributes", {}).get("friendly_name") or "")
+        q = query.lower()
+        if q not in eid.lower() and q not in name.lower():
+            return None
+
+    # 後綴比對（拿到命中的 suffix 與實際要裁掉的 trailing）
+    matched_suffix, trailing = matcher.match(eid)
+    if not matched_suffix:
+        return None
+
+    # 去掉 domain 取得 object_id（sensor.3drp_211242142_state -> 3drp_211242142_state）
+    base = eid.split(".", 1)[1] if "." in eid else eid
+
+    # 精準裁掉尾巴（依 trailing 長度），再把可能殘留的底線收乾淨
+    base_wo_suffix = base[: -len(trailing)] if trailing else base
+    base_wo_suffix = base_wo_suffix.rstrip("_")
+
+    # 正常化裝置標籤
+    device_label = base_wo_suffix
+
+    if s is None:
+        return device_label, matched_suffix, None
+    return device_label, matched_suffix, {
+        "value": s.get("state"),
+        "last_updated": s.get("last_updated"),
+    }
+
+def _build_devices(prefix, suffixes, query, limit):
+    """依條件從 HA states 整理出 [{"device_id":..., "metrics": {...}}, ...]（已排序、已截斷）。"""
+    if not suffixes:
+        return []
+    states = _get_all_states(prefix)
+    matcher = compile_suffixes(tuple(suffixes))
+    devices_map = {}  # device_id -> {"device_id":..., "metrics": {...}}
+
+    for s in states:
+        hit = _device_metric(s.get("entity_id") or "", s, query, matcher)
+        if hit is None:
+            continue
+        device_label, matched_suffix, metric = hit
+
+        # 收集 metrics（key 就是完整 suffix：matched_suffix）
+        row = devices_map.setdefault(device_label, {"device_id": device_label, "metrics": {}})
+        row["metrics"][matched_suffix] = metric
+
+    # 輸出整理
+    devices_list = list(devices_map.values())
+    devices_list.sort(key=lambda d: d["device_id"])
+    if limit and len(devices_list) > limit:
+        devices_list = devices_list[:limit]
+    return devices_list
+
+def _dumps(obj):
+    """緊湊 JSON（UTF-8 bytes）；有 orjson 就用它。"""
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+@lru_cache(maxsize=4096)
+def _minute_epoch(minute, offset):
+    return int(datetime.fromisoformat(f"{minute}:00{offset}").timestamp())
+
+# last_updated 字串 → epoch 秒；實體沒更新時字串不變，下一次請求直接查表（滿了整個清掉重來）
+_EPOCH_CACHE = {}
+_EPOCH_CACHE_MAX = 100000
+
+def _epoch(ts):
+    """
+    HA 的 last_updated（ISO 8601）→ epoch 秒；沒有或格式不對回 None。
+    大量裝置的時間多半落在同一段時間：「到分鐘 + 時區」的部分快取起來，只另外加上秒數。
+    """
+    e = _EPOCH_CACHE.get(ts)
+    if e is not None or not ts:
+        return e
+    try:
+        if len(ts) >= 25 and ts[16] == ":" and ts[-6] in "+-":
+            e = _minute_epoch(ts[:16], ts[-6:]) + int(ts[17:19])
+        else:
+            e = int(datetime.fromisoformat(ts).timestamp())
+    except (TypeError, ValueError):
+        return None
+    if len(_EPOCH_CACHE) >= _EPOCH_CACHE_MAX:
+        _EPOCH_CACHE.clear()
+    _EPOCH_CACHE[ts] = e
+    return e
+
+def _columnar(devices_list, fields):
+    """[{"device_id", "metrics"}] → 裝置 id 一個陣列，每個欄位各一個值 / 時間陣列（缺值為 null）。"""
+    metrics = [d["metrics"] for d in devices_list]
+    columns = {}
+    for f in fields:
+        cells = [m.get(f) for m in metrics]
+        columns[f] = {
+            "v": [c["value"] if c else None for c in cells],
+            "t": [_epoch(c["last_updated"]) if c else None for c in cells],
+        }
+    return {"devices": [d["device_id"] for d in devices_list], "columns": columns}
+
+def _encode(body, encoding):
+    if encoding == "br":
+        return brotli.compress(body, quality=5)
+    if encoding == "gzip":
+        return gzip.compress(body, 6, mtime=0)
+    return body
+
+def _render_devices(prefix, suffixes, query, limit, fmt="nested", fields=(), encoding=None):
+    """
+    產生 /devices 的回應本體與 ETag（ETag 只看資料內容，不含 generated_at）。
+    encoding 為 br / gzip 時回傳壓縮後的內容（跟著快取，同樣條件不會重複壓縮）。
+    """
+    requested = {"prefix": prefix, "suffixes": suffixes}
+    if fields:
+        requested["fields"] = list(fields)
+    devices_list = _build_devices(prefix, suffixes, query, limit)
+    if fmt == "columnar":
+        data = {"requested": requested, "format": "columnar", **_columnar(devices_list, fields or suffixes)}
+    else:
+        if fields:
+            devices_list = [
+                {"device_id": d["device_id"], "metrics": {k: v for k, v in d["metrics"].items() if k in fields}}
+                for d in devices_list
+            ]
+        data = {"requested": requested, "devices": devices_list}
+    data = _dumps(data)
+    etag = hashlib.sha1(data).hexdigest()
+    # generated_at 放在最前面，直接接上已序列化的內容，不用整份再序列化一次
+    body = b'{"generated_at":' + _dumps(datetime.now(timezone.utc).isoformat()) + b"," + data[1:]
+    if encoding and len(body) >= COMPRESS_MIN_BYTES:
+        return _encode(body, encoding), f"{etag}-{encoding}", encoding
+    return body, etag, None
+
+@app.get("/metrics")
+def metrics_view():
+    return Response(REGISTRY.render_all(), mimetype=METRICS_CONTENT_TYPE)
+
 @app.get("/devices")
 def devices_view():
+    t0 = time.monotonic()
+    resp = _devices_response()
+    status = resp[1] if isinstance(resp, tuple) else resp.status_code
+    DEVICES_SECONDS.observe(time.monotonic() - t0, status=status)
+    return resp
+
+def _devices_response():
     query   = request.args.get("query", DEFAULT_QUERY).strip()
     prefix  = request.args.get("prefix", DEFAULT_PREFIX).strip()
     limit   = int(request.args.get("limit", DEFAULT_LIMIT))
     suffixes = _parse_suffixes_from_request()
+    fields = tuple(_parse_fields_from_request())
+    fmt = "columnar" if request.args.get("format") == "columnar" else "nested"
+    encoding = request.accept_encodings.best_match(["br", "gzip"] if brotli is not None else ["gzip"])
 
     try:
-        states = _get_all_states()
-        devices_map = {}  # device_id -> {"device_id":..., "metrics": {...}}
+        # 同樣條件的請求共用同一份結果：快取 DEVICES_CACHE_TTL 秒，同時進來的只算一次
+        key = (prefix, tuple(suffixes), query, limit, fmt, fields, encoding)
+        body, etag, content_encoding = DEVICES_CACHE.get(
+            key, lambda: _render_devices(prefix, suffixes, query, limit, fmt, fields, encoding)
+        )
+        if etag in request.if_none_match:
+            resp = Response(status=304)
+        else:
+            resp = Response(body, mimetype="application/json")
+            if content_encoding:
+                resp.headers["Content-Encoding"] = content_encoding
+        resp.set_etag(etag)
+        resp.headers["Cache-Control"] = "no-cache"
+        resp.vary.add("Accept-Encoding")
+        return resp
 
-        for s in states:
-            eid = s.get("entity_id") or ""
-            if prefix and not eid.startswith(prefix):
-                continue
+    except requests.HTTPError as e:
+        return jsonify({"error": f"HTTP {e.response.status_code}", "detail": e.response.text[:300]}), 502
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+        
+# ---------------- 即時推送（SSE） ----------------
+class _StreamSub:
+    __slots__ = ("prefix", "query", "matcher", "queue")
 
-            # 關鍵字（entity_id 或 friendly_name）
-            if query:
-                name = (s.get("attributes", {}).get("friendly_name") or "")
-                q = query.lower()
-                if q not in eid.lower() and q not in name.lower():
-                    continue
+    def __init__(self, prefix, suffixes, query):
+        self.prefix = prefix
+        self.query = query
+        self.matcher = compile_suffixes(tuple(suffixes))
+        self.queue = queue.Queue(maxsize=STREAM_QUEUE_SIZE)
+
+
+_RESYNC = object()  # 佇列塞爆時改送一次完整 snapshot
 
-            # 後綴比對（拿到命中的 suffix 與實際要裁掉的 trailing）
-            matched_suffix, trailing = _match_suffix(eid, suffixes)
-            if not matched_suffix:
-                continue
 
-            # 去掉 domain 取得 object_id（sensor.3drp_211242142_state -> 3drp_211242142_state）
-            base = eid.split(".", 1)[1] if "." in eid else eid
+class DeviceStreamHub:
+    """
+    接收 StateIndex 的變更通知，依每個訂閱者的 prefix / suffix / query 過濾，
+    轉成 {"devices": [{"device_id":..., "metrics": {suffix: metric 或 null}}]} 的差異丟進各自佇列。
+    沒有 websocket 時，有人訂閱就由背景 thread 定期觸發 TTL 重新整理（差異由 StateIndex 算）。
+    """
+    def __init__(self, index):
+        self.index = index
+        self._lock = threading.Lock()
+        self._subs = set()
+        self._poller = None
+        index.add_listener(self._on_changes)
+
+    def subscribe(self, prefix, suffixes, query):
+        sub = _StreamSub(prefix, suffixes, query)
+        with self._lock:
+            self._subs.add(sub)
+            if self._poller is None or not self._poller.is_alive():
+                self._poller = threading.Thread(target=self._poll, name="stream-poll", daemon=True)
+                self._poller.start()
+        return sub
+
+    def unsubscribe(self, sub):
+        with self._lock:
+            self._subs.discard(sub)
+
+    def count(self):
+        """目前的訂閱者數。"""
+        with self._lock:
+            return len(self._subs)
 
-            # 精準裁掉尾巴（依 trailing 長度），再把可能殘留的底線收乾淨
-            base_wo_suffix = base[: -len(trailing)] if trailing else base
-            base_wo_suffix = base_wo_suffix.rstrip("_")
+    def _poll(self):
+        while True:
+            time.sleep(STREAM_POLL_SEC)
+            with self._lock:
+                if not self._subs:
+                    self._poller = None
+                    return
+            if not self.index.is_live():
+                try:
+                    self.index.all_states()  # 過了 TTL 才會真的重抓，差異會回呼 _on_changes
+                except Exception as e:
+                    logging.warning(f"[stream] 重新整理 HA states 失敗：{e}")
 
-            # 正常化裝置標籤
-            device_label = base_wo_suffix
+    def _on_changes(self, changes):
+        with self._lock:
+            subs = list(self._subs)
+        for sub in subs:
+            rows = {}
+            for eid, s in changes:
+                if sub.prefix and not eid.startswith(sub.prefix):
+                    continue
+                hit = _device_metric(eid, s, sub.query, sub.matcher)
+                if hit is None:
+                    continue
+                device_label, matched_suffix, metric = hit
+                row = rows.setdefault(device_label, {"device_id": device_label, "metrics": {}})
+                row["metrics"][matched_suffix] = metric
+            if not rows:
+                continue
+            try:
+                sub.queue.put_nowait(rows)
+            except queue.Full:
+                # 前端太慢：清掉累積的差異，改成下次送完整 snapshot
+                with sub.queue.mutex:
+                    sub.queue.queue.clear()
+                sub.queue.put_nowait(_RESYNC)
 
-            # 收集 metrics（key 就是完整 suffix：matched_suffix）
-            row = devices_map.setdefault(device_label, {"device_id": device_label, "metrics": {}})
-            row["metrics"][matched_suffix] = {
-                "value": s.get("state"),
-                "last_updated": s.get("last_updated"),
-            }
+def _sse(event, data):
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False, separators=(',', ':'))}\n\n"
 
-        # 輸出整理
-        devices_list = list(devices_map.values())
-        devices_list.sort(key=lambda d: d["device_id"])
-        if limit and len(devices_list) > limit:
-            devices_list = devices_list[:limit]
+@app.get("/devices/stream")
+def devices_stream():
+    """
+    Server-Sent Events：連上先送一次 snapshot（格式同 /devices），之後只送有變動的 metric：
+      event: delta  data: {"devices": [{"device_id": ..., "metrics": {"_action": {...} 或 null}}]}
+    delta 只包含 snapshot 裡的裝置，加上總數還沒到 limit 時新出現的裝置（跟 /devices 一樣最多 limit 台）。
+    """
+    query   = request.args.get("query", DEFAULT_QUERY).strip()
+    prefix  = request.args.get("prefix", DEFAULT_PREFIX).strip()
+    limit   = int(request.args.get("limit", DEFAULT_LIMIT))
+    suffixes = _parse_suffixes_from_request()
 
-        payload = {
+    def snapshot():
+        return {
             "generated_at": datetime.now(timezone.utc).isoformat(),
-            "requested": {
-                "prefix": prefix,
-                "suffixes": suffixes
-            },
-            "devices": devices_list
+            "requested": {"prefix": prefix, "suffixes": suffixes},
+            "devices": _build_devices(prefix, suffixes, query, limit),
         }
-        return jsonify(payload)
 
-    except requests.HTTPError as e:
-        return jsonify({"error": f"HTTP {e.response.status_code}", "detail": e.response.text[:300]}), 502
-    except Exception as e:
-        return jsonify({"error": str(e)}), 500
-        
+    known = set()  # 這條連線目前送過的裝置；delta 只送這些，新裝置在 limit 內才加入
+
+    def send_snapshot():
+        snap = snapshot()
+        known.clear()
+        known.update(d["device_id"] for d in snap["devices"])
+        return _sse("snapshot", snap)
+
+    def within_limit(rows):
+        out = []
+        for row in rows:
+            device_label = row["device_id"]
+            if device_label not in known:
+                # 全是刪除（null）的新裝置不必送；超過 limit 的新裝置等下次 snapshot 再說
+                if (limit and len(known) >= limit) or all(m is None for m in row["metrics"].values()):
+                    continue
+                known.add(device_label)
+            out.append(row)
+        return out
+
+    def generate():
+        # 先訂閱再做 snapshot，中間的變更最多重複套用一次，不會漏掉
+        sub = STREAM_HUB.subscribe(prefix, suffixes, query)
+        try:
+            yield f"retry: {STREAM_RETRY_MS}\n\n"
+            yield send_snapshot()
+            while True:
+                try:
+                    item = sub.queue.get(timeout=STREAM_HEARTBEAT_SEC)
+                except queue.Empty:
+                    yield ": ping\n\n"  # 保持連線，順便偵測前端已關閉
+                    continue
+                if item is _RESYNC:
+                    yield send_snapshot()
+                    continue
+                # 把佇列中已累積的差異合併成一筆再送
+                merged = item
+                while True:
+                    try:
+                        more = sub.queue.get_nowait()
+                    except queue.Empty:
+                        break
+                    if more is _RESYNC:
+                        merged = None
+                        break
+                    for device_label, row in more.items():
+                        merged.setdefault(device_label, {"device_id": device_label, "metrics": {}})
+                        merged[device_label]["metrics"].update(row["metrics"])
+                if merged is None:
+                    yield send_snapshot()
+                    continue
+                rows = within_limit(merged.values())
+                if rows:
+                    yield _sse("delta", {"devices": rows})
+        except Exception as e:
+            yield _sse("error", {"error": str(e)})
+        finally:
+            STREAM_HUB.unsubscribe(sub)
+
+    resp = Response(stream_with_context(generate()), mimetype="text/event-stream")
+    resp.headers["Cache-Control"] = "no-cache"
+    resp.headers["X-Accel-Buffering"] = "no"
+    return resp
+
+STREAM_HUB = DeviceStreamHub(STATE_INDEX)
+REGISTRY.gauge(
+    "stream_subscribers", "/devices/stream 連線數", fn=STREAM_HUB.count, namespace="dashboard"
+)
+
 if __name__ == "__main__":
+    REGISTRY.namespace = "dashboard"
     logging.info(f"HA base: {BASE_URL}")
     logging.info(f"HTTP listening on {HTTP_HOST}:{HTTP_PORT}")
     logging.info(f"Default filters → query='{DEFAULT_QUERY}', prefix='{DEFAULT_PREFIX}', suffix='{DEFAULT_SUFFIX}'")
+    STATE_INDEX.start()
     app.run(host=HTTP_HOST, port=HTTP_PORT, debug=False, threaded=True)
@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+"""
+/devices 回應格式基準：原本的巢狀格式 vs. format=columnar，以及 fields 投影、gzip / br 壓縮。
+
+  python3 bench/bench_devices.py [--devices 2000] [--rounds 10]
+
+HA states 用假資料（每台裝置 23 個欄位，同 static/status.js 的 COLUMN_CONFIG），
+直接呼叫 3drp_show 的 Flask app（test client），不經過快取；
+時間是「整理 + 序列化 + 壓縮」的最佳值，大小是實際送出的 bytes。
+"""
+import argparse
+import importlib
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+os.environ.setdefault("SUPERVISOR_TOKEN", "bench")
+dashboard = importlib.import_module("3drp_show")  # noqa: E402
+
+SUFFIXES = [
+    "_action", "_fwversion", "_a", "_al", "_c", "_cm", "_dn", "_fs", "_he", "_id", "_k", "_m",
+    "_p", "_page", "_totalpage", "_tsrm", "_w", "_y", "_yk", "_z1", "_z2", "_swversion", "_model",
+]
+VISIBLE = ["_action", "_dn", "_page", "_totalpage", "_z1", "_model"]  # DEFAULT_VISIBLE_KEYS
+PREFIX = "sensor.cometrue_"
+
+
+def make_states(n, seed=1):
+    rnd = random.Random(seed)
+    states = []
+    for i in range(n):
+        dev = f"{PREFIX}{100000000 + i}"
+        for s in SUFFIXES:
+            states.append({
+                "entity_id": f"{dev}{s}",
+                "state": rnd.choice(["idle", "printing", "unavailable"]) if s == "_action" else str(rnd.randint(0, 999)),
+                "last_updated": f"2026-10-17T{rnd.randint(0, 23):02d}:{rnd.randint(0, 59):02d}:"
+                                f"{rnd.randint(0, 59):02d}.{rnd.randint(0, 999999):06d}+00:00",
+                "attributes": {"friendly_name": f"{dev}{s}"},
+            })
+    return states
+
+
+def run_case(client, url, encoding, rounds):
+    headers = {"Accept-Encoding": encoding} if encoding else {}
+    best = float("inf")
+    size = 0
+    for _ in range(rounds):
+        dashboard.DEVICES_CACHE.clear()
+        t0 = time.perf_counter()
+        resp = client.get(url, headers=headers)
+        best = min(best, time.perf_counter() - t0)
+        size = len(resp.get_data())
+    return best, size
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--devices", type=int, default=2000)
+    ap.add_argument("--rounds", type=int, default=10)
+    args = ap.parse_args()
+
+    states = make_states(args.devices)
+    dashboard._get_all_states = lambda prefix="": states
+    client = dashboard.app.test_client()
+    base = f"/devices?prefix={PREFIX}&suffix={','.join(SUFFIXES)}&limit={args.devices}"
+    cases = [
+        ("nested", base),
+        ("nested+fields", f"{base}&fields={','.join(VISIBLE)}"),
+        ("columnar", f"{base}&format=columnar"),
+        ("columnar+fields", f"{base}&format=columnar&fields={','.join(VISIBLE)}"),
+    ]
+    encodings = [None, "gzip"] + (["br"] if dashboard.brotli is not None else [])
+    print(f"{args.devices} 台裝置 × {len(SUFFIXES)} 欄位，JSON：{'orjson' if dashboard.orjson else 'json'}")
+    print(f"{'格式':<18}{'壓縮':<8}{'時間 ms':>10}{'大小 bytes':>14}")
+    for name, url in cases:
+        for enc in encodings:
+            sec, size = run_case(client, url, enc, args.rounds)
+            print(f"{name:<18}{enc or '-':<8}{sec * 1000:>10.1f}{size:>14,}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+"""
+_match_suffix 微基準：原本逐一 endswith 的寫法 vs. suffix_match 的反轉 trie。
+
+  python3 bench/bench_match_suffix.py [--entities 10000] [--rounds 20]
+
+suffix 清單與 static/status.js 的 COLUMN_CONFIG 相同（23 個欄位）。
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from suffix_match import compile_suffixes  # noqa: E402
+
+SUFFIXES = [
+    "_action", "_fwversion", "_a", "_al", "_c", "_cm", "_dn", "_fs", "_he", "_id", "_k", "_m",
+    "_p", "_page", "_totalpage", "_tsrm", "_w", "_y", "_yk", "_z1", "_z2", "_swversion", "_model",
+]
+
+
+def naive_match_suffix(entity_id, suffixes):
+    """改寫前的 3drp_show._match_suffix。"""
+    if not suffixes:
+        return None, None
+    for s in suffixes:
+        if not s:
+            continue
+        if entity_id.endswith("_" + s):
+            return s, "_" + s
+        if entity_id.endswith(s):
+            return s, s
+    return None, None
+
+
+def make_entities(n, seed=1):
+    rnd = random.Random(seed)
+    # 一部分是不在清單裡的欄位，模擬 HA 裡其他實體
+    tails = [s[1:] for s in SUFFIXES] + ["temperature", "state", "xyz", "uptime"]
+    return [
+        f"sensor.cometrue_{rnd.randint(10**8, 10**9 - 1)}_{rnd.choice(tails)}"
+        for _ in range(n)
+    ]
+
+
+def bench(fn, entities, rounds):
+    best = float("inf")
+    for _ in range(rounds):
+        t0 = time.perf_counter()
+        for eid in entities:
+            fn(eid)
+        best = min(best, time.perf_counter() - t0)
+    return best
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--entities", type=int, default=10000)
+    ap.add_argument("--rounds", type=int, default=20)
+    args = ap.parse_args()
+
+    entities = make_entities(args.entities)
+    suffixes = tuple(SUFFIXES)
+    matcher = compile_suffixes(suffixes)
+
+    # 先確認兩種寫法結果完全一樣
+    for eid in entities:
+        assert naive_match_suffix(eid, suffixes) == matcher.match(eid), eid
+
+    t_naive = bench(lambda e: naive_match_suffix(e, suffixes), entities, args.rounds)
+    t_trie = bench(matcher.match, entities, args.rounds)
+    print(f"entities={args.entities} suffixes={len(suffixes)} (best of {args.rounds})")
+    print(f"  naive endswith loop : {t_naive * 1000:8.2f} ms")
+    print(f"  reversed-suffix trie: {t_trie * 1000:8.2f} ms")
+    print(f"  speedup             : {t_naive / t_trie:8.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+"""
+retained 訊息批次發佈基準：原本逐則 client.publish（QoS 0、不等完成）vs. BatchPublisher。
+
+  python3 bench/bench_publish.py [--messages 5000] [--window 100] [--max-queued 1000] [--broker host:port]
+
+沒給 --broker 時在背景啟動 bench/mqtt_lite.py；結果是「全部送達 broker」為止的時間與速率
+（逐則寫法沒有完成通知，所以改成等 broker 收到的數量到齊）。
+"""
+import argparse
+import os
+import socket
+import subprocess
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, ".."))
+import paho.mqtt.client as mqtt  # noqa: E402
+from publisher import BatchPublisher  # noqa: E402
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def wait_port(host, port, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection((host, port), 0.2).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError(f"broker {host}:{port} 沒有啟動")
+
+
+class Counter:
+    """訂閱 bench 用的 topic，數 broker 實際轉送了幾則。"""
+    def __init__(self, host, port, prefix):
+        self.n = 0
+        self.client = mqtt.Client()
+        self.client.on_message = self._on_message
+        self.client.connect(host, port)
+        self.client.subscribe(f"{prefix}/#")
+        self.client.loop_start()
+        time.sleep(0.3)
+
+    def _on_message(self, client, userdata, msg):
+        self.n += 1
+
+    def wait_for(self, n, timeout):
+        deadline = time.monotonic() + timeout
+        while self.n < n and time.monotonic() < deadline:
+            time.sleep(0.005)
+        return self.n
+
+
+def run_case(name, host, port, messages, setup, publish, timeout):
+    prefix = f"bench/{name}"
+    counter = Counter(host, port, prefix)
+    client = mqtt.Client()
+    setup(client)  # in-flight / queue 上限要在連線前設定
+    client.connect(host, port)
+    client.loop_start()
+    msgs = [(f"{prefix}/sensor_{i}/config", '{"name":"s%d"}' % i) for i in range(messages)]
+    t0 = time.monotonic()
+    result = publish(client, msgs)
+    got = counter.wait_for(messages, timeout)
+    elapsed = time.monotonic() - t0
+    for c in (client, counter.client):
+        c.disconnect()
+        c.loop_stop()
+    return {
+        "case": name,
+        "delivered": got,
+        "lost": messages - got,
+        "elapsed_ms": round(elapsed * 1000, 1),
+        "rate": round(got / elapsed, 1) if elapsed else None,
+        "result": result,
+    }
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--messages", type=int, default=5000)
+    ap.add_argument("--window", type=int, default=100)
+    ap.add_argument("--max-queued", type=int, default=1000)
+    ap.add_argument("--broker", help="host:port（不給就啟動 mqtt_lite）")
+    ap.add_argument("--timeout", type=float, default=30.0)
+    args = ap.parse_args()
+
+    broker = None
+    if args.broker:
+        host, port = args.broker.rsplit(":", 1)
+        port = int(port)
+    else:
+        host, port = "127.0.0.1", free_port()
+        broker = subprocess.Popen(
+            [sys.executable, os.path.join(HERE, "mqtt_lite.py"), "--port", str(port)],
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        )
+    try:
+        wait_port(host, port)
+
+        pub = BatchPublisher(qos=1, window=args.window)
+
+        def naive_setup(client):
+            client.max_queued_messages_set(args.max_queued)
+
+        def naive(client, msgs):
+            # 改寫前的做法：逐則 publish，不看結果；outgoing queue 有上限時超出的會被丟掉
+            rejected = sum(1 for t, p in msgs if client.publish(t, p, retain=False).rc != mqtt.MQTT_ERR_SUCCESS)
+            return {"rejected": rejected}
+
+        def batched_setup(client):
+            pub.configure_client(client, args.max_queued)
+
+        def batched(client, msgs):
+            return pub.publish_many(client, msgs, retain=False)
+
+        for name, setup, fn in (("naive", naive_setup, naive), ("batched", batched_setup, batched)):
+            print(run_case(name, host, port, args.messages, setup, fn, args.timeout))
+    finally:
+        if broker is not None:
+            broker.terminate()
+            broker.wait(5)
+
+
+if __name__ == "__main__":
+    main()
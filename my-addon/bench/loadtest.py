@@ -0,0 +1,505 @@
+#!/usr/bin/env python3
+"""
+整套壓測：迷你 MQTT broker + 假的 Supervisor HA API + N 台模擬 ZP2，實際啟動 run.py 與 local_ota_server.py。
+
+  python3 bench/loadtest.py [--devices 200] [--interval 1.0] [--outdated 0.2] [--duration 30]
+                            [--broker HOST:PORT] [--json out.json]
+
+流程：
+  1. 在暫存目錄寫 options.json，啟動 mqtt_lite broker（或用 --broker 指定現成的 mosquitto）、假 HA、
+     run.py 與 local_ota_server.py（都是獨立程序，和 add-on 裡一樣）
+  2. 每台模擬裝置每 interval 秒送一次 ZP2/<mac>/data；outdated 比例的裝置帶舊 FW
+  3. 收到 {"Ota": url} 後實際從 OTA server 下載，下載完就改報目標 FW
+  4. 結束時回報：送出 / 處理的訊息速率、OTA 指令端到端延遲（含 run.py 刻意的 3 秒延遲）、
+     下載量、run.py 與 OTA server 的 thread 數與 RSS，以及 /metrics 的主要數值
+
+每次執行都用固定的 --seed，同樣參數的結果可以直接比較。
+"""
+import argparse
+import asyncio
+import hashlib
+import http.server
+import json
+import os
+import random
+import re
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ADDON = os.path.dirname(HERE)
+sys.path.insert(0, HERE)
+sys.path.insert(0, ADDON)
+import mqtt_lite  # noqa: E402
+from ota_index import OtaIndex, read_ota_index  # noqa: E402
+
+
+def read_history(port, mac):
+    """從第 0 片的 /history 取一台裝置的 raw 歷史（分片時由第 0 片向負責的那一片代查）。"""
+    import urllib.request
+    try:
+        with urllib.request.urlopen(f"http://127.0.0.1:{port}/history?device={mac}&tier=raw", timeout=5) as r:
+            data = json.loads(r.read())
+    except (OSError, ValueError) as e:
+        return {"error": str(e)}
+    return {"device": mac, "points": {k: len(v["t"]) for k, v in data["series"].items()}}
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+# ---------------- 程序資源 ----------------
+def proc_status(pid):
+    """從 /proc/<pid>/status 取 thread 數與 RSS（KB）；非 Linux 回 None。"""
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            fields = dict(line.split(":", 1) for line in f if ":" in line)
+        return {
+            "threads": int(fields["Threads"].strip()),
+            "rss_kb": int(fields["VmRSS"].strip().split()[0]),
+        }
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+class ProcSampler:
+    def __init__(self, procs, interval=1.0):
+        self.procs = procs  # name -> Popen
+        self.interval = interval
+        self.peak = {name: {"threads": 0, "rss_kb": 0} for name in procs}
+        self.last = {}
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            for name, p in self.procs.items():
+                st = proc_status(p.pid)
+                if st is None:
+                    continue
+                self.last[name] = st
+                for k, v in st.items():
+                    self.peak[name][k] = max(self.peak[name][k], v)
+
+
+# ---------------- 假的 Supervisor HA API ----------------
+class FakeHA:
+    """只實作 GET /core/api/states；websocket 不支援，StateIndex 會自動退回 TTL 模式。"""
+    def __init__(self, entities):
+        self.states = json.dumps(entities).encode()
+        self.requests = 0
+        ha = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                ha.requests += 1
+                if self.path.rstrip("/") == "/core/api/states":
+                    self.send_response(200)
+                    self.send_header("Content-Type", "application/json")
+                    self.send_header("Content-Length", str(len(ha.states)))
+                    self.end_headers()
+                    self.wfile.write(ha.states)
+                else:
+                    self.send_error(404)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.port = self.server.server_address[1]
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+
+
+def make_entities(macs, fields=("p25", "co2", "fw")):
+    return [
+        {"entity_id": f"sensor.zp2_{mac}_{f}", "state": "0", "attributes": {}, "last_updated": ""}
+        for mac in macs for f in fields
+    ]
+
+
+# ---------------- 模擬 ZP2 ----------------
+class FleetStats:
+    def __init__(self):
+        self.published = 0
+        self.control_msgs = 0
+        self.ota_commands = 0
+        self.ota_latency = []      # 第一次帶舊 FW 發送 → 收到 Ota 指令（秒）
+        self.download_sec = []
+        self.downloaded_bytes = 0
+        self.download_errors = 0
+        self.sha_mismatch = 0
+        self.upgraded = 0
+        self.connect_errors = 0
+
+
+class SimDevice:
+    def __init__(self, mac, fw, target_fw, args, stats, rnd):
+        self.mac = mac
+        self.fw = fw
+        self.target_fw = target_fw
+        self.args = args
+        self.stats = stats
+        self.rnd = rnd
+        self.first_outdated_at = None
+        self.ota_started = False
+        self.seq = 0
+
+    def payload(self):
+        self.seq += 1
+        body = {"MODEL": "ZP2", "FW": self.fw, "Heartbeat": 1}
+        if not self.args.static_payload:
+            body["p25"] = self.rnd.randint(0, 80)
+            body["co2"] = self.rnd.randint(400, 1500)
+        return json.dumps(body, separators=(",", ":"))
+
+    async def run(self, host, port, deadline):
+        try:
+            reader, writer = await asyncio.open_connection(host, port)
+        except OSError:
+            self.stats.connect_errors += 1
+            return
+        writer.write(mqtt_lite.connect_packet(f"sim-{self.mac}"))
+        writer.write(mqtt_lite.subscribe_packet(1, [f"ZP2/{self.mac}/control"]))
+        await writer.drain()
+        recv = asyncio.ensure_future(self._recv(reader))
+        # 錯開起始時間，避免所有裝置同一瞬間發送
+        await asyncio.sleep(self.rnd.random() * self.args.interval)
+        topic = f"ZP2/{self.mac}/data"
+        try:
+            while time.monotonic() < deadline:
+                if self.fw != self.target_fw and self.first_outdated_at is None:
+                    self.first_outdated_at = time.monotonic()
+                writer.write(mqtt_lite.publish_packet(topic, self.payload()))
+                self.stats.published += 1
+                await writer.drain()
+                await asyncio.sleep(self.args.interval)
+        except ConnectionError:
+            pass
+        finally:
+            recv.cancel()
+            writer.close()
+
+    async def _recv(self, reader):
+        while True:
+            try:
+                ptype, flags, body = await mqtt_lite.read_packet(reader)
+            except (asyncio.IncompleteReadError, ConnectionError):
+                return
+            if ptype != mqtt_lite.PUBLISH:
+                continue
+            _, payload, _, _, _ = mqtt_lite.parse_publish(flags, body)
+            self.stats.control_msgs += 1
+            try:
+                cmd = json.loads(payload)
+            except ValueError:
+                continue
+            if "Ota" in cmd and not self.ota_started:
+                self.ota_started = True
+                self.stats.ota_commands += 1
+                if self.first_outdated_at is not None:
+                    self.stats.ota_latency.append(time.monotonic() - self.first_outdated_at)
+                asyncio.ensure_future(self._download(cmd))
+
+    async def _download(self, cmd):
+        url = cmd["Ota"]
+        rest = url.split("://", 1)[1]
+        hostport, path = rest.split("/", 1)
+        host, port = hostport.rsplit(":", 1)
+        t0 = time.monotonic()
+        try:
+            reader, writer = await asyncio.open_connection(host, int(port))
+            writer.write(f"GET /{path} HTTP/1.1\r\nHost: {hostport}\r\nConnection: close\r\n\r\n".encode())
+            await writer.drain()
+            head = await reader.readuntil(b"\r\n\r\n")
+            status = int(head.split(b" ", 2)[1])
+            h = hashlib.sha256()
+            n = 0
+            while True:
+                chunk = await reader.read(64 * 1024)
+                if not chunk:
+                    break
+                h.update(chunk)
+                n += len(chunk)
+            writer.close()
+        except (OSError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ValueError):
+            self.stats.download_errors += 1
+            self.ota_started = False
+            return
+        if status != 200:
+            self.stats.download_errors += 1
+            self.ota_started = False
+            return
+        self.stats.downloaded_bytes += n
+        self.stats.download_sec.append(time.monotonic() - t0)
+        if cmd.get("Sha256") and cmd["Sha256"] != h.hexdigest():
+            self.stats.sha_mismatch += 1
+            self.ota_started = False
+            return
+        # 模擬更新完成重開機：之後回報目標版本
+        self.fw = self.target_fw
+        self.first_outdated_at = None
+        self.stats.upgraded += 1
+
+
+async def run_fleet(args, host, port, target_fw, stats):
+    rnd = random.Random(args.seed)
+    devices = []
+    for i in range(args.devices):
+        mac = f"{0xA0B0C0000000 + i:012x}"
+        outdated = rnd.random() < args.outdated
+        devices.append(SimDevice(mac, args.old_fw if outdated else target_fw, target_fw, args, stats,
+                                 random.Random(args.seed + i)))
+    deadline = time.monotonic() + args.duration
+    await asyncio.gather(*(d.run(host, port, deadline) for d in devices))
+    return devices
+
+
+# ---------------- 啟動被測程序 ----------------
+def wait_port(host, port, timeout=10.0):
+    end = time.monotonic() + timeout
+    while time.monotonic() < end:
+        try:
+            with socket.create_connection((host, port), timeout=0.5):
+                return True
+        except OSError:
+            time.sleep(0.1)
+    return False
+
+
+def read_metrics(port):
+    import urllib.request
+    try:
+        text = urllib.request.urlopen(f"http://127.0.0.1:{port}/metrics", timeout=5).read().decode()
+    except OSError:
+        return {}
+    out = {}
+    for line in text.splitlines():
+        if line.startswith("#") or "_bucket" in line or not line.strip():
+            continue
+        name, _, value = line.rpartition(" ")
+        # 分片時各 run.py 的同名指標帶 shard 標籤：拿掉標籤加總
+        name = re.sub(r',?shard="[^"]*"', "", name).replace("{,", "{").replace("{}", "")
+        try:
+            out[name] = out.get(name, 0.0) + float(value)
+        except ValueError:
+            pass
+    return out
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--devices", type=int, default=200)
+    ap.add_argument("--interval", type=float, default=1.0, help="每台裝置的發送間隔（秒）")
+    ap.add_argument("--outdated", type=float, default=0.2, help="帶舊 FW 的裝置比例")
+    ap.add_argument("--old-fw", default="OLD-FW")
+    ap.add_argument("--duration", type=float, default=30.0)
+    ap.add_argument("--static-payload", action="store_true", help="每次送完全相同的內容（測試重複略過）")
+    ap.add_argument("--ota-concurrency", type=int, default=10)
+    ap.add_argument("--shards", type=int, default=1, help="run.py 分片數（ingest_shards）")
+    ap.add_argument("--profile", default="zp2_5_0_20251205_s01")
+    ap.add_argument("--ota-dir", default=os.path.join(ADDON, "ota"))
+    ap.add_argument("--broker", help="HOST:PORT；不給就啟動 bench/mqtt_lite.py")
+    ap.add_argument("--seed", type=int, default=1)
+    ap.add_argument("--keep", action="store_true", help="保留暫存目錄（內含 run.py / OTA server 的 log）")
+    ap.add_argument("--json", help="把結果寫成 JSON 檔")
+    args = ap.parse_args()
+
+    tmp = tempfile.mkdtemp(prefix="zp2-bench-")
+    data_dir = os.path.join(tmp, "data")
+    metrics_dir = os.path.join(tmp, "metrics")
+    os.makedirs(data_dir)
+    index_path = os.path.join(args.ota_dir, "ota_index.yaml")
+    ota_root = os.path.join(args.ota_dir, "zp2_fw")
+    target = OtaIndex(read_ota_index(index_path), {"ZP2": args.profile}).resolve("ZP2", "")
+    if not target:
+        sys.exit(f"找不到 profile {args.profile}")
+    target_fw = target["version"]
+
+    procs = {}
+    broker_proc = None
+    if args.broker:
+        mqtt_host, mqtt_port = args.broker.rsplit(":", 1)
+        mqtt_port = int(mqtt_port)
+    else:
+        mqtt_host, mqtt_port = "127.0.0.1", free_port()
+        broker_proc = subprocess.Popen(
+            [sys.executable, os.path.join(HERE, "mqtt_lite.py"), "--port", str(mqtt_port)],
+            stdout=subprocess.PIPE, text=True,
+        )
+        procs["broker"] = broker_proc
+        if not wait_port(mqtt_host, mqtt_port):
+            sys.exit("mqtt_lite 啟動失敗")
+
+    macs = [f"{0xA0B0C0000000 + i:012x}" for i in range(args.devices)]
+    ha = FakeHA(make_entities(macs))
+    ota_port = free_port()
+    history_port = free_port()  # 分片時各片用 history_port + 分片編號
+
+    with open(os.path.join(data_dir, "options.json"), "w") as f:
+        json.dump({
+            "local_ip": "127.0.0.1",
+            "zp2_fw_profile": args.profile,
+            "zp2_outbound_setup": False,
+            "mqtt_topics": "+/+/data,+/+/control",
+            "mqtt_broker": mqtt_host,
+            "mqtt_port": mqtt_port,
+            "mqtt_username": "",
+            "mqtt_password": "",
+            "ota_max_concurrent": args.ota_concurrency,
+            "log_sample_every": 1000,
+            "rediscover_debounce_sec": 1,  # 短時間壓測也要看得到 discovery
+            "history_port": history_port,
+        }, f)
+
+    env = dict(
+        os.environ,
+        ZP2_DATA_DIR=data_dir,
+        ZP2_METRICS_DIR=metrics_dir,
+        HA_BASE_URL=f"http://127.0.0.1:{ha.port}/core/api",
+        SUPERVISOR_TOKEN="bench",
+        OTA_PORT=str(ota_port),
+        OTA_ROOT=ota_root,
+        OTA_INDEX=index_path,
+        OTA_ARTIFACT_DIR=os.path.join(data_dir, "ota_artifacts"),
+        PYTHONUNBUFFERED="1",
+    )
+    logs = {}
+    run_names = ["run"] if args.shards == 1 else [f"run{i}" for i in range(args.shards)]
+    scripts = [("ota_server", "local_ota_server.py", {})] + [
+        (name, "run.py", {"ZP2_SHARD_INDEX": str(i), "ZP2_SHARD_COUNT": str(args.shards)})
+        for i, name in enumerate(run_names)
+    ]
+    for name, script, extra_env in scripts:
+        logs[name] = open(os.path.join(tmp, f"{name}.log"), "w")
+        procs[name] = subprocess.Popen(
+            [sys.executable, os.path.join(ADDON, script)], cwd=ADDON, env=dict(env, **extra_env),
+            stdout=logs[name], stderr=subprocess.STDOUT,
+        )
+    if not wait_port("127.0.0.1", ota_port):
+        sys.exit(f"OTA server 啟動失敗，見 {tmp}/ota_server.log")
+    time.sleep(1.0)  # 等 run.py 連上 broker 並訂閱
+
+    sampler = ProcSampler({k: v for k, v in procs.items() if k != "broker"})
+    sampler.start()
+    stats = FleetStats()
+    print(f"[bench] {args.devices} 台裝置，每 {args.interval}s 一筆，{args.duration}s，"
+          f"舊 FW 比例 {args.outdated}，目標 FW {target_fw}", flush=True)
+    t0 = time.monotonic()
+    asyncio.run(run_fleet(args, mqtt_host, mqtt_port, target_fw, stats))
+    elapsed = time.monotonic() - t0
+    time.sleep(1.0)  # 讓最後一批訊息處理完
+    sampler.stop()
+    history = read_history(history_port, macs[0])
+
+    # run.py 收到 SIGTERM 會在結束前寫出最終指標，OTA server 的 /metrics 會一起帶出來
+    for name in run_names:
+        procs[name].send_signal(signal.SIGTERM)
+    for name in run_names:
+        try:
+            procs[name].wait(10)
+        except subprocess.TimeoutExpired:
+            procs[name].kill()
+    metrics = read_metrics(ota_port)
+    procs["ota_server"].terminate()
+    procs["ota_server"].wait(10)
+    broker_stats = None
+    if broker_proc is not None:
+        broker_proc.send_signal(signal.SIGTERM)
+        out, _ = broker_proc.communicate(timeout=10)
+        try:
+            broker_stats = json.loads(out.strip().splitlines()[-1])
+        except (ValueError, IndexError):
+            pass
+    ha.close()
+    for f in logs.values():
+        f.close()
+
+    def m(name):
+        return metrics.get(name)
+
+    received = m("zp2_ingest_messages_received_total") or 0
+    result = {
+        "params": vars(args),
+        "elapsed_sec": round(elapsed, 2),
+        "fleet": {
+            "published": stats.published,
+            "publish_rate": round(stats.published / elapsed, 1),
+            "connect_errors": stats.connect_errors,
+            "control_msgs": stats.control_msgs,
+            "ota_commands": stats.ota_commands,
+            "upgraded": stats.upgraded,
+            "download_errors": stats.download_errors,
+            "sha_mismatch": stats.sha_mismatch,
+            "downloaded_bytes": stats.downloaded_bytes,
+        },
+        "ota_command_latency_sec": {
+            "p50": percentile(stats.ota_latency, 0.50),
+            "p95": percentile(stats.ota_latency, 0.95),
+            "max": max(stats.ota_latency) if stats.ota_latency else None,
+        },
+        "download_sec": {
+            "p50": percentile(stats.download_sec, 0.50),
+            "p95": percentile(stats.download_sec, 0.95),
+        },
+        "run_py": {
+            "received": received,
+            "received_rate": round(received / elapsed, 1),
+            "parsed": m("zp2_ingest_messages_parsed_total"),
+            "dropped_overflow": m('zp2_ingest_messages_dropped_total{reason="overflow"}'),
+            "duplicate": m('zp2_ingest_messages_duplicate_total'),
+            "handler_errors": m("zp2_ingest_handler_errors_total"),
+            "dispatch_avg_ms": (
+                round(m("zp2_ingest_dispatch_seconds_sum") / m("zp2_ingest_dispatch_seconds_count") * 1000, 3)
+                if m("zp2_ingest_dispatch_seconds_count") else None
+            ),
+            "discovery_publishes": m('zp2_discovery_publishes_total{kind="config"}'),
+        },
+        "ota_server": {
+            "bytes_served": m("ota_bytes_served_total"),
+            "responses_200": m('ota_http_responses_total{code="200"}'),
+            "rejected": m("ota_connections_rejected_total"),
+        },
+        "history": history,
+        "processes": {name: {"peak": sampler.peak[name], "last": sampler.last.get(name)} for name in sampler.procs},
+        "broker": broker_stats,
+        "ha_requests": ha.requests,
+    }
+
+    print(json.dumps(result, indent=2, ensure_ascii=False))
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(result, f, indent=2, ensure_ascii=False)
+    if args.keep:
+        print(f"[bench] log 保留在 {tmp}", flush=True)
+    else:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,272 @@
+#!/usr/bin/env python3
+"""
+壓測用的迷你 MQTT 3.1.1 / 5 broker 與 asyncio 封包工具（不是正式 broker，只夠 bench/loadtest.py 用）。
+
+  python3 bench/mqtt_lite.py [--port 18830]
+
+支援：CONNECT / PUBLISH（QoS 0、1；retain）/ SUBSCRIBE（+、# 萬用字元）/ UNSUBSCRIBE / PINGREQ / DISCONNECT。
+所有送出的訊息都以 QoS 0 轉發；沒有 session 保存、will、認證（帳密會被忽略）。
+MQTT 5 的 client 只支援到 noLocal 訂閱選項（分片的 run.py 會用），其他 properties 一律忽略。
+收到 SIGTERM / Ctrl-C 時把統計印成一行 JSON 到 stdout。
+"""
+import argparse
+import asyncio
+import json
+import signal
+import struct
+
+CONNECT, CONNACK, PUBLISH, PUBACK = 1, 2, 3, 4
+SUBSCRIBE, SUBACK, UNSUBSCRIBE, UNSUBACK = 8, 9, 10, 11
+PINGREQ, PINGRESP, DISCONNECT = 12, 13, 14
+
+
+# ---------------- 封包編解碼 ----------------
+def _varint(n):
+    out = bytearray()
+    while True:
+        b = n % 128
+        n //= 128
+        out.append(b | 0x80 if n else b)
+        if not n:
+            return bytes(out)
+
+
+def _str(s):
+    b = s.encode() if isinstance(s, str) else s
+    return struct.pack("!H", len(b)) + b
+
+
+def packet(ptype, flags, body=b""):
+    return bytes([(ptype << 4) | flags]) + _varint(len(body)) + body
+
+
+def connect_packet(client_id, keepalive=60, clean=True):
+    flags = 0x02 if clean else 0
+    return packet(CONNECT, 0, _str("MQTT") + bytes([4, flags]) + struct.pack("!H", keepalive) + _str(client_id))
+
+
+def publish_packet(topic, payload, retain=False, qos=0, packet_id=1, v5=False):
+    if isinstance(payload, str):
+        payload = payload.encode()
+    body = _str(topic) + (struct.pack("!H", packet_id) if qos else b"") + (b"\x00" if v5 else b"") + payload
+    return packet(PUBLISH, (qos << 1) | (1 if retain else 0), body)
+
+
+def subscribe_packet(packet_id, topics, qos=0):
+    body = struct.pack("!H", packet_id) + b"".join(_str(t) + bytes([qos]) for t in topics)
+    return packet(SUBSCRIBE, 0x02, body)
+
+
+async def read_packet(reader):
+    """回傳 (type, flags, body)；連線關閉時丟 asyncio.IncompleteReadError。"""
+    head = await reader.readexactly(1)
+    mult, length = 1, 0
+    while True:
+        b = (await reader.readexactly(1))[0]
+        length += (b & 0x7F) * mult
+        if not b & 0x80:
+            break
+        mult *= 128
+    body = await reader.readexactly(length) if length else b""
+    return head[0] >> 4, head[0] & 0x0F, body
+
+
+def _skip_properties(body, pos):
+    """MQTT 5：跳過 properties（varint 長度 + 內容），回傳之後的位置。"""
+    mult, length = 1, 0
+    while True:
+        b = body[pos]
+        pos += 1
+        length += (b & 0x7F) * mult
+        if not b & 0x80:
+            return pos + length
+        mult *= 128
+
+
+def parse_publish(flags, body, v5=False):
+    """回傳 (topic, payload, qos, packet_id, retain)。"""
+    tlen = struct.unpack_from("!H", body)[0]
+    topic = body[2:2 + tlen].decode()
+    pos = 2 + tlen
+    qos = (flags >> 1) & 0x03
+    packet_id = None
+    if qos:
+        packet_id = struct.unpack_from("!H", body, pos)[0]
+        pos += 2
+    if v5:
+        pos = _skip_properties(body, pos)
+    return topic, body[pos:], qos, packet_id, bool(flags & 0x01)
+
+
+def topic_matches(filter_parts, topic_parts):
+    for i, f in enumerate(filter_parts):
+        if f == "#":
+            return True
+        if i >= len(topic_parts):
+            return False
+        if f != "+" and f != topic_parts[i]:
+            return False
+    return len(filter_parts) == len(topic_parts)
+
+
+# ---------------- broker ----------------
+class _Session:
+    __slots__ = ("writer", "client_id", "filters", "v5", "no_local")
+
+    def __init__(self, writer):
+        self.writer = writer
+        self.client_id = ""
+        self.filters = set()
+        self.v5 = False
+        self.no_local = set()  # 以 noLocal 訂閱的 filter：自己發的訊息不送回來
+
+
+class MiniBroker:
+    """沒有萬用字元的訂閱用 dict 直接查，只有萬用字元訂閱才逐一比對。"""
+    def __init__(self):
+        self.exact = {}      # topic -> set(session)
+        self.wild = {}       # filter -> (parts, set(session))
+        self.retained = {}   # topic -> payload
+        self.stats = {"connections": 0, "published": 0, "delivered": 0, "bytes_in": 0, "bytes_out": 0}
+
+    async def handle(self, reader, writer):
+        sess = _Session(writer)
+        self.stats["connections"] += 1
+        try:
+            while True:
+                ptype, flags, body = await read_packet(reader)
+                self.stats["bytes_in"] += len(body) + 2
+                if ptype == CONNECT:
+                    # 協定名稱(2+4) + level(1) + flags(1) + keepalive(2)（v5 再接 properties）之後是 client id
+                    sess.v5 = body[6] == 5
+                    pos = _skip_properties(body, 10) if sess.v5 else 10
+                    cid_len = struct.unpack_from("!H", body, pos)[0]
+                    sess.client_id = body[pos + 2:pos + 2 + cid_len].decode(errors="replace")
+                    writer.write(packet(CONNACK, 0, b"\x00\x00\x00" if sess.v5 else b"\x00\x00"))
+                elif ptype == PUBLISH:
+                    topic, payload, qos, pid, retain = parse_publish(flags, body, sess.v5)
+                    if qos == 1:
+                        writer.write(packet(PUBACK, 0, struct.pack("!H", pid)))
+                    if retain:
+                        if payload:
+                            self.retained[topic] = payload
+                        else:
+                            self.retained.pop(topic, None)
+                    self.route(topic, payload, sess)
+                elif ptype == SUBSCRIBE:
+                    pid = struct.unpack_from("!H", body)[0]
+                    pos = _skip_properties(body, 2) if sess.v5 else 2
+                    granted, new = bytearray(), []
+                    while pos < len(body):
+                        tlen = struct.unpack_from("!H", body, pos)[0]
+                        filt = body[pos + 2:pos + 2 + tlen].decode()
+                        opts = body[pos + 2 + tlen]
+                        pos += 2 + tlen + 1
+                        self._subscribe(sess, filt, no_local=sess.v5 and bool(opts & 0x04))
+                        granted.append(0)
+                        new.append(filt)
+                    props = b"\x00" if sess.v5 else b""
+                    writer.write(packet(SUBACK, 0, struct.pack("!H", pid) + props + bytes(granted)))
+                    for filt in new:
+                        self._send_retained(sess, filt)
+                elif ptype == UNSUBSCRIBE:
+                    pid = struct.unpack_from("!H", body)[0]
+                    pos = _skip_properties(body, 2) if sess.v5 else 2
+                    count = 0
+                    while pos < len(body):
+                        tlen = struct.unpack_from("!H", body, pos)[0]
+                        self._unsubscribe(sess, body[pos + 2:pos + 2 + tlen].decode())
+                        pos += 2 + tlen
+                        count += 1
+                    tail = b"\x00" + bytes(count) if sess.v5 else b""
+                    writer.write(packet(UNSUBACK, 0, struct.pack("!H", pid) + tail))
+                elif ptype == PINGREQ:
+                    writer.write(packet(PINGRESP, 0))
+                elif ptype == DISCONNECT:
+                    break
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            for filt in list(sess.filters):
+                self._unsubscribe(sess, filt)
+            writer.close()
+
+    def _subscribe(self, sess, filt, no_local=False):
+        sess.filters.add(filt)
+        if no_local:
+            sess.no_local.add(filt)
+        else:
+            sess.no_local.discard(filt)
+        if "+" in filt or "#" in filt:
+            self.wild.setdefault(filt, (filt.split("/"), set()))[1].add(sess)
+        else:
+            self.exact.setdefault(filt, set()).add(sess)
+
+    def _unsubscribe(self, sess, filt):
+        sess.filters.discard(filt)
+        sess.no_local.discard(filt)
+        if filt in self.exact:
+            self.exact[filt].discard(sess)
+            if not self.exact[filt]:
+                del self.exact[filt]
+        elif filt in self.wild:
+            self.wild[filt][1].discard(sess)
+            if not self.wild[filt][1]:
+                del self.wild[filt]
+
+    def _send_retained(self, sess, filt):
+        parts = filt.split("/")
+        for topic, payload in self.retained.items():
+            if topic_matches(parts, topic.split("/")):
+                sess.writer.write(publish_packet(topic, payload, retain=True, v5=sess.v5))
+
+    def route(self, topic, payload, sender=None):
+        self.stats["published"] += 1
+        targets = set(self.exact.get(topic, ()))
+        if self.wild:
+            tparts = topic.split("/")
+            for parts, sessions in self.wild.values():
+                if topic_matches(parts, tparts):
+                    targets |= sessions
+        if sender in targets and sender.no_local:
+            # 發送者只有 noLocal 的訂閱符合時不送回給它
+            tparts = topic.split("/")
+            if all(f in sender.no_local for f in sender.filters if topic_matches(f.split("/"), tparts)):
+                targets.discard(sender)
+        if not targets:
+            return
+        data = {False: publish_packet(topic, payload)}
+        for s in targets:
+            if s.v5 not in data:
+                data[s.v5] = publish_packet(topic, payload, v5=s.v5)
+            s.writer.write(data[s.v5])
+            self.stats["bytes_out"] += len(data[s.v5])
+        self.stats["delivered"] += len(targets)
+
+
+async def serve(host, port, ready=None):
+    broker = MiniBroker()
+    server = await asyncio.start_server(broker.handle, host, port, backlog=4096)
+    if ready is not None:
+        ready(server)
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stop.set)
+    async with server:
+        await stop.wait()
+    return broker
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--port", type=int, default=18830)
+    args = ap.parse_args()
+    broker = asyncio.run(serve(args.host, args.port, ready=lambda s: print("READY", flush=True)))
+    print(json.dumps(broker.stats), flush=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+# ------------------------------------------------------------
+# ♻️ 重複 payload 判斷（每個 topic 記住上一筆內容的 hash）
+# ------------------------------------------------------------
+class PayloadDedup:
+    """
+    is_duplicate(key, payload)：跟同一個 key 上一筆的內容 hash 相同、且距離上次「真正處理」
+    還不到 max_age 秒就回 True。超過 max_age 的重複訊息仍會放行一次，
+    讓 OTA 狀態、Discovery 之類的定期檢查不會因為裝置一直送一樣的內容而永遠不跑。
+    max_age <= 0 代表停用（永遠回 False）。
+    attach(key, value) 可以把解析後的內容掛在目前的 hash 上，重複時用 value(key) 取回，不必再解析一次。
+    """
+    def __init__(self, max_age=60.0, max_entries=50000, clock=time.monotonic):
+        self.max_age = float(max_age)
+        self.max_entries = max(1, int(max_entries))
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._last = OrderedDict()   # key -> [digest, processed_at, value]
+
+        self.duplicates = 0
+        self.passed = 0
+
+    def is_duplicate(self, key, payload):
+        if self.max_age <= 0:
+            return False
+        if isinstance(payload, str):
+            payload = payload.encode()
+        digest = hashlib.blake2b(payload, digest_size=8).digest()
+        now = self._clock()
+        with self._lock:
+            last = self._last.get(key)
+            if last is not None and last[0] == digest and now - last[1] < self.max_age:
+                self.duplicates += 1
+                return True
+            self._last[key] = [digest, now, None]
+            self._last.move_to_end(key)
+            if len(self._last) > self.max_entries:
+                self._last.popitem(last=False)
+            self.passed += 1
+            return False
+
+    def attach(self, key, value):
+        """把 key 最近一筆內容解析後的結果記下來（只在剛被判定為新內容之後呼叫）。"""
+        with self._lock:
+            last = self._last.get(key)
+            if last is not None:
+                last[2] = value
+
+    def value(self, key):
+        """attach 過的內容；沒有就回 None。"""
+        with self._lock:
+            last = self._last.get(key)
+            return None if last is None else last[2]
+
+    def forget(self, key):
+        """下一筆同 key 的訊息強制當成新的（例如要重建 Discovery 時）。"""
+        with self._lock:
+            self._last.pop(key, None)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "keys": len(self._last),
+                "duplicates": self.duplicates,
+                "passed": self.passed,
+            }
+
+
+# ------------------------------------------------------------
+# ⏱️ 每個 key 的最小間隔（控制指令回覆節流）
+# ------------------------------------------------------------
+class KeyedThrottle:
+    """allow(key)：距離同 key 上次放行未滿 min_interval 秒就回 False。min_interval <= 0 代表不節流。"""
+    def __init__(self, min_interval=10.0, max_entries=50000, clock=time.monotonic):
+        self.min_interval = float(min_interval)
+        self.max_entries = max(1, int(max_entries))
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._last = OrderedDict()   # key -> last allowed at
+
+        self.allowed = 0
+        self.throttled = 0
+
+    def allow(self, key):
+        if self.min_interval <= 0:
+            return True
+        now = self._clock()
+        with self._lock:
+            last = self._last.get(key)
+            if last is not None and now - last < self.min_interval:
+                self.throttled += 1
+                return False
+            self._last[key] = now
+            self._last.move_to_end(key)
+            if len(self._last) > self.max_entries:
+                self._last.popitem(last=False)
+            self.allowed += 1
+            return True
+
+    def stats(self):
+        with self._lock:
+            return {
+                "keys": len(self._last),
+                "allowed": self.allowed,
+                "throttled": self.throttled,
+            }
@@ -0,0 +1,194 @@
+import json
+import logging
+import sqlite3
+import threading
+import time
+
+# ------------------------------------------------------------
+# 💾 裝置紀錄（SQLite，存在 /data，重開後接續上次的狀態）
+# ------------------------------------------------------------
+FIELDS = (
+    "name", "mac", "fw", "sensors", "discovery",
+    "ota_state", "ota_target", "ota_attempts", "ota_updated_at", "last_seen",
+)
+JSON_FIELDS = ("sensors", "discovery")
+SCHEMA_VERSION = 1
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS devices (
+    key            TEXT PRIMARY KEY,
+    name           TEXT,
+    mac            TEXT,
+    fw             TEXT,
+    sensors        TEXT,
+    discovery      TEXT,
+    ota_state      TEXT,
+    ota_target     TEXT,
+    ota_attempts   INTEGER,
+    ota_updated_at REAL,
+    last_seen      REAL
+)
+"""
+
+
+class DeviceStore:
+    """
+    每台裝置一列（key = "<dev>_<mac>"，小寫）：最後回報的 FW、sensor 欄位、discovery 指紋、OTA 狀態。
+
+    啟動時整張表一次載入記憶體（幾百台只要幾 ms），之後讀取都走記憶體；
+    更新只標記 dirty，由 save_if_dirty() 定期在一個 transaction 內寫回，
+    每台裝置每則訊息都不會碰到磁碟。last_seen 只有變化超過 last_seen_resolution 秒才算 dirty。
+    """
+    def __init__(self, path="/data/devices.db", last_seen_resolution=60.0):
+        self.path = path
+        self.last_seen_resolution = float(last_seen_resolution)
+        self._lock = threading.Lock()
+        self._db_lock = threading.Lock()
+        self._records = {}
+        self._dirty = set()
+        self._deleted = set()
+        self._db = None
+
+        self.saves = 0
+        self.load_ms = 0.0
+        self.load()
+
+    # ---------------- 載入 / 存檔 ----------------
+    def _connect(self):
+        db = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")
+        db.execute(_SCHEMA)
+        db.execute(f"PRAGMA user_version={SCHEMA_VERSION}")
+        return db
+
+    def load(self):
+        t0 = time.perf_counter()
+        records = {}
+        try:
+            with self._db_lock:
+                if self._db is None:
+                    self._db = self._connect()
+                cur = self._db.execute(f"SELECT key, {', '.join(FIELDS)} FROM devices")
+                for row in cur:
+                    rec = dict(zip(FIELDS, row[1:]))
+                    for f in JSON_FIELDS:
+                        rec[f] = json.loads(rec[f]) if rec[f] else None
+                    records[row[0]] = rec
+        except (sqlite3.Error, ValueError) as e:
+            logging.error(f"[devices] 讀取 {self.path} 失敗，從空白開始：{e}")
+        with self._lock:
+            self._records = records
+            self._dirty.clear()
+            self._deleted.clear()
+        self.load_ms = (time.perf_counter() - t0) * 1000
+        logging.info(f"[devices] 載入 {len(records)} 台裝置紀錄（{self.load_ms:.1f} ms）")
+        return len(records)
+
+    def save_if_dirty(self):
+        with self._lock:
+            if not self._dirty and not self._deleted:
+                return False
+            rows = []
+            for key in self._dirty:
+                rec = self._records.get(key)
+                if rec is None:
+                    continue
+                row = [key]
+                for f in FIELDS:
+                    v = rec.get(f)
+                    row.append(json.dumps(v, separators=(",", ":")) if f in JSON_FIELDS and v is not None else v)
+                rows.append(row)
+            deleted = [(k,) for k in self._deleted]
+            dirty, self._dirty = self._dirty, set()
+            self._deleted = set()
+
+        cols = ", ".join(("key",) + FIELDS)
+        marks = ", ".join("?" * (len(FIELDS) + 1))
+        try:
+            with self._db_lock:
+                if self._db is None:
+                    self._db = self._connect()
+                self._db.execute("BEGIN")
+                try:
+                    self._db.executemany(f"INSERT OR REPLACE INTO devices ({cols}) VALUES ({marks})", rows)
+                    self._db.executemany("DELETE FROM devices WHERE key = ?", deleted)
+                    self._db.execute("COMMIT")
+                except Exception:
+                    self._db.execute("ROLLBACK")
+                    raise
+            self.saves += 1
+            return True
+        except sqlite3.Error as e:
+            with self._lock:
+                self._dirty |= dirty
+                self._deleted |= {k for (k,) in deleted}
+            logging.error(f"[devices] 寫入 {self.path} 失敗：{e}")
+            return False
+
+    def close(self):
+        self.save_if_dirty()
+        with self._db_lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+    # ---------------- 讀寫 ----------------
+    def get(self, key):
+        with self._lock:
+            rec = self._records.get(key)
+            return dict(rec) if rec is not None else None
+
+    def items(self):
+        with self._lock:
+            return [(k, dict(v)) for k, v in self._records.items()]
+
+    def update(self, key, **fields):
+        """只更新有變的欄位；回傳是否有任何變動。"""
+        with self._lock:
+            rec = self._records.get(key)
+            if rec is None:
+                rec = self._records[key] = dict.fromkeys(FIELDS)
+                self._deleted.discard(key)
+                changed = True
+            else:
+                changed = False
+            for f, v in fields.items():
+                if rec.get(f) != v:
+                    rec[f] = v
+                    changed = True
+            if changed:
+                self._dirty.add(key)
+            return changed
+
+    def touch(self, key, name, mac, fw, sensors):
+        """收到 data frame 時呼叫；回傳 FW 或 sensor 欄位是否跟上次不同（新裝置也算）。"""
+        now = time.time()
+        with self._lock:
+            rec = self._records.get(key)
+            changed = rec is None or rec.get("fw") != fw or rec.get("sensors") != sensors
+            if rec is None:
+                rec = self._records[key] = dict.fromkeys(FIELDS)
+                self._deleted.discard(key)
+            if changed or rec.get("name") != name or rec.get("mac") != mac:
+                rec.update(name=name, mac=mac, fw=fw, sensors=sensors, last_seen=now)
+                self._dirty.add(key)
+            elif now - (rec.get("last_seen") or 0) >= self.last_seen_resolution:
+                rec["last_seen"] = now
+                self._dirty.add(key)
+            return changed
+
+    def delete(self, key):
+        with self._lock:
+            if self._records.pop(key, None) is not None:
+                self._dirty.discard(key)
+                self._deleted.add(key)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "devices": len(self._records),
+                "dirty": len(self._dirty),
+                "saves": self.saves,
+                "load_ms": round(self.load_ms, 1),
+            }
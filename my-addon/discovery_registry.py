@@ -0,0 +1,125 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+
+# ------------------------------------------------------------
+# 🗃️ 已發佈的 MQTT Discovery config 紀錄（存在 /data）
+# ------------------------------------------------------------
+def fingerprint(payload):
+    """discovery payload（已序列化字串）的指紋。"""
+    return hashlib.sha1(payload.encode("utf-8")).hexdigest()[:16]
+
+
+def compact_json(obj):
+    """discovery 用的精簡 JSON（無縮排、key 排序，內容相同字串就相同）。"""
+    return json.dumps(obj, separators=(",", ":"), sort_keys=True)
+
+
+class DiscoveryRegistry:
+    """
+    記錄每台裝置目前發佈中的 discovery topic → 指紋：
+      { "<dev>_<mac>": { "<discovery topic>": "<fingerprint>", ... }, ... }
+    重新註冊時只比對差異，只發新增 / 變更 / 移除的 topic。
+    存檔採「標記 dirty + 定期 save_if_dirty」，避免每台裝置都寫一次檔案。
+    有給 store（device_store.DeviceStore）時改存在裝置資料庫的 discovery 欄位，
+    path 指向的舊 JSON 只在資料庫還沒有任何 discovery 紀錄時匯入一次。
+    """
+    def __init__(self, path="/data/discovery_registry.json", store=None):
+        self.path = path
+        self.store = store
+        self._lock = threading.Lock()
+        self._devices = {}
+        self._dirty = False
+        self.load()
+
+    def load(self):
+        if self.store is not None:
+            if any(rec.get("discovery") for _, rec in self.store.items()):
+                return
+            self._load_json()
+            for key, topics in self._devices.items():
+                self.store.update(key, discovery=dict(topics))
+            if self._devices:
+                logging.info(f"[registry] 已把 {self.path} 匯入裝置資料庫")
+            self._devices = {}
+            return
+        self._load_json()
+
+    def _load_json(self):
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f) or {}
+            self._devices = {k: dict(v) for k, v in data.get("devices", {}).items()}
+            logging.info(f"[registry] 載入 {len(self._devices)} 台裝置的 discovery 紀錄")
+        except FileNotFoundError:
+            self._devices = {}
+        except Exception as e:
+            logging.error(f"[registry] 讀取 {self.path} 失敗，從空白開始：{e}")
+            self._devices = {}
+
+    def save_if_dirty(self):
+        if self.store is not None:
+            return self.store.save_if_dirty()
+        with self._lock:
+            if not self._dirty:
+                return False
+            snapshot = {"devices": {k: dict(v) for k, v in self._devices.items()}}
+            self._dirty = False
+        tmp = f"{self.path}.tmp"
+        try:
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(snapshot, f, separators=(",", ":"))
+            os.replace(tmp, self.path)  # 原子替換，寫到一半斷電也不會壞檔
+            return True
+        except Exception as e:
+            with self._lock:
+                self._dirty = True
+            logging.error(f"[registry] 寫入 {self.path} 失敗：{e}")
+            return False
+
+    def get(self, device_key):
+        """回傳 {topic: fingerprint}；從未記錄過的裝置回傳 None。"""
+        if self.store is not None:
+            rec = self.store.get(device_key)
+            known = rec.get("discovery") if rec else None
+            return dict(known) if known is not None else None
+        with self._lock:
+            known = self._devices.get(device_key)
+            return dict(known) if known is not None else None
+
+    def diff(self, device_key, payloads):
+        """
+        payloads = {topic: 序列化後的 payload}
+        回傳 (added, changed, removed)，前兩者為 topic list，removed 為舊有但這次沒有的 topic。
+        從未記錄過的裝置全部算 added。
+        """
+        known = self.get(device_key) or {}
+        added, changed = [], []
+        for topic, payload in payloads.items():
+            old = known.get(topic)
+            if old is None:
+                added.append(topic)
+            elif old != fingerprint(payload):
+                changed.append(topic)
+        removed = [t for t in known if t not in payloads]
+        return added, changed, removed
+
+    def commit(self, device_key, payloads):
+        """發佈完成後記錄這台裝置目前的 discovery 內容。"""
+        if self.store is not None:
+            self.store.update(device_key, discovery={t: fingerprint(p) for t, p in payloads.items()})
+            return
+        with self._lock:
+            self._devices[device_key] = {t: fingerprint(p) for t, p in payloads.items()}
+            self._dirty = True
+
+    def forget(self, device_key):
+        if self.store is not None:
+            if self.store.get(device_key) is not None:
+                self.store.update(device_key, discovery=None)
+            return
+        with self._lock:
+            if self._devices.pop(device_key, None) is not None:
+                self._dirty = True
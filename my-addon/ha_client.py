@@ -0,0 +1,189 @@
+import json
+import logging
+import random
+import re
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from metrics import REGISTRY
+
+HA_API_SECONDS = REGISTRY.histogram("ha_api_request_seconds", "HA REST API 請求時間", ("endpoint",))
+HA_API_ERRORS = REGISTRY.counter("ha_api_errors_total", "HA REST API 請求失敗次數", ("endpoint",))
+HA_API_RETRIES = REGISTRY.counter("ha_api_retries_total", "HA REST API 重試次數", ("endpoint",))
+
+
+class CircuitOpenError(requests.ConnectionError):
+    """斷路器開啟中：HA 連續失敗，暫時不送請求（繼承 ConnectionError，原本的例外處理照樣適用）。"""
+
+
+# ------------------------------------------------------------
+# ⚡ 斷路器：連續失敗 threshold 次就開路，reset_sec 後放一個請求試試（half-open）
+# ------------------------------------------------------------
+class CircuitBreaker:
+    CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+    def __init__(self, threshold=5, reset_sec=30.0, clock=time.monotonic):
+        self.threshold = max(1, int(threshold))
+        self.reset_sec = float(reset_sec)
+        self._clock = clock
+        self._lock = threading.Lock()
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.opens = 0
+
+    def allow(self):
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and self._clock() - self.opened_at >= self.reset_sec:
+                self.state = self.HALF_OPEN  # 只放這一個請求去試
+                return True
+            return False
+
+    def success(self):
+        with self._lock:
+            if self.state != self.CLOSED:
+                logging.info("[ha-api] HA 恢復回應，斷路器關閉")
+            self.state = self.CLOSED
+            self.failures = 0
+
+    def failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or (self.state == self.CLOSED and self.failures >= self.threshold):
+                if self.state == self.CLOSED:
+                    logging.warning(f"[ha-api] 連續失敗 {self.failures} 次，{self.reset_sec:.0f} 秒內不再呼叫 HA")
+                self.state = self.OPEN
+                self.opened_at = self._clock()
+                self.opens += 1
+
+
+# ------------------------------------------------------------
+# 🌐 Supervisor Core API client（共用連線池 + 重試 + 斷路器）
+# ------------------------------------------------------------
+class HAClient:
+    """
+    所有 HA REST 呼叫共用一個 requests.Session（keep-alive 連線池），並且：
+      - 同時進行的請求最多 max_concurrency 個
+      - 連線錯誤 / 逾時 / 5xx / 429 以 full-jitter 指數退避重試 retries 次；其他例外不重試但算斷路器失敗
+      - 連續失敗 breaker_threshold 次就開路 breaker_reset_sec 秒，期間直接丟 CircuitOpenError
+      - 每個 endpoint（states / state / template）分開記錄延遲與錯誤（metrics.REGISTRY）
+    除了整份 get_states()，也可以只抓單一實體 get_state()，或用 template 在 HA 端先過濾。
+    """
+    _shared = {}
+    _shared_lock = threading.Lock()
+
+    @classmethod
+    def shared(cls, base_url, token, **kwargs):
+        """同一程序內相同 (base_url, token) 共用一個 client；參數以第一個建立的為準。"""
+        key = (base_url.rstrip("/"), token)
+        with cls._shared_lock:
+            client = cls._shared.get(key)
+            if client is None:
+                client = cls._shared[key] = cls(base_url, token, **kwargs)
+            return client
+
+    def __init__(self, base_url, token, timeout=5, max_concurrency=4, retries=2,
+                 backoff_base=0.5, backoff_max=8.0, breaker_threshold=5, breaker_reset_sec=30.0):
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout
+        self.retries = max(0, int(retries))
+        self.backoff_base = float(backoff_base)
+        self.backoff_max = float(backoff_max)
+        self.breaker = CircuitBreaker(breaker_threshold, breaker_reset_sec)
+        self._slots = threading.BoundedSemaphore(max(1, int(max_concurrency)))
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max(1, int(max_concurrency)), max_retries=0)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.session.headers.update({
+            "Authorization": f"Bearer {token}",
+            "Content-Type": "application/json",
+        })
+
+    # ---------------- 核心 ----------------
+    def _sleep_backoff(self, attempt):
+        time.sleep(random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt))))
+
+    def request(self, method, path, endpoint, ok_statuses=(), **kwargs):
+        """
+        送出請求並回傳 Response；HTTP 錯誤丟 requests.HTTPError（ok_statuses 內的狀態碼除外）。
+        4xx（429 以外）是呼叫端的問題，不重試也不算斷路器失敗。
+        """
+        url = f"{self.base_url}/{path.lstrip('/')}"
+        kwargs.setdefault("timeout", self.timeout)
+        attempt = 0
+        while True:
+            if not self.breaker.allow():
+                HA_API_ERRORS.inc(endpoint=endpoint)
+                raise CircuitOpenError(f"HA API 斷路器開啟中（{endpoint}）")
+            retryable = False
+            try:
+                with self._slots, HA_API_SECONDS.time(endpoint=endpoint):
+                    resp = self.session.request(method, url, **kwargs)
+                if resp.status_code in ok_statuses:
+                    self.breaker.success()
+                    return resp
+                if resp.status_code == 429 or resp.status_code >= 500:
+                    retryable = True
+                    resp.raise_for_status()
+                self.breaker.success()
+                resp.raise_for_status()
+                return resp
+            except (requests.ConnectionError, requests.Timeout, requests.HTTPError) as e:
+                if isinstance(e, requests.HTTPError) and not retryable:
+                    HA_API_ERRORS.inc(endpoint=endpoint)
+                    raise
+                self.breaker.failure()
+                HA_API_ERRORS.inc(endpoint=endpoint)
+                if attempt >= self.retries:
+                    raise
+                HA_API_RETRIES.inc(endpoint=endpoint)
+                self._sleep_backoff(attempt)
+                attempt += 1
+            except Exception:
+                # 其他 RequestException（ChunkedEncodingError、TooManyRedirects、InvalidURL…）或非預期的例外：
+                # 不重試，但一定要記一次失敗，否則 half-open 時放出去試的那一個請求永遠沒有結果，斷路器卡在開路
+                self.breaker.failure()
+                HA_API_ERRORS.inc(endpoint=endpoint)
+                raise
+
+    # ---------------- 常用呼叫 ----------------
+    def get_states(self):
+        """GET /states：全部實體。"""
+        return self.request("GET", "states", "states").json()
+
+    def get_state(self, entity_id):
+        """GET /states/<entity_id>：單一實體，不存在時回 None。"""
+        resp = self.request("GET", f"states/{entity_id}", "state", ok_statuses=(404,))
+        return None if resp.status_code == 404 else resp.json()
+
+    def render_template(self, template, **variables):
+        """POST /template：在 HA 端算好 Jinja template，回傳字串。"""
+        body = {"template": template}
+        if variables:
+            body["variables"] = variables
+        return self.request("POST", "template", "template", json=body).text
+
+    def entity_ids_with_prefix(self, prefix):
+        """只取 entity_id 以 prefix 開頭的 id 清單（HA 端過濾，不用把全部 states 傳回來）。"""
+        text = self.render_template(
+            "{{ states | map(attribute='entity_id') | select('match', pattern) | list | tojson }}",
+            pattern=re.escape(prefix),
+        )
+        return json.loads(text)
+
+    def stats(self):
+        return {
+            "breaker": self.breaker.state,
+            "breaker_opens": self.breaker.opens,
+            "consecutive_failures": self.breaker.failures,
+            "endpoints": {
+                ep: HA_API_SECONDS.snapshot(endpoint=ep) for ep in ("states", "state", "template")
+            },
+        }
@@ -0,0 +1,307 @@
+import bisect
+import json
+import logging
+import threading
+import time
+from datetime import datetime
+
+from ha_client import HAClient
+
+try:
+    import websocket  # websocket-client（選用）；沒有安裝就只用 TTL 重新整理
+except ImportError:
+    websocket = None
+
+def _updated_at(state):
+    """state 的 last_updated 轉成 timestamp；沒有或格式不對回 None。"""
+    try:
+        return datetime.fromisoformat(state["last_updated"]).timestamp()
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+# ------------------------------------------------------------
+# 🗂️ HA 實體狀態索引（整份載入一次，之後增量更新）
+# ------------------------------------------------------------
+class StateIndex:
+    """
+    把 GET /api/states 的結果存在記憶體，並依 entity_id 排序建立索引：
+      - 有 websocket-client 時訂閱 HA websocket 的 state_changed 事件即時更新
+      - 沒有（或斷線中）時，資料超過 ttl 秒就在下次查詢時重新整份抓
+      - websocket 超過 ping_interval 秒沒收到任何訊息就送 ping，再等一輪沒回應視為斷線（半開的 TCP 連線）；
+        最近 2 × ping_interval 秒內沒收到東西時不把 websocket 當即時，回到 ttl；
+        即使 websocket 看起來正常，資料也最多沿用 max_age 秒就整份重抓一次（補漏掉的事件）
+    prefix 查詢用 bisect 找範圍，不再線性掃描全部實體。
+    add_listener(fn) 可收到變更通知：fn([(entity_id, new_state 或 None), ...])。
+    """
+    _shared = {}
+    _shared_lock = threading.Lock()
+
+    @classmethod
+    def shared(cls, base_url, token, **kwargs):
+        """
+        同一程序內相同 (base_url, token) 共用一份索引與 HAClient
+        （單一程序模式下 run.py 與儀表板共用）；參數以第一個建立的為準。
+        """
+        key = (base_url.rstrip("/"), token)
+        with cls._shared_lock:
+            index = cls._shared.get(key)
+            if index is None:
+                index = cls._shared[key] = cls(base_url, token, **kwargs)
+            return index
+
+    def __init__(self, base_url, token, ttl=30.0, timeout=5, use_websocket=True, name="ha-states", client=None,
+                 ping_interval=30.0, max_age=600.0):
+        self.base_url = base_url.rstrip("/")
+        self.token = token
+        self.ttl = float(ttl)
+        self.ping_interval = float(ping_interval)
+        self.max_age = max(self.ttl, float(max_age))
+        self.timeout = timeout
+        self.use_websocket = use_websocket and websocket is not None
+        self.name = name
+        # REST 呼叫一律走共用 client（連線池、重試、斷路器、延遲統計）
+        self.client = client or HAClient.shared(base_url, token, timeout=timeout)
+
+        self._lock = threading.RLock()
+        self._refresh_lock = threading.Lock()
+        self._states = {}     # entity_id -> state dict
+        self._ids = []        # 排序過的 entity_id，給 prefix 查詢用
+        self._loaded_at = 0.0
+        self._ws_live = False
+        self._ws_activity = 0.0  # websocket 最後一次收到訊息的時間
+        self._stopped = False
+        self._ws = None
+        self._ws_thread = None
+        self._listeners = []
+
+        self.full_loads = 0
+        self.events = 0
+        self.stale_events = 0
+
+    # ---------------- 載入 / 更新 ----------------
+    def refresh(self):
+        """整份重新抓 /states 並重建索引；失敗時丟出 requests 的例外（斷路器開啟時是 CircuitOpenError）。"""
+        states = self.client.get_states()
+        by_id = {}
+        for s in states:
+            eid = s.get("entity_id")
+            if eid:
+                by_id[eid] = s
+        with self._lock:
+            old = self._states
+            self._states = by_id
+            self._ids = sorted(by_id)
+            self._loaded_at = time.monotonic()
+            self.full_loads += 1
+        logging.info(f"[{self.name}] 已載入 {len(by_id)} 筆 HA states")
+
+        # 有人訂閱時才比對新舊差異（第一次載入不算變更）
+        if self._listeners and old:
+            changes = [
+                (eid, s) for eid, s in by_id.items()
+                if (o := old.get(eid)) is None
+                or o.get("state") != s.get("state")
+                or o.get("last_updated") != s.get("last_updated")
+            ]
+            changes.extend((eid, None) for eid in old if eid not in by_id)
+            if changes:
+                self._notify(changes)
+
+    def _is_fresh(self):
+        with self._lock:
+            if not self._loaded_at:
+                return False
+            now = time.monotonic()
+            age = now - self._loaded_at
+            if age < self.ttl:
+                return True
+            return (
+                self._ws_live
+                and now - self._ws_activity < 2 * self.ping_interval
+                and age < self.max_age
+            )
+
+    def _ensure_fresh(self):
+        if self._is_fresh():
+            return
+        # 同一時間只讓一條 thread 去抓，其他人等它抓完直接用結果
+        with self._refresh_lock:
+            if not self._is_fresh():
+                self.refresh()
+
+    def apply_state(self, entity_id, new_state):
+        """
+        套用單筆 state_changed；new_state 為 None 代表實體被移除。
+        last_updated 比索引裡的還舊的事件直接丟掉（整份載入期間送來、已經包含在 snapshot 裡的事件），
+        不然會把實體倒回舊的狀態；有丟掉時回傳 False。
+        """
+        with self._lock:
+            old = self._states.get(entity_id)
+            exists = old is not None
+            if new_state is not None and exists:
+                t_new, t_old = _updated_at(new_state), _updated_at(old)
+                if t_new is not None and t_old is not None and t_new < t_old:
+                    self.stale_events += 1
+                    return False
+            if new_state is None:
+                if exists:
+                    del self._states[entity_id]
+                    i = bisect.bisect_left(self._ids, entity_id)
+                    if i < len(self._ids) and self._ids[i] == entity_id:
+                        del self._ids[i]
+            else:
+                self._states[entity_id] = new_state
+                if not exists:
+                    bisect.insort(self._ids, entity_id)
+            self.events += 1
+        if self._listeners:
+            self._notify([(entity_id, new_state)])
+        return True
+
+    def add_listener(self, fn):
+        self._listeners.append(fn)
+
+    def remove_listener(self, fn):
+        try:
+            self._listeners.remove(fn)
+        except ValueError:
+            pass
+
+    def _notify(self, changes):
+        for fn in list(self._listeners):
+            try:
+                fn(changes)
+            except Exception as e:
+                logging.error(f"[{self.name}] 變更通知失敗：{e}")
+
+    # ---------------- 查詢 ----------------
+    def all_states(self):
+        self._ensure_fresh()
+        with self._lock:
+            return [self._states[eid] for eid in self._ids]
+
+    def with_prefix(self, prefix):
+        """回傳 entity_id 以 prefix 開頭的所有 state（依 entity_id 排序）。"""
+        if not prefix:
+            return self.all_states()
+        self._ensure_fresh()
+        with self._lock:
+            lo = bisect.bisect_left(self._ids, prefix)
+            # prefix 後面接一個最大的字元，就是範圍的上界
+            hi = bisect.bisect_left(self._ids, prefix + "\U0010ffff", lo)
+            return [self._states[eid] for eid in self._ids[lo:hi]]
+
+    def get(self, entity_id):
+        self._ensure_fresh()
+        with self._lock:
+            return self._states.get(entity_id)
+
+    def is_live(self):
+        """websocket 訂閱中（資料即時）時回 True。"""
+        with self._lock:
+            return self._ws_live
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entities": len(self._ids),
+                "websocket": self._ws_live,
+                "age_sec": round(time.monotonic() - self._loaded_at, 1) if self._loaded_at else None,
+                "full_loads": self.full_loads,
+                "events": self.events,
+                "stale_events": self.stale_events,
+            }
+
+    # ---------------- websocket 訂閱 ----------------
+    def start(self):
+        """啟動背景 websocket 訂閱（沒有 websocket-client 就什麼都不做，靠 TTL）。"""
+        if not self.use_websocket:
+            logging.info(f"[{self.name}] 未安裝 websocket-client，改用 TTL={self.ttl}s 重新整理")
+            return
+        if self._ws_thread and self._ws_thread.is_alive():
+            return
+        self._ws_thread = threading.Thread(target=self._ws_loop, name=self.name, daemon=True)
+        self._ws_thread.start()
+
+    def stop(self):
+        self._stopped = True
+        ws = self._ws
+        if ws is not None:
+            try:
+                ws.close()
+            except Exception:
+                pass
+
+    def _ws_url(self):
+        # http://supervisor/core/api → ws://supervisor/core/websocket
+        url = self.base_url
+        if url.endswith("/api"):
+            url = url[: -len("/api")]
+        url = url.replace("https://", "wss://", 1).replace("http://", "ws://", 1)
+        return f"{url}/websocket"
+
+    def _ws_loop(self):
+        backoff = 1.0
+        while not self._stopped:
+            try:
+                self._ws_session()
+                backoff = 1.0
+            except Exception as e:
+                if self._stopped:
+                    break
+                logging.warning(f"[{self.name}] websocket 中斷：{e}，{backoff:.0f} 秒後重連")
+            finally:
+                with self._lock:
+                    self._ws_live = False
+                self._ws = None
+            if self._stopped:
+                break
+            time.sleep(backoff)
+            backoff = min(backoff * 2, 60.0)
+
+    def _ws_session(self):
+        ws = websocket.create_connection(self._ws_url(), timeout=self.timeout)
+        self._ws = ws
+        msg = json.loads(ws.recv())
+        if msg.get("type") == "auth_required":
+            ws.send(json.dumps({"type": "auth", "access_token": self.token}))
+            msg = json.loads(ws.recv())
+        if msg.get("type") != "auth_ok":
+            raise RuntimeError(f"websocket 認證失敗：{msg}")
+
+        ws.send(json.dumps({"id": 1, "type": "subscribe_events", "event_type": "state_changed"}))
+        # 先訂閱再整份載入：載入期間的事件會排在 snapshot 之後才處理，
+        # 已經包含在 snapshot 裡的舊事件由 apply_state 依 last_updated 丟掉
+        ws.settimeout(self.ping_interval)
+        self.refresh()
+        with self._lock:
+            self._ws_live = True
+            self._ws_activity = time.monotonic()
+        logging.info(f"[{self.name}] 已訂閱 state_changed")
+
+        msg_id = 1
+        waiting_pong = False
+        while not self._stopped:
+            try:
+                raw = ws.recv()
+            except websocket.WebSocketTimeoutException:
+                # 一段時間沒有任何訊息：送 ping；上一個 ping 也沒回就當作連線已經斷了
+                if waiting_pong:
+                    raise RuntimeError(f"{self.ping_interval:.0f} 秒內沒有回應 ping")
+                msg_id += 1
+                ws.send(json.dumps({"id": msg_id, "type": "ping"}))
+                waiting_pong = True
+                continue
+            if not raw:
+                raise RuntimeError("連線已關閉")
+            waiting_pong = False
+            with self._lock:
+                self._ws_activity = time.monotonic()
+            msg = json.loads(raw)
+            if msg.get("type") != "event":
+                continue
+            data = (msg.get("event") or {}).get("data") or {}
+            eid = data.get("entity_id")
+            if eid:
+                self.apply_state(eid, data.get("new_state"))
@@ -0,0 +1,438 @@
+import array
+import http.server
+import json
+import logging
+import math
+import socketserver
+import threading
+import time
+import urllib.error
+import urllib.request
+from collections import OrderedDict
+from urllib.parse import urlsplit, parse_qs
+
+# ------------------------------------------------------------
+# 📊 裝置感測值歷史（固定記憶體的環狀緩衝區）
+# ------------------------------------------------------------
+# 每個 (裝置, 欄位) 是一條 series，佔用固定大小的格子：
+#   - raw：最近 raw_points 筆原始值（float32）＋與前一筆的秒差（uint16，時間戳記只存最新一筆）
+#   - 1h / 24h / 7d：依固定時間區間平均後的值（float32），格子位置由時間決定，不另存時間戳記
+# 所有 series 的同一種資料放在同一個 array 裡（slot × 格子數），不是每條 series 各一堆 Python 物件，
+# 所以記憶體 ≈ series 數 × bytes_per_series()，最多 max_series 條；滿了就回收最久沒更新的那條。
+# INGEST 會略過內容沒變的訊息，所以同樣的讀值連續送來時只記一次（圖表上看起來是同一條線）。
+
+# (名稱, 每格秒數, 格數)
+TIERS = (("1h", 60, 60), ("24h", 300, 288), ("7d", 3600, 168))
+DT_MAX = 0xFFFF  # raw 的秒差用 uint16；間隔更久的話前面的 raw 直接清掉（反正已在 1h/24h/7d 裡）
+NAN = float("nan")
+
+
+def _number(value):
+    """感測值轉 float；bool、非數字、NaN/inf 回 None（FW、MODEL 這類欄位自然被略過）。"""
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, (int, float)):
+        v = float(value)
+    elif isinstance(value, str):
+        try:
+            v = float(value)
+        except ValueError:
+            return None
+    else:
+        return None
+    return v if math.isfinite(v) else None
+
+
+def _f32(v):
+    # float32 轉回 Python float 會多出一串尾數（23.1 → 23.100000381…），輸出時取 7 位有效數字
+    return float(f"{v:.7g}")
+
+
+class HistoryStore:
+    """
+    record(device, fields, ts)：把一則 data 的數值欄位寫進各自的 series
+    query(device, metrics, start, end, tier)：取出時間範圍內的點；tier="auto" 時 raw 涵蓋得到就用 raw，
+      否則用涵蓋得到 start 的最細一層
+    """
+    _shared = None
+    _shared_lock = threading.Lock()
+
+    @classmethod
+    def shared(cls, **kw):
+        """同一程序共用一份（單一程序模式下 run.py 與儀表板看到同樣的資料）；參數只在第一次建立時有效。"""
+        with cls._shared_lock:
+            if cls._shared is None:
+                cls._shared = cls(**kw)
+            return cls._shared
+
+    def __init__(self, raw_points=120, max_series=10000, tiers=TIERS):
+        self.raw_points = min(max(2, int(raw_points)), DT_MAX)
+        self.max_series = max(0, int(max_series))
+        self.tiers = tuple(tiers)
+        self._lock = threading.Lock()
+        self._index = OrderedDict()  # (device, metric) → slot，依最後寫入排序（最前面是最久沒更新的）
+        self._keys = []     # slot → (device, metric)
+        self._devices = {}  # device → {metric: slot}
+
+        self._raw_v = array.array("f")
+        self._raw_dt = array.array("H")
+        self._raw_head = array.array("H")  # 最新一筆在 raw 格子裡的位置
+        self._raw_len = array.array("H")
+        self._t_last = array.array("I")    # 最新一筆的時間（epoch 秒）
+        self._tier_v = [array.array("f") for _ in self.tiers]
+        self._tier_head = [array.array("I") for _ in self.tiers]  # 最新一格的編號（ts // step），0 = 還沒有資料
+        self._tier_sum = [array.array("d") for _ in self.tiers]   # 最新一格的累計，用來算平均
+        self._tier_n = [array.array("H") for _ in self.tiers]
+
+        # 新 series / 回收時整段覆蓋用的空白格子
+        self._raw_blank = array.array("f", [NAN]) * self.raw_points
+        self._raw_dt_blank = array.array("H", [0]) * self.raw_points
+        self._tier_blank = [array.array("f", [NAN]) * slots for _, _, slots in self.tiers]
+
+        self.samples = 0
+        self.out_of_order = 0
+        self.evicted = 0
+
+    # ---------------- 寫入 ----------------
+    def record(self, device, fields, ts=None):
+        if not self.max_series:
+            return 0
+        ts = int(time.time() if ts is None else ts)
+        device = str(device).lower()
+        written = 0
+        with self._lock:
+            for metric, value in fields.items():
+                v = _number(value)
+                if v is None:
+                    continue
+                slot = self._index.get((device, metric))
+                if slot is None:
+                    slot = self._new_slot(device, metric)
+                else:
+                    self._index.move_to_end((device, metric))
+                if self._append(slot, ts, v):
+                    written += 1
+            self.samples += written
+        return written
+
+    def _new_slot(self, device, metric):
+        if len(self._keys) < self.max_series:
+            slot = len(self._keys)
+            self._keys.append((device, metric))
+            self._raw_v.extend(self._raw_blank)
+            self._raw_dt.extend(self._raw_dt_blank)
+            for meta in (self._raw_head, self._raw_len, self._t_last):
+                meta.append(0)
+            for k in range(len(self.tiers)):
+                self._tier_v[k].extend(self._tier_blank[k])
+                self._tier_head[k].append(0)
+                self._tier_sum[k].append(0.0)
+                self._tier_n[k].append(0)
+        else:
+            # 滿了：回收最久沒寫入的 series（_index 的第一個，O(1)）
+            (old_device, old_metric), slot = self._index.popitem(last=False)
+            metrics = self._devices[old_device]
+            del metrics[old_metric]
+            if not metrics:
+                del self._devices[old_device]
+            self._keys[slot] = (device, metric)
+            self._reset(slot)
+            self.evicted += 1
+        self._index[(device, metric)] = slot
+        self._devices.setdefault(device, {})[metric] = slot
+        return slot
+
+    def _reset(self, slot):
+        cap = self.raw_points
+        self._raw_v[slot * cap:(slot + 1) * cap] = self._raw_blank
+        self._raw_dt[slot * cap:(slot + 1) * cap] = self._raw_dt_blank
+        self._raw_head[slot] = self._raw_len[slot] = self._t_last[slot] = 0
+        for k, (_, _, slots) in enumerate(self.tiers):
+            self._tier_v[k][slot * slots:(slot + 1) * slots] = self._tier_blank[k]
+            self._tier_head[k][slot] = 0
+            self._tier_sum[k][slot] = 0.0
+            self._tier_n[k][slot] = 0
+
+    def _append(self, slot, ts, v):
+        cap = self.raw_points
+        base = slot * cap
+        n = self._raw_len[slot]
+        last = self._t_last[slot]
+        if n and ts < last:
+            self.out_of_order += 1
+            return False
+        if n and ts == last:
+            self._raw_v[base + self._raw_head[slot]] = v  # 同一秒內多筆：raw 只留最新的
+        else:
+            if n and ts - last > DT_MAX:
+                n = 0  # 間隔太久，秒差存不下：前面的 raw 不要了
+            head = (self._raw_head[slot] + 1) % cap if n else 0
+            self._raw_head[slot] = head
+            self._raw_v[base + head] = v
+            self._raw_dt[base + head] = ts - last if n else 0
+            self._raw_len[slot] = min(n + 1, cap)
+            self._t_last[slot] = ts
+
+        for k, (_, step, slots) in enumerate(self.tiers):
+            b = ts // step
+            head = self._tier_head[k][slot]
+            vals = self._tier_v[k]
+            base = slot * slots
+            if b > head:
+                # 進入新的一格：中間沒收到資料的格子標成 NaN（最多清一整圈）
+                if head:
+                    for missing in range(max(head + 1, b - slots + 1), b):
+                        vals[base + missing % slots] = NAN
+                self._tier_head[k][slot] = b
+                self._tier_sum[k][slot] = v
+                self._tier_n[k][slot] = 1
+            elif b == head:
+                self._tier_sum[k][slot] += v
+                self._tier_n[k][slot] = min(self._tier_n[k][slot] + 1, 0xFFFF)
+            else:
+                continue
+            vals[base + b % slots] = self._tier_sum[k][slot] / self._tier_n[k][slot]
+        return True
+
+    # ---------------- 查詢 ----------------
+    def devices(self):
+        with self._lock:
+            return {device: sorted(metrics) for device, metrics in self._devices.items()}
+
+    def _read_raw(self, slot, start, end):
+        cap = self.raw_points
+        base = slot * cap
+        head = self._raw_head[slot]
+        t = self._t_last[slot]
+        ts, vs = [], []
+        for i in range(self._raw_len[slot]):
+            idx = (head - i) % cap
+            if t < start:
+                break
+            if t <= end:
+                ts.append(t)
+                vs.append(_f32(self._raw_v[base + idx]))
+            t -= self._raw_dt[base + idx]
+        ts.reverse()
+        vs.reverse()
+        return ts, vs
+
+    def _raw_oldest(self, slot):
+        cap = self.raw_points
+        base = slot * cap
+        head = self._raw_head[slot]
+        t = self._t_last[slot]
+        for i in range(self._raw_len[slot] - 1):
+            t -= self._raw_dt[base + (head - i) % cap]
+        return t
+
+    def _read_tier(self, k, slot, start, end):
+        _, step, slots = self.tiers[k]
+        head = self._tier_head[k][slot]
+        ts, vs = [], []
+        if not head:
+            return ts, vs
+        vals = self._tier_v[k]
+        base = slot * slots
+        for b in range(max(head - slots + 1, start // step), min(head, end // step) + 1):
+            v = vals[base + b % slots]
+            if not math.isnan(v):
+                ts.append(b * step)
+                vs.append(_f32(v))
+        return ts, vs
+
+    def _pick_tier(self, slots, start, now):
+        """raw 涵蓋得到 start 就用 raw，否則選第一個時間跨度涵蓋得到 start 的 tier（都不夠就用最後一層）。"""
+        if slots and all(self._raw_len[s] and self._raw_oldest(s) <= start for s in slots):
+            return None
+        for k, (_, step, n) in enumerate(self.tiers):
+            if now - start <= step * n:
+                return k
+        return len(self.tiers) - 1
+
+    def query(self, device, metrics=None, start=None, end=None, tier="auto"):
+        """
+        回傳 {"device", "tier", "step", "start", "end", "series": {metric: {"t": [...], "v": [...]}}}；
+        沒有這台裝置回 None。tier 可指定 raw / 1h / 24h / 7d，不認得的丟 ValueError。
+        """
+        now = int(time.time())
+        end = now if end is None else int(end)
+        start = end - 3600 if start is None else int(start)
+        device = str(device).lower()
+        names = [t[0] for t in self.tiers]
+        if tier not in ("auto", "raw", *names):
+            raise ValueError(f"tier 只能是 auto、raw 或 {'/'.join(names)}")
+        with self._lock:
+            known = self._devices.get(device)
+            if known is None:
+                return None
+            wanted = [m for m in (metrics or sorted(known)) if m in known]
+            slots = [known[m] for m in wanted]
+            if tier == "auto":
+                k = self._pick_tier(slots, start, now)
+            else:
+                k = None if tier == "raw" else names.index(tier)
+            series = {}
+            for m, slot in zip(wanted, slots):
+                if k is None:
+                    t, v = self._read_raw(slot, start, end)
+                else:
+                    t, v = self._read_tier(k, slot, start, end)
+                series[m] = {"t": t, "v": v}
+        return {
+            "device": device,
+            "tier": "raw" if k is None else names[k],
+            "step": None if k is None else self.tiers[k][1],
+            "start": start,
+            "end": end,
+            "series": series,
+        }
+
+    # ---------------- 統計 ----------------
+    def bytes_per_series(self):
+        raw = self.raw_points * (4 + 2) + 2 + 2 + 4
+        tiers = sum(slots * 4 + 4 + 8 + 2 for _, _, slots in self.tiers)
+        return raw + tiers
+
+    def stats(self):
+        with self._lock:
+            series = len(self._keys)
+            devices = len(self._devices)
+        per = self.bytes_per_series()
+        return {
+            "series": series,
+            "devices": devices,
+            "max_series": self.max_series,
+            "bytes": series * per,
+            "capacity_bytes": self.max_series * per,
+            "samples": self.samples,
+            "out_of_order": self.out_of_order,
+            "evicted": self.evicted,
+        }
+
+
+# ------------------------------------------------------------
+# 🌐 /history 查詢 API
+# ------------------------------------------------------------
+class HistoryHandler(http.server.BaseHTTPRequestHandler):
+    """
+    GET /history                                   → 有歷史資料的裝置與欄位
+    GET /history?device=<mac>&metric=p25,co2&start=<epoch>&end=<epoch>&tier=auto|raw|1h|24h|7d
+      metric 可重複或逗號分隔，不給就全部；start 預設 end 前 1 小時、end 預設現在
+    分片時只有第 0 片對外（history_port），其他片只聽 127.0.0.1:history_port + 分片編號：
+      - 裝置不在這一片就代為向負責的那一片查詢（server.locate(device) 回傳它的 port）
+      - 裝置清單與統計會合併 server.peers 裡每一片的結果（查不到的列在 unavailable）
+    """
+    server_version = "ZP2History/1.0"
+
+    def log_message(self, format, *args):
+        pass  # 儀表板會定期輪詢，不逐筆記錄
+
+    def _send_json(self, code, obj, headers=None):
+        body = json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("Cache-Control", "no-cache")
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        if url.path.rstrip("/") != "/history":
+            return self._send_json(404, {"error": "not found"})
+        params = parse_qs(url.query)
+        store = self.server.store
+        device = (params.get("device") or [""])[0].strip().lower()
+        if not device:
+            return self._send_listing(store)
+
+        locate = getattr(self.server, "locate", None)
+        port = locate(device) if locate else None
+        if port is not None:
+            return self._proxy(port)
+
+        metrics = [m.strip() for v in params.get("metric", []) for m in v.split(",") if m.strip()]
+        try:
+            start = params.get("start", [None])[0]
+            end = params.get("end", [None])[0]
+            result = store.query(
+                device, metrics or None,
+                None if start is None else int(float(start)),
+                None if end is None else int(float(end)),
+                params.get("tier", ["auto"])[0],
+            )
+        except ValueError as e:
+            return self._send_json(400, {"error": str(e)})
+        if result is None:
+            return self._send_json(404, {"error": f"沒有 {device} 的歷史資料"})
+        return self._send_json(200, result)
+
+
+    def _send_listing(self, store):
+        devices, stats = store.devices(), store.stats()
+        unavailable = []
+        for port in getattr(self.server, "peers", ()):
+            try:
+                code, body = _fetch(port, "/history")
+                peer = json.loads(body)
+                if code != 200:
+                    raise ValueError(f"HTTP {code}")
+            except (OSError, ValueError) as e:
+                logging.warning(f"[history] 無法取得 port {port} 的裝置清單：{e}")
+                unavailable.append(port)
+                continue
+            devices.update(peer.get("devices") or {})
+            for k, v in (peer.get("stats") or {}).items():
+                if isinstance(v, (int, float)):
+                    stats[k] = stats.get(k, 0) + v
+        out = {"devices": devices, "stats": stats}
+        if unavailable:
+            out["unavailable"] = unavailable
+        return self._send_json(200, out)
+
+    def _proxy(self, port):
+        try:
+            code, body = _fetch(port, self.path)
+        except OSError as e:
+            return self._send_json(502, {"error": f"負責這台裝置的分片（port {port}）沒有回應：{e}"})
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def _fetch(port, path, timeout=5):
+    """向同一台機器上的另一片 /history 查詢；回傳 (狀態碼, body)，連不上丟 OSError。"""
+    try:
+        with urllib.request.urlopen(f"http://127.0.0.1:{port}{path}", timeout=timeout) as r:
+            return r.status, r.read()
+    except urllib.error.HTTPError as e:
+        return e.code, e.read()
+
+
+class _HistoryHTTPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+def start_history_server(store, host, port, locate=None, peers=()):
+    """
+    在背景 thread 啟動 /history；回傳 server（shutdown() 停止）。port 被占用時記錄錯誤並回傳 None。
+    locate / peers 只給對外的那一片：locate(device) 回傳負責分片的 port，peers 是其他分片的 port。
+    """
+    try:
+        httpd = _HistoryHTTPServer((host, port), HistoryHandler)
+    except OSError as e:
+        logging.error(f"[history] 無法在 {host}:{port} 啟動 /history：{e}")
+        return None
+    httpd.store = store
+    httpd.locate = locate
+    httpd.peers = tuple(peers)
+    threading.Thread(target=httpd.serve_forever, name="history-http", daemon=True).start()
+    logging.info(f"[history] /history 監聽 {host}:{port}（最多 {store.max_series} 條 series）")
+    return httpd
@@ -0,0 +1,221 @@
+import json
+import logging
+import threading
+import time
+import zlib
+from collections import deque
+
+from metrics import Histogram
+
+try:
+    import orjson  # 選用：有安裝就用比較快的 JSON 解析
+except ImportError:
+    orjson = None
+
+
+if orjson is not None:
+    JSON_DECODER = "orjson"
+    json_loads = orjson.loads
+    JSON_ERRORS = (orjson.JSONDecodeError, UnicodeDecodeError)
+else:
+    JSON_DECODER = "json"
+    json_loads = json.loads
+    JSON_ERRORS = (json.JSONDecodeError, UnicodeDecodeError)
+
+
+# ------------------------------------------------------------
+# 📥 MQTT 收訊管線：on_message 只負責放進環狀佇列，解析 / 分派交給 worker
+# ------------------------------------------------------------
+class _Shard:
+    __slots__ = ("ring", "cond", "thread")
+
+    def __init__(self, capacity):
+        self.ring = deque(maxlen=capacity)
+        self.cond = threading.Condition(threading.Lock())
+        self.thread = None
+
+
+class IngestPipeline:
+    """
+    offer(topic, payload) 在 paho 的 network loop thread 上被呼叫，只做一次 append，不解析、不阻塞。
+    依 topic 分到固定的 shard（同一台裝置的訊息永遠由同一個 worker 依序處理），
+    每個 worker 一次取出最多 batch_size 筆，解析 JSON 後呼叫 handler(topic, message_json)。
+
+    環狀佇列滿了就丟掉最舊的一筆（overflow 計數），讓最新的狀態優先。
+    三段延遲分開統計：queue（排隊）、parse（JSON 解析）、dispatch（handler）。
+    有給 dedup（dedup.PayloadDedup）時，內容跟同 topic 上一筆一樣的訊息不再解析、不呼叫 handler；
+    有給 on_duplicate 就改呼叫 on_duplicate(topic, 上一筆解析好的 dict)，讓便宜但不能省的工作照做。
+    """
+    def __init__(self, handler, workers=2, capacity=10000, batch_size=100, name="ingest", dedup=None,
+                 on_duplicate=None):
+        self.handler = handler
+        self.dedup = dedup
+        self.on_duplicate = on_duplicate
+        self.name = name
+        self.batch_size = max(1, int(batch_size))
+        workers = max(1, int(workers))
+        per_shard = max(1, int(capacity) // workers)
+        self.capacity = per_shard * workers
+        self._shards = [_Shard(per_shard) for _ in range(workers)]
+        self._stopped = False
+
+        self._stat_lock = threading.Lock()
+        self.received = 0
+        self.processed = 0
+        self.overflow = 0
+        self.parse_errors = 0
+        self.handler_errors = 0
+        self.duplicates = 0
+        self.batches = 0
+        self.max_depth = 0
+
+        self.queue_latency = Histogram(f"{name}_queue_seconds", "offer 到 worker 取出的等待時間")
+        self.parse_latency = Histogram(f"{name}_parse_seconds", "JSON 解析時間")
+        self.dispatch_latency = Histogram(f"{name}_dispatch_seconds", "handler 處理時間")
+
+    def _shard_for(self, topic):
+        if len(self._shards) == 1:
+            return self._shards[0]
+        return self._shards[zlib.crc32(topic.encode()) % len(self._shards)]
+
+    # ---------------- 生產端（paho loop thread） ----------------
+    def offer(self, topic, payload):
+        """放進佇列；回傳 False 代表擠掉了一筆舊訊息。"""
+        shard = self._shard_for(topic)
+        with shard.cond:
+            full = len(shard.ring) == shard.ring.maxlen
+            shard.ring.append((topic, payload, time.monotonic()))
+            depth = len(shard.ring)
+            shard.cond.notify()
+        with self._stat_lock:
+            self.received += 1
+            if full:
+                self.overflow += 1
+            if depth > self.max_depth:
+                self.max_depth = depth
+        return not full
+
+    # ---------------- 消費端（worker threads） ----------------
+    def start(self):
+        for i, shard in enumerate(self._shards):
+            if shard.thread and shard.thread.is_alive():
+                continue
+            shard.thread = threading.Thread(
+                target=self._worker, args=(shard,), name=f"{self.name}-{i}", daemon=True
+            )
+            shard.thread.start()
+        logging.info(
+            f"[{self.name}] 啟動 {len(self._shards)} 個 worker，佇列 {self.capacity} 筆，"
+            f"batch={self.batch_size}，JSON={JSON_DECODER}"
+        )
+
+    def stop(self, drain=True, timeout=5.0):
+        """停止 worker；drain=True 時先把佇列內剩下的處理完。"""
+        self._stopped = True
+        for shard in self._shards:
+            with shard.cond:
+                if not drain:
+                    shard.ring.clear()
+                shard.cond.notify_all()
+        deadline = time.monotonic() + timeout
+        for shard in self._shards:
+            if shard.thread:
+                shard.thread.join(max(0.0, deadline - time.monotonic()))
+
+    def _worker(self, shard):
+        ring = shard.ring
+        while True:
+            with shard.cond:
+                while not ring and not self._stopped:
+                    shard.cond.wait()
+                if not ring:
+                    return
+                n = min(len(ring), self.batch_size)
+                batch = [ring.popleft() for _ in range(n)]
+            self._process(batch)
+
+    def _process(self, batch):
+        ok = parse_err = handler_err = dup = 0
+        dedup = self.dedup
+        for topic, payload, enqueued_at in batch:
+            t0 = time.monotonic()
+            self.queue_latency.observe(t0 - enqueued_at)
+            if dedup is not None and dedup.is_duplicate(topic, payload):
+                dup += 1
+                cached = dedup.value(topic) if self.on_duplicate is not None else None
+                if cached is None:
+                    continue  # 沒有輕量處理，或上一筆根本解析失敗
+                try:
+                    self.on_duplicate(topic, cached)
+                except Exception as e:
+                    handler_err += 1
+                    logging.error(f"Error processing duplicate message: {e}")
+                self.dispatch_latency.observe(time.monotonic() - t0)
+                continue
+            try:
+                message_json = json_loads(payload)
+            except JSON_ERRORS:
+                parse_err += 1
+                logging.error(f"Failed to decode payload: {payload[:200]!r}")
+                continue
+            t1 = time.monotonic()
+            self.parse_latency.observe(t1 - t0)
+            if dedup is not None and self.on_duplicate is not None:
+                dedup.attach(topic, message_json)
+            try:
+                self.handler(topic, message_json)
+                ok += 1
+            except Exception as e:
+                handler_err += 1
+                logging.error(f"Error processing message: {e}")
+            self.dispatch_latency.observe(time.monotonic() - t1)
+        with self._stat_lock:
+            self.processed += ok
+            self.parse_errors += parse_err
+            self.handler_errors += handler_err
+            self.duplicates += dup
+            self.batches += 1
+
+    # ---------------- 統計 ----------------
+    def register_metrics(self, registry):
+        """把計數與直方圖掛到 metrics.Registry（數值在輸出時才讀）。"""
+        n = self.name
+        registry.add(self.queue_latency, self.parse_latency, self.dispatch_latency)
+        registry.counter(f"{n}_messages_received_total", "收到的 MQTT 訊息數", fn=lambda: self.received)
+        registry.counter(f"{n}_messages_parsed_total", "成功解析並處理的訊息數", fn=lambda: self.processed)
+        registry.counter(
+            f"{n}_messages_dropped_total", "未處理就丟掉的訊息數", ("reason",),
+            fn=lambda: {
+                ("overflow",): self.overflow,
+                ("parse_error",): self.parse_errors,
+            },
+        )
+        registry.counter(
+            f"{n}_messages_duplicate_total", "內容跟上一筆相同、略過完整處理的訊息數", fn=lambda: self.duplicates,
+        )
+        registry.counter(f"{n}_handler_errors_total", "handler 丟出例外的次數", fn=lambda: self.handler_errors)
+        registry.gauge(f"{n}_queue_depth", "佇列中等待處理的訊息數", fn=self.depth)
+
+    def depth(self):
+        return sum(len(s.ring) for s in self._shards)
+
+    def stats(self):
+        with self._stat_lock:
+            out = {
+                "workers": len(self._shards),
+                "depth": self.depth(),
+                "capacity": self.capacity,
+                "max_depth": self.max_depth,
+                "received": self.received,
+                "processed": self.processed,
+                "overflow": self.overflow,
+                "parse_errors": self.parse_errors,
+                "handler_errors": self.handler_errors,
+                "duplicates": self.duplicates,
+                "batches": self.batches,
+                "decoder": JSON_DECODER,
+            }
+        out["queue"] = self.queue_latency.snapshot()
+        out["parse"] = self.parse_latency.snapshot()
+        out["dispatch"] = self.dispatch_latency.snapshot()
+        return out
@@ -1,5 +1,5 @@
 # launcher.py
-import subprocess, signal, sys, os, time
+import subprocess, signal, sys, os, time, json
 
 PROCS = []
 
@@ -33,26 +33,52 @@ def handler(sig, frame):
     stop_all()
     sys.exit(0)
 
+def read_options():
+    try:
+        with open("/data/options.json", "r") as f:
+            return json.load(f)
+    except Exception:
+        return {}
+
+def runtime_mode():
+    return read_options().get("runtime_mode", "multi")
+
+def ingest_shards():
+    try:
+        return max(1, int(read_options().get("ingest_shards", 1)))
+    except (TypeError, ValueError):
+        return 1
+
 if __name__ == "__main__":
+    # 單一程序模式：直接換成 runtime.py（SIGTERM 由它自己處理），省掉第二個 Python 程序
+    if runtime_mode() == "single":
+        print("[launcher] runtime_mode=single → /runtime.py", flush=True)
+        sys.stdout.flush()
+        os.execv(sys.executable, [sys.executable, "/runtime.py"])
+
     # 訊號處理（HA/Supervisor 會送 SIGTERM）
     signal.signal(signal.SIGTERM, handler)
     signal.signal(signal.SIGINT, handler)
 
-    # 同時啟動兩支
-    p1 = start(["python3", "/run.py"])          # MQTT 發佈/Discovery
-    p2 = start(["python3", "/local_ota_server.py"])    # Flask HTTP API/Status
+    # 同時啟動：run.py（ingest_shards > 1 時每個分片一支）+ OTA server
+    shards = ingest_shards()
+    names = {}
+    for i in range(shards):
+        env = dict(os.environ, ZP2_SHARD_INDEX=str(i), ZP2_SHARD_COUNT=str(shards))
+        print(f"[launcher] starting: /run.py shard {i}/{shards}", flush=True)
+        p = subprocess.Popen(["python3", "/run.py"], stdout=sys.stdout, stderr=sys.stderr, env=env)  # MQTT 發佈/Discovery
+        PROCS.append(p)
+        names[p] = "/run.py" if shards == 1 else f"/run.py (shard {i})"
+    names[start(["python3", "/local_ota_server.py"])] = "/local_ota_server.py"    # OTA HTTP server
 
-    # 任何一支先退出，就把另一支也關掉並跟著退出
+    # 任何一支先退出，就把其他的也關掉並跟著退出
     exit_code = 0
     try:
         while True:
-            if p1.poll() is not None:
-                exit_code = p1.returncode
-                print(f"[launcher] /run.py exited with {exit_code}", flush=True)
-                break
-            if p2.poll() is not None:
-                exit_code = p2.returncode
-                print(f"[launcher] /3drp_show.py exited with {exit_code}", flush=True)
+            done = next((p for p in PROCS if p.poll() is not None), None)
+            if done is not None:
+                exit_code = done.returncode
+                print(f"[launcher] {names[done]} exited with {exit_code}", flush=True)
                 break
             time.sleep(0.5)
     finally:
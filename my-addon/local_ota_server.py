@@ -3,36 +3,559 @@ import http.server
 import socketserver
 import threading
 import functools
+import io
+import json
+import hashlib
+import mmap
 import os
+import email.utils
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from ota_index import OtaIndexWatcher, file_digest
+from ota_artifacts import ArtifactStore, DELTA_FORMAT
+from metrics import REGISTRY, CONTENT_TYPE as METRICS_CONTENT_TYPE
+
+OTA_BYTES = REGISTRY.counter("bytes_served_total", "已送出的韌體 bytes", namespace="ota")
+OTA_ACTIVE = REGISTRY.gauge("active_downloads", "正在傳送中的下載數", namespace="ota")
+OTA_DOWNLOAD_SECONDS = REGISTRY.histogram("download_seconds", "單次下載（含 range）傳送時間", namespace="ota")
+OTA_RESPONSES = REGISTRY.counter("http_responses_total", "HTTP 回應數", ("code",), namespace="ota")
+OTA_REJECTED = REGISTRY.counter("connections_rejected_total", "超過連線上限回 503 的連線數", namespace="ota")
+OTA_VARIANTS = REGISTRY.counter("responses_by_variant_total", "依送出內容分類的韌體回應數", ("variant",), namespace="ota")
+
+
+def _etag_in(header_value, etag):
+    """If-None-Match 比對：支援 * 與逗號分隔的多個 ETag（弱比較）。"""
+    for tag in header_value.split(","):
+        tag = tag.strip()
+        if tag == "*":
+            return True
+        if tag.startswith("W/"):
+            tag = tag[2:]
+        if tag == etag:
+            return True
+    return False
+
+
+def _accepts_gzip(header_value):
+    """Accept-Encoding 裡有 gzip（且 q 不是 0）。"""
+    for item in (header_value or "").split(","):
+        name, _, params = item.strip().partition(";")
+        if name.strip().lower() not in ("gzip", "*"):
+            continue
+        q = params.strip()
+        if q.startswith("q="):
+            try:
+                return float(q[2:]) > 0
+            except ValueError:
+                return False
+        return True
+    return False
+
+
+def _parse_range(header_value, size):
+    """
+    解析單一 byte range（bytes=a-b / bytes=a- / bytes=-n）。
+    回傳 (start, end)；格式不支援（例如多段）回傳 None；無法滿足回傳 "unsatisfiable"。
+    """
+    if not header_value.startswith("bytes="):
+        return None
+    spec = header_value[len("bytes="):].strip()
+    if "," in spec:
+        return None  # 多段 range 不支援，依 RFC 直接回整個檔案
+    start_s, sep, end_s = spec.partition("-")
+    if not sep:
+        return None
+    try:
+        if start_s == "":
+            length = int(end_s)
+            if length <= 0:
+                return "unsatisfiable"
+            start, end = max(0, size - length), size - 1
+        else:
+            start = int(start_s)
+            end = int(end_s) if end_s else size - 1
+    except ValueError:
+        return None
+    if start >= size or start > end:
+        return "unsatisfiable"
+    return start, min(end, size - 1)
+
+
+# ------------------------------------------------------------
+# 💾 韌體快取：ota_index.yaml 列出的映像檔預先 mmap，常駐在 page cache
+# ------------------------------------------------------------
+class CachedFirmware:
+    __slots__ = ("path", "fd", "mm", "size", "mtime_ns", "mtime", "digest")
+
+    def __init__(self, path):
+        self.path = path
+        self.fd = os.open(path, os.O_RDONLY)
+        try:
+            st = os.fstat(self.fd)
+            self.size = st.st_size
+            self.mtime_ns = st.st_mtime_ns
+            self.mtime = st.st_mtime
+            self.mm = mmap.mmap(self.fd, 0, access=mmap.ACCESS_READ) if self.size else None
+            if self.mm is not None and hasattr(self.mm, "madvise") and hasattr(mmap, "MADV_WILLNEED"):
+                self.mm.madvise(mmap.MADV_WILLNEED)
+            self.digest = file_digest(path, st)
+        except Exception:
+            os.close(self.fd)
+            raise
+
+    def is_current(self):
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return False
+        return st.st_mtime_ns == self.mtime_ns and st.st_size == self.size
+
+    def close(self):
+        if self.fd < 0:
+            return
+        if self.mm is not None:
+            self.mm.close()
+        os.close(self.fd)
+        self.fd = -1
+
+    def __del__(self):
+        # 被新版本取代後，等最後一個還在送的連線放掉參照才關閉
+        try:
+            self.close()
+        except Exception:
+            pass
+
+
+class FirmwareCache:
+    """
+    啟動時把 ota_index.yaml 裡的韌體 mmap 起來；
+    檔案被替換（mtime / size 改變）時自動重新載入。
+    有給 artifacts 時，gzip 預壓縮版也一起 mmap（gzip_variant() 取用）。
+    """
+    def __init__(self, root_dir, artifacts=None):
+        self.root_dir = os.path.realpath(root_dir)
+        self.artifacts = artifacts
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._gzip = {}  # 原始韌體路徑 → gzip 版的 CachedFirmware
+
+    def count(self):
+        """目前快取的韌體數。"""
+        with self._lock:
+            return len(self._entries)
+
+    def preload(self, index):
+        """index 為 OtaIndex；ota_index.yaml 重載時也會再呼叫一次，已快取且沒變的檔案不會重讀。"""
+        wanted = set()
+        for fw in index.profiles.values():
+            rel = str(fw.get("path", "")).lstrip("/")
+            if not rel:
+                continue
+            path = os.path.realpath(os.path.join(self.root_dir, rel))
+            if path in wanted:
+                continue
+            wanted.add(path)
+            with self._lock:
+                entry = self._entries.get(path)
+            if entry is None or not entry.is_current():
+                try:
+                    entry = self._load(path)
+                    print(f"[OTA] 快取韌體 {fw.get('id')}：{rel}（{entry.size} bytes）", flush=True)
+                except OSError as e:
+                    print(f"[OTA] ⚠ 無法快取 {rel}：{e}", flush=True)
+                    continue
+            self._preload_gzip(path, entry)
+        # 已從 index 移除的檔案不再常駐
+        with self._lock:
+            for path in [p for p in self._entries if p not in wanted]:
+                del self._entries[path]
+            for path in [p for p in self._gzip if p not in wanted]:
+                del self._gzip[path]
+
+    def _preload_gzip(self, path, entry):
+        gz_path = self.artifacts.gzip_for(entry.digest["sha256"]) if self.artifacts else None
+        with self._lock:
+            current = self._gzip.get(path)
+        if gz_path is None:
+            if current is not None:
+                with self._lock:
+                    self._gzip.pop(path, None)
+            return
+        if current is not None and current.path == gz_path and current.is_current():
+            return
+        try:
+            gz = CachedFirmware(gz_path)
+        except OSError as e:
+            print(f"[OTA] ⚠ 無法快取 {gz_path}：{e}", flush=True)
+            return
+        with self._lock:
+            self._gzip[path] = gz
+        print(f"[OTA] 快取 gzip 版：{os.path.basename(path)}（{entry.size} → {gz.size} bytes）", flush=True)
+
+    def gzip_variant(self, path, entry):
+        """回傳跟 entry 同一份內容的 gzip 版；沒有或已過期時回 None。"""
+        with self._lock:
+            gz = self._gzip.get(os.path.realpath(path))
+        if gz is None or not gz.is_current() or not gz.path.endswith(f"{entry.digest['sha256']}.gz"):
+            return None
+        return gz
+
+    def _load(self, path):
+        entry = CachedFirmware(path)
+        with self._lock:
+            self._entries[path] = entry
+        return entry
+
+    def get(self, path):
+        """只回傳已快取的檔案；不在 index 裡的檔案回 None，走一般磁碟讀取。"""
+        path = os.path.realpath(path)
+        with self._lock:
+            entry = self._entries.get(path)
+        if entry is None:
+            return None
+        if entry.is_current():
+            return entry
+        try:
+            return self._load(path)
+        except OSError:
+            with self._lock:
+                self._entries.pop(path, None)
+            return None
+
+
+class _CachedBody:
+    """send_head 回傳給 do_GET 的物件；內容直接從快取送出。"""
+    def __init__(self, entry):
+        self.entry = entry
+
+    def close(self):
+        pass
 
 
 class OTARequestHandler(http.server.SimpleHTTPRequestHandler):
     """
     簡單的靜態檔案伺服器。
     directory 參數會指定 OTA 根目錄。
+    支援 Range / 206（斷線後續傳）、以 SHA-256 為強 ETag 的 If-None-Match / If-Range。
+    /manifest.json 列出 ota_index.yaml 中每個韌體的 sha256 / size。
+    Accept-Encoding 有 gzip 時改送預壓縮版（Content-Encoding: gzip，ETag 是壓縮檔的雜湊）；
+    /delta/<舊>-<新>.bsdiff 是版本間的差分。
+    /metrics 輸出本程序與 run.py 等其他程序的指標（Prometheus text format）。
     """
+    # 韌體檔名可能沿用，讓裝置每次都用 ETag 重新驗證
+    cache_control = "no-cache"
+    # 慢速 / 斷線的連線最多佔住 worker 這麼久
+    timeout = 30
+
     def __init__(self, *args, directory=None, **kwargs):
+        self._range = None
+        self._span = None
         super().__init__(*args, directory=directory, **kwargs)
 
+    def send_response(self, code, message=None):
+        OTA_RESPONSES.inc(code=code)
+        super().send_response(code, message)
+
+    def translate_path(self, path):
+        # /delta/<名稱> 對應到衍生檔目錄（只取檔名，不能跳出目錄）
+        route = path.split("?", 1)[0].split("#", 1)[0]
+        artifacts = getattr(self.server, "artifacts", None)
+        if artifacts is not None and route.startswith("/delta/"):
+            return os.path.join(artifacts.cache_dir, "delta", os.path.basename(route))
+        return super().translate_path(path)
+
+    def send_head(self):
+        self._range = None
+        self._span = None
+        route = self.path.split("?", 1)[0]
+        if route == "/manifest.json":
+            return self._send_manifest()
+        if route == "/metrics":
+            return self._send_metrics()
+        path = self.translate_path(self.path)
+        if os.path.isdir(path) or path.endswith("/"):
+            return super().send_head()
+
+        fw_cache = getattr(self.server, "fw_cache", None)
+        entry = fw_cache.get(path) if fw_cache else None
+        variant = "delta" if route.startswith("/delta/") else "full"
+        fw_digest = None
+        if entry is not None:
+            # ota_index 裡的韌體：裝置接受 gzip 且有預壓縮版就送比較小的那份
+            fw_digest, fw_size = entry.digest, entry.size
+            if _accepts_gzip(self.headers.get("Accept-Encoding")):
+                gz = fw_cache.gzip_variant(path, entry)
+                if gz is not None:
+                    entry, variant = gz, "gzip"
+            f = _CachedBody(entry)
+            size, mtime, digest = entry.size, entry.mtime, entry.digest
+        else:
+            try:
+                f = open(path, "rb")
+            except OSError:
+                self.send_error(404, "File not found")
+                return None
+
+        try:
+            if entry is None:
+                st = os.fstat(f.fileno())
+                size, mtime = st.st_size, st.st_mtime
+                digest = file_digest(path, st)
+                fw_digest, fw_size = digest, size
+            etag = f'"{digest["sha256"]}"'
+            last_modified = self.date_time_string(mtime)
 
-def start_ota_server_in_thread(root_dir: str = "/ota/zp2_fw", port: int = 8088) -> threading.Thread:
+            # ① 條件式 GET：裝置已經有同一份檔案就回 304
+            inm = self.headers.get("If-None-Match")
+            if inm is not None:
+                if _etag_in(inm, etag):
+                    self._send_not_modified(etag, last_modified)
+                    f.close()
+                    return None
+            elif self.headers.get("If-Modified-Since"):
+                try:
+                    ims = email.utils.parsedate_to_datetime(self.headers["If-Modified-Since"])
+                    if int(mtime) <= ims.timestamp():
+                        self._send_not_modified(etag, last_modified)
+                        f.close()
+                        return None
+                except (TypeError, ValueError, IndexError, OverflowError):
+                    pass
+
+            # ② Range：If-Range 必須是同一個強 ETag 才續傳，否則回整個檔案
+            rng = None
+            range_header = self.headers.get("Range")
+            if range_header:
+                if_range = self.headers.get("If-Range")
+                if if_range is None or if_range.strip() == etag:
+                    rng = _parse_range(range_header.strip(), size)
+
+            if rng == "unsatisfiable":
+                self.send_response(416)
+                self.send_header("Content-Range", f"bytes */{size}")
+                self.send_header("Content-Length", "0")
+                self.send_header("ETag", etag)
+                self.end_headers()
+                f.close()
+                return None
+
+            self._span = (0, size - 1)
+            if rng:
+                start, end = rng
+                self._range = self._span = (start, end)
+                self.send_response(206)
+                self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+                self.send_header("Content-Length", str(end - start + 1))
+            else:
+                self.send_response(200)
+                self.send_header("Content-Length", str(size))
+            self.send_header("Content-Type", self.guess_type(path))
+            if variant == "gzip":
+                self.send_header("Content-Encoding", "gzip")
+            if variant != "delta" and fw_cache is not None and fw_digest is not None:
+                self.send_header("Vary", "Accept-Encoding")
+            self.send_header("Accept-Ranges", "bytes")
+            self.send_header("ETag", etag)
+            self.send_header("Last-Modified", last_modified)
+            self.send_header("Cache-Control", self.cache_control)
+            # 整個檔案（不是這段 range）的雜湊，裝置下載完可自行驗證；
+            # Repr-Digest 是實際送出的內容（gzip / 差分），X-Firmware-* 是解開後的韌體
+            self.send_header("Repr-Digest", f"sha-256=:{digest['sha256_b64']}:")
+            if variant == "delta":
+                # 差分的目標韌體雜湊在 OTA 指令裡，這裡只標示格式
+                self.send_header("X-Delta-Format", DELTA_FORMAT)
+            else:
+                self.send_header("X-Firmware-SHA256", fw_digest["sha256"])
+                self.send_header("X-Firmware-Size", str(fw_size))
+            self.end_headers()
+            OTA_VARIANTS.inc(variant=variant)
+            return f
+        except Exception:
+            f.close()
+            raise
+
+    def _send_manifest(self):
+        watcher = getattr(self.server, "ota_index", None)
+        firmwares = watcher.current.manifest() if watcher else []
+        body = json.dumps({"firmwares": firmwares}, separators=(",", ":")).encode("utf-8")
+        etag = f'"{hashlib.sha1(body).hexdigest()}"'
+        if _etag_in(self.headers.get("If-None-Match") or "", etag):
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return None
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("ETag", etag)
+        self.send_header("Cache-Control", self.cache_control)
+        self.end_headers()
+        return io.BytesIO(body)
+
+    def _send_metrics(self):
+        body = REGISTRY.render_all().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", METRICS_CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("Cache-Control", "no-store")
+        self.end_headers()
+        return io.BytesIO(body)
+
+    def _send_not_modified(self, etag, last_modified):
+        self.send_response(304)
+        self.send_header("ETag", etag)
+        self.send_header("Last-Modified", last_modified)
+        self.send_header("Cache-Control", self.cache_control)
+        self.end_headers()
+
+    def copyfile(self, source, outputfile):
+        if self._span is None:  # manifest / metrics / 目錄列表
+            return super().copyfile(source, outputfile)
+        start, end = self._span
+        sent = 0
+        OTA_ACTIVE.inc()
+        t0 = time.monotonic()
+        try:
+            if isinstance(source, _CachedBody):
+                sent = self._send_cached(source.entry, start, end - start + 1, outputfile)
+            else:
+                sent = self._send_file(source, start, end - start + 1, outputfile)
+        finally:
+            OTA_ACTIVE.dec()
+            OTA_BYTES.inc(sent)
+            OTA_DOWNLOAD_SECONDS.observe(time.monotonic() - t0)
+
+    def _send_file(self, source, offset, count, outputfile):
+        source.seek(offset)
+        remaining = count
+        while remaining > 0:
+            chunk = source.read(min(64 * 1024, remaining))
+            if not chunk:
+                break
+            outputfile.write(chunk)
+            remaining -= len(chunk)
+        return count - remaining
+
+    def _send_cached(self, entry, offset, count, outputfile):
+        """用 socket.sendfile（kernel 直接從 page cache 送到 socket，平台不支援時自動改用 send）。"""
+        if count <= 0:
+            return 0
+        with open(entry.fd, "rb", closefd=False) as f:
+            return self.connection.sendfile(f, offset, count)
+
+
+# ------------------------------------------------------------
+# 🧵 固定 worker 數量 + 連線數上限的 HTTP server（取代每條連線一個 thread）
+# ------------------------------------------------------------
+class PooledTCPServer(socketserver.TCPServer):
     """
-    在背景 thread 啟動 HTTP Server，提供 root_dir 底下的靜態檔案。
+    連線交給固定大小的 thread pool 處理；
+    同時連線數超過 max_connections 時直接回 503，請裝置稍後再試。
+    """
+    allow_reuse_address = True
+    request_queue_size = 128
+
+    def __init__(self, server_address, handler, max_workers=16, max_connections=64):
+        super().__init__(server_address, handler)
+        self.max_workers = max(1, int(max_workers))
+        self.max_connections = max(self.max_workers, int(max_connections))
+        self._pool = ThreadPoolExecutor(self.max_workers, thread_name_prefix="ota-http")
+        self._slots = threading.BoundedSemaphore(self.max_connections)
+        self.fw_cache = None
+
+    def process_request(self, request, client_address):
+        if not self._slots.acquire(blocking=False):
+            OTA_REJECTED.inc()
+            try:
+                request.sendall(
+                    b"HTTP/1.1 503 Service Unavailable\r\n"
+                    b"Retry-After: 5\r\nContent-Length: 0\r\nConnection: close\r\n\r\n"
+                )
+            except OSError:
+                pass
+            finally:
+                self.shutdown_request(request)
+            return
+        self._pool.submit(self._process, request, client_address)
+
+    def _process(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            self._slots.release()
+
+    def server_close(self):
+        super().server_close()
+        self._pool.shutdown(wait=False)
+
+
+def prepare_firmware_cache(root_dir, index_path="/ota/ota_index.yaml", watcher=None, artifacts=None,
+                           default_profiles=None):
+    """
+    建立韌體快取並跟著 ota_index 熱重載。
+    watcher 可以傳入既有的 OtaIndexWatcher（單一程序模式下跟 run.py 共用同一份），沒給就用
+    default_profiles（{"ZP2": zp2_fw_profile}，決定差分要做到哪個版本）自己建一個。
+    artifacts（ota_artifacts.ArtifactStore）有給時，每次載入 index 在背景產生 gzip / 差分，
+    做完再快取一次 gzip 版；產生期間照常提供完整韌體。
     """
     if not os.path.isdir(root_dir):
         print(f"[OTA] ⚠ 目錄不存在：{root_dir}（仍然啟動 HTTP，但請確認 /ota 掛載與路徑）", flush=True)
     else:
         print(f"[OTA] 使用根目錄：{root_dir}", flush=True)
 
+    fw_cache = FirmwareCache(root_dir, artifacts)
+    if watcher is None:
+        watcher = OtaIndexWatcher(index_path, default_profiles, root_dir=root_dir)
+
+    def _built(index):
+        if watcher.current is index:  # 產生期間 index 又換了就等下一輪
+            fw_cache.preload(index)
+
+    def _reload(index):
+        fw_cache.preload(index)
+        if artifacts is not None:
+            artifacts.build_async(index, on_done=_built)
+
+    _reload(watcher.current)
+    watcher.add_listener(_reload)
+    watcher.start()
+    REGISTRY.gauge("cached_firmwares", "已 mmap 快取的韌體數", fn=fw_cache.count, namespace="ota")
+    return fw_cache, watcher
+
+
+def create_ota_server(root_dir, port, fw_cache, watcher, max_workers=16, max_connections=64):
+    """綁定 port 並回傳尚未開始 serve 的 PooledTCPServer。"""
     handler = functools.partial(OTARequestHandler, directory=root_dir)
+    httpd = PooledTCPServer(("", port), handler, max_workers, max_connections)
+    httpd.fw_cache = fw_cache
+    httpd.artifacts = fw_cache.artifacts
+    httpd.ota_index = watcher
+    print(f"[OTA] worker={httpd.max_workers}，連線上限={httpd.max_connections}", flush=True)
+    print(f"[OTA] HTTP server 啟動：http://0.0.0.0:{port}/", flush=True)
+    print(f"[OTA] 例如：http://<HA_IP>:{port}/STM32/ZP2/fota-ZP2-5-0-20251205-S01.bin", flush=True)
+    return httpd
 
-    class ThreadingTCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
-        allow_reuse_address = True
+
+def start_ota_server_in_thread(root_dir: str = "/ota/zp2_fw", port: int = 8088,
+                               index_path: str = "/ota/ota_index.yaml",
+                               max_workers: int = 16, max_connections: int = 64,
+                               artifact_dir: str = None, default_profiles: dict = None) -> threading.Thread:
+    """
+    在背景 thread 啟動 HTTP Server，提供 root_dir 底下的靜態檔案。
+    index_path 列出的韌體會先 mmap 快取，下載時用 sendfile 送出；
+    有給 artifact_dir 時另外產生 gzip 預壓縮版與版本間差分。
+    """
+    artifacts = ArtifactStore(artifact_dir) if artifact_dir else None
+    fw_cache, watcher = prepare_firmware_cache(
+        root_dir, index_path, artifacts=artifacts, default_profiles=default_profiles
+    )
 
     def _run():
-        with ThreadingTCPServer(("", port), handler) as httpd:
-            print(f"[OTA] HTTP server 啟動：http://0.0.0.0:{port}/", flush=True)
-            print(f"[OTA] 例如：http://<HA_IP>:{port}/STM32/ZP2/fota-ZP2-5-0-20251205-S01.bin", flush=True)
+        with create_ota_server(root_dir, port, fw_cache, watcher, max_workers, max_connections) as httpd:
             try:
                 httpd.serve_forever()
             except KeyboardInterrupt:
@@ -45,8 +568,35 @@ def start_ota_server_in_thread(root_dir: str = "/ota/zp2_fw", port: int = 8088)
     return t
 
 
+def _default_profiles():
+    """add-on 設定的 zp2_fw_profile（同 run.py 的預設值）；讀不到 options.json 時只看 ota_index 的 rollouts。"""
+    path = os.path.join(os.environ.get("ZP2_DATA_DIR", "/data"), "options.json")
+    try:
+        with open(path, "r") as f:
+            options = json.load(f)
+    except (OSError, ValueError) as e:
+        print(f"[OTA] ⚠ 無法讀取 {path}：{e}", flush=True)
+        return {}
+    return {"ZP2": options.get("zp2_fw_profile", "zp2_5_0_20251205_s01")}
+
+
+def _start_metrics_dump(interval=10.0):
+    """定期把本程序指標寫到 METRICS_DIR，讓其他程序的 /metrics 也看得到。"""
+    def _loop():
+        while True:
+            REGISTRY.dump()
+            time.sleep(interval)
+    threading.Thread(target=_loop, name="metrics-dump", daemon=True).start()
+
+
 if __name__ == "__main__":
+    REGISTRY.namespace = "ota"
     root = os.environ.get("OTA_ROOT", "/ota/zp2_fw")
     port = int(os.environ.get("OTA_PORT", "8088"))
+    index = os.environ.get("OTA_INDEX", "/ota/ota_index.yaml")
+    workers = int(os.environ.get("OTA_WORKERS", "16"))
+    max_conn = int(os.environ.get("OTA_MAX_CONNECTIONS", "64"))
+    artifact_dir = os.environ.get("OTA_ARTIFACT_DIR", "/data/ota_artifacts")
     print(f"[OTA] 以獨立模式啟動，root={root}, port={port}", flush=True)
-    start_ota_server_in_thread(root, port).join()
+    _start_metrics_dump()
+    start_ota_server_in_thread(root, port, index, workers, max_conn, artifact_dir, _default_profiles()).join()
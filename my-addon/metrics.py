@@ -0,0 +1,339 @@
+import bisect
+import glob
+import logging
+import os
+import threading
+import time
+
+# ------------------------------------------------------------
+# 📈 共用指標（Prometheus text format）
+# ------------------------------------------------------------
+# 每個程序一個 REGISTRY，namespace 由主程式設定（run.py → zp2、OTA server → ota、儀表板 → dashboard），
+# 共用模組（ha_states 等）註冊的指標會自動掛上所屬程序的前綴，不會撞名。
+# OTA server / 儀表板自己的指標建立時就指定 namespace，單一程序模式（runtime.py）下名稱也不變。
+# run.py 沒有 HTTP server，所以每個程序都定期把自己的指標寫到 METRICS_DIR/<namespace>.prom，
+# 有 /metrics 的 server 回應時把自己的即時指標加上其他程序的檔案一起輸出。
+
+METRICS_DIR = os.environ.get("ZP2_METRICS_DIR", "/tmp/zp2_metrics")
+STALE_SEC = 300  # 超過這麼久沒更新的 .prom 視為程序已結束，不輸出
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _label_str(names, values, *extra):
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    pairs.extend(e for e in extra if e)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _fmt(v):
+    if isinstance(v, float):
+        if v == float("inf"):
+            return "+Inf"
+        return repr(v)
+    return str(v)
+
+
+class _Metric:
+    kind = "untyped"
+
+    def __init__(self, name, help="", labelnames=(), fn=None, namespace=None):
+        self.name = name
+        self.namespace = namespace  # None = 跟著 Registry.namespace
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.fn = fn  # 有給 fn 就在輸出時呼叫：回傳數值，或 {label 值 tuple: 數值}
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def _key(self, labels):
+        return tuple(str(labels.get(n, "")) for n in self.labelnames)
+
+    def samples(self):
+        if self.fn is not None:
+            v = self.fn()
+            return list(v.items()) if isinstance(v, dict) else [((), v)]
+        with self._lock:
+            return list(self._values.items())
+
+    def render(self, full_name, const=None):
+        lines = [f"# HELP {full_name} {self.help}", f"# TYPE {full_name} {self.kind}"]
+        for key, v in self.samples():
+            if v is None:
+                continue
+            lines.append(f"{full_name}{_label_str(self.labelnames, key, const)} {_fmt(v)}")
+        return lines
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+
+class _HistogramChild:
+    __slots__ = ("counts", "count", "sum", "max")
+
+    def __init__(self, n):
+        self.counts = [0] * n
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+
+class Histogram(_Metric):
+    """以秒為單位的固定 bucket 直方圖（記錄只要一次 bisect）；snapshot() 給 log 用，percentile 取 bucket 上界。"""
+    kind = "histogram"
+    BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+               0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self, name, help="", labelnames=(), buckets=None, namespace=None):
+        super().__init__(name, help, labelnames, namespace=namespace)
+        self.buckets = tuple(buckets or self.BUCKETS)
+
+    def _child(self, key):
+        child = self._values.get(key)
+        if child is None:
+            child = self._values[key] = _HistogramChild(len(self.buckets) + 1)  # 最後一格是 +Inf
+        return child
+
+    def observe(self, seconds, **labels):
+        i = bisect.bisect_left(self.buckets, seconds)
+        key = self._key(labels)
+        with self._lock:
+            child = self._child(key)
+            child.counts[i] += 1
+            child.count += 1
+            child.sum += seconds
+            if seconds > child.max:
+                child.max = seconds
+
+    def time(self, **labels):
+        return _Timer(self, labels)
+
+    def snapshot(self, **labels):
+        with self._lock:
+            child = self._values.get(self._key(labels))
+            if child is None or not child.count:
+                return {"count": 0, "avg_ms": None, "p50_ms": None, "p95_ms": None, "p99_ms": None, "max_ms": 0.0}
+            return {
+                "count": child.count,
+                "avg_ms": round(child.sum / child.count * 1000, 3),
+                "p50_ms": self._percentile_ms(child, 0.50),
+                "p95_ms": self._percentile_ms(child, 0.95),
+                "p99_ms": self._percentile_ms(child, 0.99),
+                "max_ms": round(child.max * 1000, 3),
+            }
+
+    def _percentile_ms(self, child, q):
+        target = q * child.count
+        seen = 0
+        for i, n in enumerate(child.counts):
+            seen += n
+            if seen >= target:
+                v = self.buckets[i] if i < len(self.buckets) else child.max
+                return round(v * 1000, 3)
+        return round(child.max * 1000, 3)
+
+    def render(self, full_name, const=None):
+        lines = [f"# HELP {full_name} {self.help}", f"# TYPE {full_name} histogram"]
+        with self._lock:
+            items = [(k, list(c.counts), c.count, c.sum) for k, c in self._values.items()]
+        for key, counts, count, total in items:
+            cum = 0
+            for bound, n in zip(self.buckets + (float("inf"),), counts):
+                cum += n
+                le = f'le="{_fmt(float(bound))}"'
+                lines.append(f"{full_name}_bucket{_label_str(self.labelnames, key, const, le)} {cum}")
+            labels = _label_str(self.labelnames, key, const)
+            lines.append(f"{full_name}_sum{labels} {_fmt(total)}")
+            lines.append(f"{full_name}_count{labels} {count}")
+        return lines
+
+
+class _Timer:
+    __slots__ = ("hist", "labels", "t0")
+
+    def __init__(self, hist, labels):
+        self.hist = hist
+        self.labels = labels
+
+    def __enter__(self):
+        self.t0 = time.monotonic()
+        return self
+
+    def __exit__(self, *exc):
+        self.hist.observe(time.monotonic() - self.t0, **self.labels)
+        return False
+
+
+class Registry:
+    def __init__(self, namespace=""):
+        self.namespace = namespace
+        self.shard = None  # 分片模式下每個 run.py 的指標加上 shard 標籤，各寫各的 .prom
+        self._lock = threading.Lock()
+        self._metrics = {}
+
+    def _get_or_add(self, cls, name, *args):
+        key = (args[-1], name)  # 最後一個參數是 namespace
+        with self._lock:
+            m = self._metrics.get(key)
+            if m is None:
+                m = self._metrics[key] = cls(name, *args)
+            return m
+
+    def counter(self, name, help="", labelnames=(), fn=None, namespace=None):
+        return self._get_or_add(Counter, name, help, labelnames, fn, namespace)
+
+    def gauge(self, name, help="", labelnames=(), fn=None, namespace=None):
+        return self._get_or_add(Gauge, name, help, labelnames, fn, namespace)
+
+    def histogram(self, name, help="", labelnames=(), buckets=None, namespace=None):
+        return self._get_or_add(Histogram, name, help, labelnames, buckets, namespace)
+
+    def add(self, *metrics):
+        """註冊在別處建立好的指標物件（例如 IngestPipeline 自帶的直方圖）。"""
+        with self._lock:
+            for m in metrics:
+                self._metrics.setdefault((m.namespace, m.name), m)
+
+    def full_name(self, name, namespace=None):
+        ns = namespace or self.namespace
+        return f"{ns}_{name}" if ns else name
+
+    def render(self):
+        with self._lock:
+            metrics = list(self._metrics.values())
+        const = f'shard="{_escape(self.shard)}"' if self.shard is not None else None
+        lines = []
+        for m in metrics:
+            try:
+                lines.extend(m.render(self.full_name(m.name, m.namespace), const))
+            except Exception as e:
+                logging.error(f"[metrics] 輸出 {m.name} 失敗：{e}")
+        return "\n".join(lines) + "\n"
+
+    def dump(self, metrics_dir=None):
+        """把指標寫到 <metrics_dir>/<namespace>.prom（先寫暫存檔再 rename，讀的人不會看到一半）。"""
+        metrics_dir = metrics_dir or METRICS_DIR
+        try:
+            os.makedirs(metrics_dir, exist_ok=True)
+            path = os.path.join(metrics_dir, self._filename())
+            tmp = f"{path}.tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                f.write(self.render())
+            os.replace(tmp, path)
+        except OSError as e:
+            logging.error(f"[metrics] 寫入 {metrics_dir} 失敗：{e}")
+
+    def _filename(self):
+        base = self.namespace or "default"
+        return f"{base}-{self.shard}.prom" if self.shard is not None else f"{base}.prom"
+
+    def render_all(self, metrics_dir=None):
+        """自己的即時指標 + 其他程序最近寫出的 .prom。"""
+        metrics_dir = metrics_dir or METRICS_DIR
+        parts = [self.render()]
+        own = self._filename()
+        now = time.time()
+        for path in sorted(glob.glob(os.path.join(metrics_dir, "*.prom"))):
+            if os.path.basename(path) == own:
+                continue
+            try:
+                if now - os.path.getmtime(path) > STALE_SEC:
+                    continue
+                with open(path, "r", encoding="utf-8") as f:
+                    parts.append(f.read())
+            except OSError:
+                continue
+        return _merge_families(parts)
+
+
+def _merge_families(parts):
+    """
+    多個分片會寫出同名的指標：同一個名稱的 HELP / TYPE 只留一份，
+    樣本依名稱集中在一起（text format 要求同一個 metric 的行要連續）。
+    """
+    families = {}
+    order = []
+    for text in parts:
+        current = None
+        for line in text.splitlines():
+            if not line:
+                continue
+            if line.startswith("# "):
+                fields = line.split(" ", 3)
+                if len(fields) >= 3 and fields[1] in ("HELP", "TYPE"):
+                    current = fields[2]
+                    if current not in families:
+                        families[current] = {"HELP": None, "TYPE": None, "samples": []}
+                        order.append(current)
+                    if families[current][fields[1]] is None:
+                        families[current][fields[1]] = line
+                continue
+            if current is None:
+                current = ""
+                if current not in families:
+                    families[current] = {"HELP": None, "TYPE": None, "samples": []}
+                    order.append(current)
+            families[current]["samples"].append(line)
+    lines = []
+    for name in order:
+        fam = families[name]
+        lines.extend(l for l in (fam["HELP"], fam["TYPE"]) if l)
+        lines.extend(fam["samples"])
+    return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+# ------------------------------------------------------------
+# 🪵 每則訊息的 INFO log 取樣（量大時只留 1/N，總數看 /metrics）
+# ------------------------------------------------------------
+class LogSampler:
+    """
+    info(key, msg)：同一個 key 每 every 筆只印第一筆，並附上目前累計數。
+    every <= 1 代表全部照印（原本的行為）。
+    """
+    def __init__(self, every=1):
+        self.every = max(1, int(every))
+        self._lock = threading.Lock()
+        self._counts = {}
+
+    def info(self, key, msg):
+        if self.every == 1:
+            logging.info(msg)
+            return
+        with self._lock:
+            n = self._counts.get(key, 0) + 1
+            self._counts[key] = n
+        if n % self.every == 1:
+            logging.info(f"{msg} [取樣 1/{self.every}，累計 {n}]")
@@ -0,0 +1,214 @@
+import gzip
+import logging
+import os
+import threading
+import time
+
+try:
+    import bsdiff4  # 選用；沒有安裝就只產生 gzip，不做差分
+except ImportError:
+    bsdiff4 = None
+
+# ------------------------------------------------------------
+# 🗜️ 韌體衍生檔：gzip 預壓縮 + 版本間的二進位差分（bsdiff4）
+# ------------------------------------------------------------
+# 檔名只由內容的 SHA-256 決定，同一份韌體換了 profile 名稱或路徑也不用重算；
+# 寫入時先寫暫存檔再 rename，run.py 與 OTA server 同時看這個目錄也不會讀到一半的檔案。
+# 只由 OTA server（單一程序模式下是同一個 watcher）負責產生，run.py 只查詢有沒有。
+
+DELTA_FORMAT = "bsdiff4"
+
+
+def _write_atomic(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+
+class ArtifactStore:
+    """
+    build(index)：依 OtaIndex 產生
+      - gz/<sha256>.gz：每個韌體的 gzip 版本（比原檔小才保留）
+      - delta/<舊 sha 前 16 碼>-<新 sha 前 16 碼>.bsdiff：同一個 model 的其他版本 → 目前 rollout / 預設的
+        目標版本（index.target_profiles()）的差分（比完整韌體小才保留；沒有 bsdiff4 時略過）
+    index 不再列出的衍生檔會被刪掉。bsdiff 很吃 CPU（每組數秒），OTA server 用 build_async()
+    在背景 thread 產生，不擋啟動與熱重載；產生好之前裝置照樣拿完整韌體。
+    """
+    def __init__(self, cache_dir, deltas=True, gzip_level=9, max_delta_ratio=0.8):
+        self.cache_dir = cache_dir
+        self.deltas = bool(deltas) and bsdiff4 is not None
+        self.gzip_level = int(gzip_level)
+        # 差分超過完整韌體的這個比例就不值得（裝置還要花時間 patch）
+        self.max_delta_ratio = float(max_delta_ratio)
+        self._lock = threading.Lock()
+        self._async_lock = threading.Lock()
+        self._next = None     # build_async 還沒開始做的最新一份 (index, on_done)
+        self._worker = None
+        self.built = 0
+        self.build_ms = 0.0
+
+    # ---------------- 路徑 ----------------
+    def gzip_path(self, sha256):
+        return os.path.join(self.cache_dir, "gz", f"{sha256}.gz")
+
+    @staticmethod
+    def delta_name(from_sha, to_sha):
+        return f"{from_sha[:16]}-{to_sha[:16]}.bsdiff"
+
+    def delta_path(self, from_sha, to_sha):
+        return os.path.join(self.cache_dir, "delta", self.delta_name(from_sha, to_sha))
+
+    def gzip_for(self, sha256):
+        path = self.gzip_path(sha256)
+        return path if os.path.isfile(path) else None
+
+    def delta_for(self, from_sha, to_sha):
+        """有可用的差分時回傳 (路徑, 大小)，否則 None。"""
+        if not from_sha or not to_sha or from_sha == to_sha:
+            return None
+        path = self.delta_path(from_sha, to_sha)
+        try:
+            return path, os.path.getsize(path)
+        except OSError:
+            return None
+
+    # ---------------- 產生 ----------------
+    def build_async(self, index, on_done=None):
+        """
+        在背景 thread 執行 build(index)，完成後呼叫 on_done(index)。
+        正在產生時又有新的 index 進來，只保留最新一份，這輪做完接著做。
+        """
+        with self._async_lock:
+            self._next = (index, on_done)
+            if self._worker is not None:
+                return
+            self._worker = threading.Thread(target=self._build_loop, name="ota-artifacts", daemon=True)
+            self._worker.start()
+
+    def _build_loop(self):
+        while True:
+            with self._async_lock:
+                job, self._next = self._next, None
+                if job is None:
+                    self._worker = None
+                    return
+            index, on_done = job
+            try:
+                self.build(index)
+            except Exception as e:
+                logging.error(f"[OTA] 產生衍生檔失敗：{e}")
+            if on_done is not None:
+                try:
+                    on_done(index)
+                except Exception as e:
+                    logging.error(f"[OTA] 衍生檔產生後的回呼失敗：{e}")
+
+    def idle(self):
+        """背景產生已做完（測試與 bench 用）。"""
+        with self._async_lock:
+            return self._worker is None
+
+    def build(self, index):
+        t0 = time.perf_counter()
+        images = {}  # sha256 → (model, 路徑, size)
+        for fw in index.profiles.values():
+            path = index.image_path(fw)
+            if path and fw.get("sha256"):
+                images.setdefault(fw["sha256"], (str(fw.get("model")), path, fw.get("size") or 0))
+        targets = {
+            fw["sha256"] for fw in map(index.get, index.target_profiles()) if fw and fw.get("sha256") in images
+        }
+
+        with self._lock:
+            keep = set()
+            made = 0
+            for sha, (_, path, size) in images.items():
+                out = self.gzip_path(sha)
+                keep.update((out, out + ".skip"))
+                if os.path.isfile(out) or os.path.isfile(out + ".skip"):
+                    continue
+                try:
+                    with open(path, "rb") as f:
+                        data = gzip.compress(f.read(), self.gzip_level, mtime=0)
+                    if len(data) < size:
+                        _write_atomic(out, data)
+                    else:
+                        _write_atomic(out + ".skip", b"")  # 壓不小，記下來下次不用再試
+                    made += 1
+                except OSError as e:
+                    logging.error(f"[OTA] 無法產生 {os.path.basename(path)} 的 gzip：{e}")
+
+            if self.deltas:
+                for to_sha in targets:
+                    to_model, to_path, to_size = images[to_sha]
+                    for from_sha, (model, from_path, _) in images.items():
+                        if from_sha == to_sha or model != to_model:
+                            continue
+                        out = self.delta_path(from_sha, to_sha)
+                        keep.update((out, out + ".skip"))
+                        if os.path.isfile(out) or os.path.isfile(out + ".skip"):
+                            continue
+                        try:
+                            with open(from_path, "rb") as f:
+                                old = f.read()
+                            with open(to_path, "rb") as f:
+                                new = f.read()
+                            patch = bsdiff4.diff(old, new)
+                            if len(patch) <= to_size * self.max_delta_ratio:
+                                _write_atomic(out, patch)
+                            else:
+                                _write_atomic(out + ".skip", b"")
+                            made += 1
+                        except Exception as e:
+                            # 讀檔失敗、bsdiff 本身出錯（例如記憶體不足）都記成 .skip，不要每次重載都重試
+                            logging.error(f"[OTA] 無法產生差分 {self.delta_name(from_sha, to_sha)}：{e}")
+                            try:
+                                _write_atomic(out + ".skip", b"")
+                            except OSError:
+                                pass
+
+            removed = self._prune(keep)
+            self.built += made
+        self.build_ms = (time.perf_counter() - t0) * 1000
+        if made or removed:
+            logging.info(
+                f"[OTA] 衍生檔：新產生 {made}、刪除 {removed}（{self.build_ms:.0f} ms，"
+                f"差分{'啟用' if self.deltas else '停用'}）"
+            )
+        return made
+
+    def _prune(self, keep):
+        removed = 0
+        for sub in ("gz", "delta"):
+            d = os.path.join(self.cache_dir, sub)
+            try:
+                names = os.listdir(d)
+            except OSError:
+                continue
+            for name in names:
+                path = os.path.join(d, name)
+                if path not in keep and not name.endswith(".tmp"):
+                    try:
+                        os.remove(path)
+                        removed += 1
+                    except OSError:
+                        pass
+        return removed
+
+    def stats(self):
+        counts = {}
+        for sub in ("gz", "delta"):
+            try:
+                names = os.listdir(os.path.join(self.cache_dir, sub))
+            except OSError:
+                names = []
+            counts[sub] = sum(1 for n in names if not n.endswith((".tmp", ".skip")))
+        return {
+            "gzip": counts["gz"],
+            "deltas": counts["delta"],
+            "delta_enabled": self.deltas,
+            "built": self.built,
+            "build_ms": round(self.build_ms, 1),
+        }
@@ -0,0 +1,265 @@
+import base64
+import hashlib
+import logging
+import os
+import threading
+import yaml
+
+# ------------------------------------------------------------
+# 📂 讀取 ota_index.yaml（run.py 與 OTA server 共用）
+# ------------------------------------------------------------
+def read_ota_index(path="/ota/ota_index.yaml"):
+    """讀取整份 ota_index.yaml；格式錯誤時直接丟例外（給熱重載判斷要不要沿用舊版）。"""
+    with open(path, "r", encoding="utf-8") as f:
+        data = yaml.safe_load(f) or {}
+    if not isinstance(data, dict):
+        raise ValueError("ota_index.yaml 最外層必須是 mapping")
+    return data
+
+
+def load_ota_index(path="/ota/ota_index.yaml"):
+    try:
+        data = read_ota_index(path)
+        fw_list = data.get("firmwares", [])
+        return {fw["id"]: fw for fw in fw_list if "id" in fw}
+    except Exception as e:
+        logging.error(f"[OTA] 載入 ota_index.yaml 失敗：{e}")
+        return {}
+
+
+# ------------------------------------------------------------
+# 🔑 韌體完整性資訊（SHA-256 / size），依 (mtime, size) 快取，檔案沒變就不重算
+# ------------------------------------------------------------
+_DIGEST_CACHE = {}
+_DIGEST_LOCK = threading.Lock()
+
+
+def file_digest(path, st=None):
+    """回傳 {"sha256", "sha256_b64", "size", "mtime_ns"}；檔案不存在時丟 OSError。"""
+    st = st or os.stat(path)
+    key = (st.st_mtime_ns, st.st_size)
+    with _DIGEST_LOCK:
+        hit = _DIGEST_CACHE.get(path)
+        if hit and hit[0] == key:
+            return hit[1]
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(chunk)
+    meta = {
+        "sha256": h.hexdigest(),
+        "sha256_b64": base64.b64encode(h.digest()).decode("ascii"),
+        "size": st.st_size,
+        "mtime_ns": st.st_mtime_ns,
+    }
+    with _DIGEST_LOCK:
+        _DIGEST_CACHE[path] = (key, meta)
+    return meta
+
+
+def normalize_mac(mac):
+    return str(mac).lower().replace(":", "").replace("-", "")
+
+
+# ------------------------------------------------------------
+# 🧭 韌體解析表（載入時建好所有對照 dict，查詢都是 O(1)）
+# ------------------------------------------------------------
+class OtaIndex:
+    """
+    ota_index.yaml 的唯讀快照。除了 firmwares 以外，可選的：
+
+      groups:                    # MAC 分組（分批 rollout 用）
+        canary: [aabbccddeeff, ...]
+      rollouts:                  # 由上往下，先列的優先
+        - {model: ZP2, group: canary, profile: test}
+        - {model: ZP2, hw: "B", profile: zp2_xxx}
+        - {model: ZS2, profile: zs2_xxx}
+
+    解析順序：(model, MAC 所屬 group) → (model, hw) → model 預設。
+    model 預設以 default_profiles（add-on 設定的 zp2_fw_profile）優先，其次是只有 model 的 rollout。
+    有給 root_dir 時，每個 profile 的 sha256 / size 會在載入時算好放進 entry。
+    """
+    def __init__(self, data=None, default_profiles=None, mtime_ns=0, root_dir=None):
+        data = data or {}
+        self.mtime_ns = mtime_ns
+        self.root_dir = root_dir
+        self.profiles = {
+            fw["id"]: dict(fw) for fw in (data.get("firmwares") or []) if isinstance(fw, dict) and "id" in fw
+        }
+        self.image_stats = {}  # 檔案路徑 → (mtime_ns, size)，給 watcher 判斷映像檔是否被換掉
+        if root_dir:
+            for fw in self.profiles.values():
+                self._attach_digest(fw)
+        self.by_model_mac = {}
+        self.by_model_hw = {}
+        self.by_model = {}
+        # (model, version) → entry：用裝置回報的 FW 找出它目前的映像檔（差分 OTA 的基底）
+        self.by_model_version = {}
+        for fw in self.profiles.values():
+            if fw.get("model") is not None and fw.get("version") is not None:
+                self.by_model_version.setdefault((str(fw["model"]), str(fw["version"])), fw)
+
+        groups = {
+            str(name): {normalize_mac(m) for m in (macs or [])}
+            for name, macs in (data.get("groups") or {}).items()
+        }
+
+        for rule in data.get("rollouts") or []:
+            if not isinstance(rule, dict):
+                continue
+            profile = rule.get("profile")
+            model = rule.get("model")
+            if profile not in self.profiles or not model:
+                logging.warning(f"[OTA] 忽略無效的 rollout：{rule}")
+                continue
+            model = str(model)
+            macs = set(normalize_mac(m) for m in (rule.get("macs") or []))
+            if rule.get("group") is not None:
+                macs |= groups.get(str(rule["group"]), set())
+            if macs:
+                for mac in macs:
+                    self.by_model_mac.setdefault((model, mac), profile)
+            elif rule.get("hw") is not None:
+                self.by_model_hw.setdefault((model, str(rule["hw"])), profile)
+            else:
+                self.by_model.setdefault(model, profile)
+
+        for model, profile in (default_profiles or {}).items():
+            if profile in self.profiles:
+                self.by_model[model] = profile
+            elif profile:
+                logging.error(f"[OTA] 找不到 FW profile：{profile}（model={model}）")
+
+    def resolve(self, model, mac, hw=None):
+        """回傳該裝置應該使用的 firmware entry（dict），沒有對應時回 None。"""
+        model = str(model)
+        profile = self.by_model_mac.get((model, normalize_mac(mac)))
+        if profile is None and hw is not None:
+            profile = self.by_model_hw.get((model, str(hw)))
+        if profile is None:
+            profile = self.by_model.get(model)
+        return self.profiles.get(profile) if profile else None
+
+    def get(self, profile_id):
+        return self.profiles.get(profile_id)
+
+    def target_profiles(self):
+        """目前有裝置會被解析到的 profile id（rollout 與各 model 預設），差分只需要做到這些版本。"""
+        return set(self.by_model_mac.values()) | set(self.by_model_hw.values()) | set(self.by_model.values())
+
+    def find_version(self, model, version):
+        """回傳 model 底下 version 相同的 firmware entry，index 沒列出時回 None。"""
+        return self.by_model_version.get((str(model), str(version)))
+
+    def image_path(self, fw):
+        rel = str(fw.get("path", "")).lstrip("/")
+        return os.path.join(self.root_dir, rel) if (rel and self.root_dir) else None
+
+    def _attach_digest(self, fw):
+        path = self.image_path(fw)
+        if not path:
+            return
+        try:
+            meta = file_digest(path)
+        except OSError as e:
+            logging.error(f"[OTA] 無法計算 {fw.get('id')} 的 SHA-256：{e}")
+            self.image_stats[path] = None
+            return
+        fw["sha256"] = meta["sha256"]
+        fw["size"] = meta["size"]
+        self.image_stats[path] = (meta["mtime_ns"], meta["size"])
+
+    def images_changed(self):
+        """有任何韌體檔案被替換 / 新增 / 刪除就回 True。"""
+        for path, key in self.image_stats.items():
+            try:
+                st = os.stat(path)
+                now = (st.st_mtime_ns, st.st_size)
+            except OSError:
+                now = None
+            if now != key:
+                return True
+        return False
+
+    def manifest(self):
+        """給 OTA server /manifest.json 用的清單。"""
+        return [
+            {
+                k: fw.get(k)
+                for k in ("id", "model", "version", "path", "sha256", "size")
+                if fw.get(k) is not None
+            }
+            for fw in self.profiles.values()
+        ]
+
+
+# ------------------------------------------------------------
+# 👀 ota_index.yaml 熱重載（輪詢 mtime，解析成功才整份替換）
+# ------------------------------------------------------------
+class OtaIndexWatcher:
+    """
+    定期檢查 ota_index.yaml（以及它列出的韌體檔）的 mtime / size，變了就重新解析並建立新的 OtaIndex。
+    替換只是一次屬性指定，讀取端永遠拿到完整的一份；解析失敗則繼續用舊版。
+    """
+    def __init__(self, path="/ota/ota_index.yaml", default_profiles=None, interval=5.0, root_dir=None):
+        self.path = path
+        self.root_dir = root_dir
+        self.default_profiles = dict(default_profiles or {})
+        self.interval = float(interval)
+        self._listeners = []
+        self._stat_key = None
+        self._stopped = threading.Event()
+        self._thread = None
+        self.current = OtaIndex()
+        self.reloads = 0
+        self.check()
+
+    def add_listener(self, fn):
+        """fn(new_index) 會在每次成功重載後被呼叫。"""
+        self._listeners.append(fn)
+
+    def check(self):
+        """檔案有變就重載；回傳是否換了新版。"""
+        try:
+            st = os.stat(self.path)
+        except OSError as e:
+            if self._stat_key != "missing":  # 同一次缺檔只印一次
+                logging.error(f"[OTA] 無法讀取 {self.path}：{e}")
+            self._stat_key = "missing"
+            return False
+        key = (st.st_mtime_ns, st.st_size)
+        if key == self._stat_key and not self.current.images_changed():
+            return False
+        self._stat_key = key
+        try:
+            data = read_ota_index(self.path)
+            index = OtaIndex(data, self.default_profiles, st.st_mtime_ns, self.root_dir)
+        except Exception as e:
+            logging.error(f"[OTA] 重新載入 ota_index.yaml 失敗，沿用舊版：{e}")
+            return False
+
+        self.current = index
+        self.reloads += 1
+        logging.info(
+            f"[OTA] 已載入 ota_index.yaml：{len(index.profiles)} 個 profile、"
+            f"{len(index.by_model_mac)} 筆 MAC 對應、{len(index.by_model_hw)} 筆 hw 對應"
+        )
+        for fn in self._listeners:
+            try:
+                fn(index)
+            except Exception as e:
+                logging.error(f"[OTA] ota_index 重載通知失敗：{e}")
+        return True
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self._thread = threading.Thread(target=self._run, name="ota-index-watch", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            self.check()
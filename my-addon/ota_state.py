@@ -0,0 +1,224 @@
+import logging
+import threading
+import time
+
+# ------------------------------------------------------------
+# 📶 每台裝置的 OTA 狀態
+# ------------------------------------------------------------
+IDLE = "idle"                # 沒有進行中的 OTA
+COMMANDED = "commanded"      # 已排程 OTA 指令，尚未真的送出
+DOWNLOADING = "downloading"  # 指令已送出，等待裝置回報新 FW
+VERIFIED = "verified"        # 裝置回報的 FW 已等於目標版本
+FAILED = "failed"            # 逾時沒升級成功，等待退避後重試
+
+ACTIVE_STATES = (COMMANDED, DOWNLOADING)
+
+
+class OtaEntry:
+    __slots__ = (
+        "mac", "state", "target", "fw", "attempts",
+        "commanded_at", "started_at", "next_attempt_at", "updated_at",
+    )
+
+    def __init__(self, mac):
+        self.mac = mac
+        self.state = IDLE
+        self.target = None
+        self.fw = None
+        self.attempts = 0
+        self.commanded_at = 0.0
+        self.started_at = 0.0
+        self.next_attempt_at = 0.0
+        self.updated_at = 0.0
+
+    def as_dict(self):
+        return {k: getattr(self, k) for k in self.__slots__}
+
+
+class OtaTracker:
+    """
+    以 MAC 為 key 的 OTA 狀態表：
+      idle → commanded → downloading → verified / failed
+    - 每次嘗試只送一次 OTA 指令，之後的 data frame 只更新狀態
+    - 失敗後以指數退避重試（retry_base_sec * 2^n，最多 retry_max_sec）
+    - 同一台兩次指令之間至少間隔 cooldown_sec
+    - 全域同時下載數量上限 max_concurrent
+    """
+    def __init__(self, max_concurrent=10, timeout_sec=600, retry_base_sec=60,
+                 retry_max_sec=3600, cooldown_sec=30, clock=time.monotonic):
+        self.max_concurrent = max(1, int(max_concurrent))
+        self.timeout_sec = float(timeout_sec)
+        self.retry_base_sec = float(retry_base_sec)
+        self.retry_max_sec = float(retry_max_sec)
+        self.cooldown_sec = float(cooldown_sec)
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._active = set()
+        self._listeners = []
+
+        self.commands = 0
+        self.verified = 0
+        self.failed = 0
+        self.deferred = 0
+
+    # ---------------- 內部工具 ----------------
+    def _entry(self, mac):
+        e = self._entries.get(mac)
+        if e is None:
+            e = self._entries[mac] = OtaEntry(mac)
+        return e
+
+    def _set_state(self, e, state, now, notify=True):
+        changed = e.state != state
+        e.state = state
+        e.updated_at = now
+        if state in ACTIVE_STATES:
+            self._active.add(e.mac)
+        else:
+            self._active.discard(e.mac)
+        if notify and changed:
+            for fn in self._listeners:
+                try:
+                    fn(e.mac, e.state, e.target, e.attempts)
+                except Exception as ex:
+                    logging.error(f"[OTA] 狀態通知失敗：{ex}")
+
+    def _backoff(self, attempts):
+        return min(self.retry_max_sec, self.retry_base_sec * (2 ** max(0, attempts - 1)))
+
+    def _fail(self, e, now):
+        self._set_state(e, FAILED, now)
+        e.next_attempt_at = max(now + self._backoff(e.attempts), e.commanded_at + self.cooldown_sec)
+        self.failed += 1
+        logging.warning(
+            f"[OTA] {e.mac} 第 {e.attempts} 次 OTA 逾時（FW={e.fw}, 目標={e.target}），"
+            f"{e.next_attempt_at - now:.0f} 秒後重試"
+        )
+
+    # ---------------- 對外 API ----------------
+    def add_listener(self, fn):
+        """fn(mac, state, target, attempts) 會在狀態改變時被呼叫（持有鎖，請勿在裡面呼叫 tracker）。"""
+        self._listeners.append(fn)
+
+    def restore(self, mac, state, target, attempts=0):
+        """
+        重開機後從裝置紀錄還原。進行中的 OTA 視為剛開始下載（等 timeout_sec 再判定），
+        失敗的照次數重新計算退避，避免重開後對整批裝置馬上再送一次指令。
+        """
+        now = self._clock()
+        with self._lock:
+            e = self._entry(mac)
+            e.target = target
+            e.attempts = int(attempts or 0)
+            if state in ACTIVE_STATES:
+                e.commanded_at = e.started_at = now
+                e.next_attempt_at = now + self.cooldown_sec
+                state = DOWNLOADING
+            elif state == FAILED:
+                e.next_attempt_at = now + self._backoff(e.attempts)
+            elif state not in (IDLE, VERIFIED):
+                return
+            self._set_state(e, state, now, notify=False)
+
+    def observe(self, mac, fw, target):
+        """
+        收到裝置 data frame 時呼叫。
+        回傳 True 代表這次要送 OTA 指令（狀態已轉成 commanded）。
+        """
+        now = self._clock()
+        with self._lock:
+            e = self._entry(mac)
+            e.fw = fw
+
+            if fw == target:
+                if e.state != VERIFIED:
+                    if e.state in ACTIVE_STATES:
+                        self.verified += 1
+                        logging.info(f"[OTA] {mac} 已升級到 {fw}（第 {e.attempts} 次嘗試）")
+                    e.target = target
+                    e.attempts = 0
+                    self._set_state(e, VERIFIED, now)
+                return False
+
+            # 目標版本換了：舊的重試紀錄不再適用
+            if e.target != target and e.state not in ACTIVE_STATES:
+                e.target = target
+                e.attempts = 0
+                e.next_attempt_at = 0.0
+                self._set_state(e, IDLE, now)
+
+            if e.state in ACTIVE_STATES:
+                ref = e.started_at if e.state == DOWNLOADING else e.commanded_at
+                if now - ref >= self.timeout_sec:
+                    self._fail(e, now)
+                return False
+
+            # idle / verified / failed → 看能不能開始新的一次嘗試
+            if now < e.next_attempt_at:
+                return False
+            if len(self._active) >= self.max_concurrent:
+                self.deferred += 1
+                return False
+
+            e.target = target
+            e.attempts += 1
+            e.commanded_at = now
+            e.next_attempt_at = now + self.cooldown_sec
+            self._set_state(e, COMMANDED, now)
+            self.commands += 1
+            return True
+
+    def mark_sent(self, mac):
+        """OTA 指令真的 publish 出去後呼叫：commanded → downloading。"""
+        now = self._clock()
+        with self._lock:
+            e = self._entries.get(mac)
+            if e is not None and e.state == COMMANDED:
+                e.started_at = now
+                self._set_state(e, DOWNLOADING, now)
+
+    def abort(self, mac):
+        """指令沒送出去（例如排程佇列已滿）時呼叫，回到 idle 且不算一次嘗試。"""
+        now = self._clock()
+        with self._lock:
+            e = self._entries.get(mac)
+            if e is not None and e.state in ACTIVE_STATES:
+                e.attempts = max(0, e.attempts - 1)
+                e.next_attempt_at = 0.0
+                self._set_state(e, IDLE, now)
+                self.commands -= 1
+
+    def expire(self):
+        """定期呼叫：把逾時的 commanded/downloading 轉成 failed，釋放下載名額。"""
+        now = self._clock()
+        expired = 0
+        with self._lock:
+            for mac in list(self._active):
+                e = self._entries[mac]
+                ref = e.started_at if e.state == DOWNLOADING else e.commanded_at
+                if now - ref >= self.timeout_sec:
+                    self._fail(e, now)
+                    expired += 1
+        return expired
+
+    def get(self, mac):
+        with self._lock:
+            e = self._entries.get(mac)
+            return e.as_dict() if e else None
+
+    def stats(self):
+        with self._lock:
+            counts = {}
+            for e in self._entries.values():
+                counts[e.state] = counts.get(e.state, 0) + 1
+            return {
+                "devices": len(self._entries),
+                "active": len(self._active),
+                "max_concurrent": self.max_concurrent,
+                "states": counts,
+                "commands": self.commands,
+                "verified": self.verified,
+                "failed": self.failed,
+                "deferred": self.deferred,
+            }
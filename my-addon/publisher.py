@@ -0,0 +1,92 @@
+import collections
+import logging
+import time
+
+import paho.mqtt.client as mqtt
+
+from metrics import REGISTRY
+
+PUBLISHED = REGISTRY.counter("mqtt_batch_messages_total", "批次發佈的訊息數", ("result",))
+BATCH_SECONDS = REGISTRY.histogram("mqtt_batch_publish_seconds", "一整批訊息從送出到全部確認的時間")
+BATCH_RATE = REGISTRY.gauge("mqtt_batch_publish_rate", "最近一批的發佈速率（則/秒）")
+
+
+# ------------------------------------------------------------
+# 📤 retained 訊息批次發佈（discovery config / 清除）
+# ------------------------------------------------------------
+class BatchPublisher:
+    """
+    publish_many(client, [(topic, payload), ...])：整批用同一個 QoS / retain 送出，
+    同時未確認的訊息最多 window 則（滿了就等最舊的一則完成），全部送完後回傳結果。
+      - QoS 1 以 PUBACK 為完成，QoS 0 以寫進 socket 為完成
+      - paho 的 outgoing queue 滿（max_queued_messages）時先等前面的完成再重送，不會丟訊息
+      - 單則超過 timeout 秒沒完成、或 paho 回報錯誤（例如斷線中）就算失敗
+    呼叫端可以用 result["failed"] 決定要不要記錄這次已發佈（失敗的下次整批重送，retained 重送無害）。
+    會阻塞呼叫的 thread，不能在 paho 的網路 thread（on_message 等 callback）裡呼叫。
+    """
+    def __init__(self, qos=1, window=100, timeout=10.0, name="publish"):
+        self.qos = int(qos)
+        self.window = max(1, int(window))
+        self.timeout = float(timeout)
+        self.name = name
+
+    def configure_client(self, client, max_queued=0):
+        """讓 paho 的 in-flight 上限跟 window 一致；max_queued=0 代表不限制 outgoing queue。"""
+        client.max_inflight_messages_set(self.window)
+        client.max_queued_messages_set(int(max_queued))
+
+    def _wait(self, info):
+        try:
+            info.wait_for_publish(self.timeout)
+            return info.is_published()
+        except (ValueError, RuntimeError):
+            return False
+
+    def publish_many(self, client, messages, retain=True):
+        t0 = time.monotonic()
+        inflight = collections.deque()
+        sent = failed = 0
+
+        for topic, payload in messages:
+            while True:
+                info = client.publish(topic, payload, qos=self.qos, retain=retain)
+                if info.rc != mqtt.MQTT_ERR_QUEUE_SIZE:
+                    break
+                # outgoing queue 滿了：等自己最舊的一則完成（沒有的話小睡一下）再重送
+                if inflight:
+                    if self._wait(inflight.popleft()):
+                        sent += 1
+                    else:
+                        failed += 1
+                elif time.monotonic() - t0 > self.timeout:
+                    break
+                else:
+                    time.sleep(0.01)
+            if info.rc not in (mqtt.MQTT_ERR_SUCCESS, mqtt.MQTT_ERR_AGAIN):
+                failed += 1
+                continue
+            inflight.append(info)
+            if len(inflight) >= self.window:
+                if self._wait(inflight.popleft()):
+                    sent += 1
+                else:
+                    failed += 1
+
+        while inflight:
+            if self._wait(inflight.popleft()):
+                sent += 1
+            else:
+                failed += 1
+
+        elapsed = time.monotonic() - t0
+        total = sent + failed
+        rate = round(total / elapsed, 1) if elapsed > 0 else None
+        if total:
+            BATCH_SECONDS.observe(elapsed)
+            PUBLISHED.inc(sent, result="ok")
+            PUBLISHED.inc(failed, result="failed")
+            if rate is not None:
+                BATCH_RATE.set(rate)
+        if failed:
+            logging.warning(f"[{self.name}] {total} 則中 {failed} 則未完成（{elapsed * 1000:.0f} ms）")
+        return {"sent": sent, "failed": failed, "elapsed_ms": round(elapsed * 1000, 1), "rate": rate}
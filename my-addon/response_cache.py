@@ -0,0 +1,87 @@
+import threading
+import time
+from collections import OrderedDict
+
+# ------------------------------------------------------------
+# 🧊 短 TTL 回應快取 + single-flight（同一個 key 同時只算一次）
+# ------------------------------------------------------------
+class _Flight:
+    __slots__ = ("done", "value", "error")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class SingleFlightCache:
+    """
+    get(key, builder)：
+      - 快取內且未過期 → 直接回傳
+      - 已有其他 thread 正在算同一個 key → 等它算完，共用結果（或共用例外）
+      - 否則自己呼叫 builder()，成功才放進快取
+    超過 max_entries 時淘汰最久沒用到的 key（LRU）。
+    """
+    def __init__(self, ttl=5.0, max_entries=64, clock=time.monotonic):
+        self.ttl = float(ttl)
+        self.max_entries = max(1, int(max_entries))
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._items = OrderedDict()   # key -> (expires_at, value)
+        self._flights = {}
+
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    def get(self, key, builder):
+        with self._lock:
+            item = self._items.get(key)
+            if item is not None and item[0] > self._clock():
+                self._items.move_to_end(key)
+                self.hits += 1
+                return item[1]
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+                self.misses += 1
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.value
+
+        try:
+            flight.value = builder()
+        except BaseException as e:
+            flight.error = e
+            raise
+        else:
+            with self._lock:
+                self._items[key] = (self._clock() + self.ttl, flight.value)
+                self._items.move_to_end(key)
+                while len(self._items) > self.max_entries:
+                    self._items.popitem(last=False)
+            return flight.value
+        finally:
+            with self._lock:
+                self._flights.pop(key, None)
+            flight.done.set()
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._items),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "coalesced": self.coalesced,
+            }
@@ -1,6 +1,8 @@
+import functools
 import logging
 import json
 import paho.mqtt.client as mqtt
+from paho.mqtt.subscribeoptions import SubscribeOptions
 import requests
 import os
 import shutil
@@ -8,70 +10,233 @@ import time
 import threading
 import yaml
 import socket
+import signal
+import sys
+from scheduler import BoundedExecutor, DelayedScheduler, KeyedWorkQueue
+from ota_state import OtaTracker
+from ha_client import HAClient
+from ha_states import StateIndex
+from discovery_registry import DiscoveryRegistry, compact_json
+from device_store import DeviceStore
+from ota_index import OtaIndexWatcher
+from ota_artifacts import ArtifactStore, DELTA_FORMAT
+from ingest import IngestPipeline
+from dedup import PayloadDedup, KeyedThrottle
+from publisher import BatchPublisher
+from sharding import ShardFilter, ShardRouter
+from history import HistoryStore, start_history_server
+from metrics import REGISTRY, LogSampler
 
 # ------------------------------------------------------------
 # 🧾 設定日誌格式
 # ------------------------------------------------------------
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(message)s')
 # ------------------------------------------------------------
-# 🔧 先定義功能函式（一定要放在前面）
+# ⚙️ 讀取 HA 傳入的設定 (options.json)
 # ------------------------------------------------------------
-def load_ota_index(path="/ota/ota_index.yaml"):
-    try:
-        with open(path, "r", encoding="utf-8") as f:
-            data = yaml.safe_load(f) or {}
-        fw_list = data.get("firmwares", [])
-        return {fw["id"]: fw for fw in fw_list if "id" in fw}
-    except Exception as e:
-        logging.error(f"[OTA] 載入 ota_index.yaml 失敗：{e}")
-        return {}
+# ZP2_DATA_DIR / HA_BASE_URL / OTA_* 環境變數只給本機測試與 bench/loadtest.py 用，add-on 內一律走預設值
+DATA_DIR = os.environ.get("ZP2_DATA_DIR", "/data")
+with open(os.path.join(DATA_DIR, "options.json"), "r") as f:
+    options = json.load(f)
 
 # ------------------------------------------------------------
-# ⚙️ 讀取 HA 傳入的設定 (options.json)
+# 🧩 分片（ingest_shards > 1 時 launcher 啟動多個 run.py，以環境變數告知自己是第幾片）
 # ------------------------------------------------------------
-with open("/data/options.json", "r") as f:
-    options = json.load(f)
+# 每片只處理 MAC 雜湊到自己的裝置（sharding.HashRing），OTA / discovery / 裝置紀錄都在那一片
+SHARD = ShardFilter(
+    int(os.environ.get("ZP2_SHARD_INDEX", "0")),
+    int(os.environ.get("ZP2_SHARD_COUNT", "1")),
+)
+# MQTT v5 才有 noLocal：不會收到自己發出的 control（v3.1.1 照舊會收到，handle_message 看不是 data 就略過）
+MQTT_PROTOCOL = str(options.get("mqtt_protocol", "3.1.1"))
+if SHARD.enabled and MQTT_PROTOCOL != "5":
+    # 分片時每片都有萬用字元或按裝置的訂閱，沒有 noLocal 會收到自己的 control 與交接訊息
+    logging.warning(f"[shard {SHARD.label()}] ingest_shards > 1 需要 MQTT v5（noLocal），mqtt_protocol 改用 5")
+    MQTT_PROTOCOL = "5"
+
+# ------------------------------------------------------------
+# 📈 指標與 log 取樣（/metrics 由 OTA server 一起輸出，這裡定期寫檔）
+# ------------------------------------------------------------
+REGISTRY.namespace = "zp2"
+if SHARD.enabled:
+    REGISTRY.shard = str(SHARD.index)
+# 每則訊息的 INFO log 每 N 筆只印 1 筆（1 = 全部印）；總數看 /metrics 或定期統計
+LOG_SAMPLER = LogSampler(int(options.get("log_sample_every", 1)))
+CONTROL_SENT = REGISTRY.counter("control_commands_sent_total", "送出的控制指令數", ("reason",))
+CONTROL_DROPPED = REGISTRY.counter("control_commands_dropped_total", "排程到期時工作池已滿、沒送出的控制指令數", ("reason",))
+REDISCOVERIES = REGISTRY.counter("rediscoveries_total", "執行 rediscover 的次數", ("result",))
+DISCOVERY_PUBLISHES = REGISTRY.counter("discovery_publishes_total", "發佈的 discovery 訊息數", ("kind",))
 
 # 從環境變數取得 Long-Lived Token
 TOPICS = options.get("mqtt_topics", "+/+/data,+/+/control").split(",")
+# 分片時第 0 片訂閱 TOPICS 並把新裝置轉發給負責的分片，其他片只訂閱自己裝置的 topic
+ROUTER = ShardRouter(SHARD, TOPICS)
 MQTT_BROKER = options.get("mqtt_broker", "core-mosquitto")
 MQTT_PORT = int(options.get("mqtt_port", 1883))
 MQTT_USERNAME = options.get("mqtt_username", "")
 MQTT_PASSWORD = options.get("mqtt_password", "")
 SUPERVISOR_TOKEN = os.environ.get("SUPERVISOR_TOKEN")
-BASE_URL = "http://supervisor/core/api"
-
-HEADERS = {
-    "Authorization": f"Bearer {SUPERVISOR_TOKEN}",
-    "Content-Type": "application/json",
-}
+BASE_URL = os.environ.get("HA_BASE_URL", "http://supervisor/core/api")
+
+# 所有 HA REST 呼叫共用一個 client：連線池、同時請求上限、退避重試、斷路器
+HA_CLIENT = HAClient.shared(
+    BASE_URL, SUPERVISOR_TOKEN,
+    max_concurrency=int(options.get("ha_api_max_concurrency", 4)),
+    retries=int(options.get("ha_api_retries", 2)),
+)
+# HA states 只整份載入一次，之後靠 websocket 事件（或 TTL）更新
+STATE_INDEX = StateIndex.shared(BASE_URL, SUPERVISOR_TOKEN, ttl=float(options.get("ha_states_ttl", 30)), client=HA_CLIENT)
+# 裝置紀錄（SQLite，存在 /data）：最後 FW、sensor 欄位、discovery 指紋、OTA 狀態，重開後接續
+DEVICE_STORE = DeviceStore(os.path.join(DATA_DIR, "devices.db"))
+# 已發佈的 discovery 紀錄（存在裝置紀錄裡，重開後仍可只發差異；舊的 JSON 會匯入一次）
+DISCOVERY_REGISTRY = DiscoveryRegistry(os.path.join(DATA_DIR, "discovery_registry.json"), store=DEVICE_STORE)
 # ------------------------------------------------------------
 # 🌐 自動偵測 IP + 固定 8088
 # ------------------------------------------------------------
 OTA_IP = options.get("local_ip")
-OTA_BASE_URL = f"http://{OTA_IP}:8088"
+OTA_PORT = int(os.environ.get("OTA_PORT", "8088"))
+OTA_BASE_URL = f"http://{OTA_IP}:{OTA_PORT}"
 logging.info(f"[OTA] 使用 ota_ip={OTA_IP} → OTA_BASE_URL={OTA_BASE_URL}")
+
+def firmware_url(fw_entry):
+    rel_path = str(fw_entry.get("path", "")).lstrip("/")
+    return f"{OTA_BASE_URL}/{rel_path}"
+
+def resolve_firmware(device_name, device_mac, message_json):
+    """
+    依 model / 硬體版本 / MAC 分組找出這台裝置的目標韌體。
+    回傳 (version, fw_entry)；沒有對應的 profile 時回 (None, None)。
+    """
+    fw_entry = OTA_INDEX.current.resolve(device_name, device_mac, message_json.get("HW"))
+    if not fw_entry:
+        return None, None
+    return fw_entry.get("version"), fw_entry
+
+def delta_for_device(device_name, current_fw, fw_entry):
+    """裝置目前的 FW 在 ota_index 裡、而且 OTA server 已產生到目標版本的差分時，回傳 (URL, 基底 entry)。"""
+    if not OTA_DELTA_UPDATES or current_fw is None:
+        return None
+    base = OTA_INDEX.current.find_version(device_name, current_fw)
+    if not base:
+        return None
+    hit = OTA_ARTIFACTS.delta_for(base.get("sha256"), fw_entry.get("sha256"))
+    if hit is None:
+        return None
+    path, _ = hit
+    return f"{OTA_BASE_URL}/delta/{os.path.basename(path)}", base
+
+def build_ota_payload(fw_entry, device_name="ZP2", current_fw=None):
+    """
+    OTA 指令內容；開啟 ota_advertise_integrity 時一併帶上載入 index 時算好的 SHA-256 / size。
+    開啟 ota_delta_updates 且有差分時改給差分 URL，並一定帶上基底與目標的雜湊讓裝置驗證 patch 結果。
+    """
+    delta = delta_for_device(device_name, current_fw, fw_entry)
+    if delta is not None:
+        url, base = delta
+        OTA_COMMANDS.inc(kind="delta")
+        return json.dumps({
+            "Ota": url,
+            "Delta": DELTA_FORMAT,
+            "Base": base["sha256"],
+            "Sha256": fw_entry["sha256"],
+            "Size": fw_entry["size"],
+        }, separators=(",", ":"))
+    OTA_COMMANDS.inc(kind="full")
+    cmd = {"Ota": firmware_url(fw_entry)}
+    if OTA_ADVERTISE_INTEGRITY and fw_entry.get("sha256"):
+        cmd["Sha256"] = fw_entry["sha256"]
+        cmd["Size"] = fw_entry["size"]
+    return json.dumps(cmd, separators=(",", ":"))
 # ------------------------------------------------------------
 # 📦 設定要用哪個 Firmware Profile
 # ------------------------------------------------------------
 ZP2_FW_PROFILE = options.get("zp2_fw_profile", "zp2_5_0_20251205_s01")
 ZP2_OUTBOUND_SETUP = bool(options.get("zp2_outbound_setup", False))
+# sensor：每個欄位一個 homeassistant/sensor/.../config（原本的做法）
+# device：整台裝置一個 homeassistant/device/<dev>_<mac>/config（HA 2024.11 起支援）
+DISCOVERY_MODE = str(options.get("discovery_mode", "sensor")).lower()
+# ------------------------------------------------------------
+# 🧵 背景工作池 / 延遲排程（取代每則訊息開一條 thread）
 # ------------------------------------------------------------
-# 📂 讀取 ota_index.yaml
+WORKER_THREADS = int(options.get("worker_threads", 4))
+WORKER_QUEUE_SIZE = int(options.get("worker_queue_size", 2000))
+SCHEDULER_MAX_PENDING = int(options.get("scheduler_max_pending", 10000))
+
+EXECUTOR = BoundedExecutor(WORKER_THREADS, WORKER_QUEUE_SIZE, name="zp2-worker")
+SCHEDULER = DelayedScheduler(EXECUTOR, SCHEDULER_MAX_PENDING, name="zp2-scheduler")
+# discovery / 清除整批送出：QoS、同時未確認數量（window）、paho outgoing queue 上限（0 = 不限）
+PUBLISHER = BatchPublisher(
+    qos=int(options.get("publish_qos", 1)),
+    window=int(options.get("publish_window", 100)),
+    name="rediscover",
+)
+MQTT_MAX_QUEUED = int(options.get("mqtt_max_queued", 0))
+# rediscover 依裝置合併：debounce 期間的請求只做一次、同一台不會同時跑兩個、全部同時最多 N 台
+REDISCOVERY = KeyedWorkQueue(
+    SCHEDULER,
+    debounce_sec=float(options.get("rediscover_debounce_sec", 5)),
+    max_concurrent=int(options.get("rediscover_max_concurrent", 2)),
+    name="rediscover",
+)
 # ------------------------------------------------------------
-OTA_INDEX = load_ota_index()
-CURRENT_FW = OTA_INDEX.get(ZP2_FW_PROFILE)
+# 📶 每台裝置 OTA 狀態（去重 / 退避 / 同時下載上限）
+# ------------------------------------------------------------
+OTA_TRACKER = OtaTracker(
+    # 同時下載上限是整個 add-on 的量，分片時平均分給每一片
+    max_concurrent=max(1, int(options.get("ota_max_concurrent", 10)) // SHARD.count),
+    timeout_sec=float(options.get("ota_timeout_sec", 600)),
+    retry_base_sec=float(options.get("ota_retry_base_sec", 60)),
+    retry_max_sec=float(options.get("ota_retry_max_sec", 3600)),
+    cooldown_sec=float(options.get("ota_cooldown_sec", 30)),
+)
+
+def _device_key(device_name, device_mac):
+    return f"{str(device_name).lower()}_{str(device_mac).lower()}"
+
+def _warm_start_ota():
+    """從裝置紀錄還原 OTA 狀態；之後每次狀態改變都寫回裝置紀錄。"""
+    restored = 0
+    for _, rec in DEVICE_STORE.items():
+        if rec.get("ota_state") and rec.get("mac") and SHARD.owns_mac(rec["mac"]):
+            OTA_TRACKER.restore(rec["mac"], rec["ota_state"], rec.get("ota_target"), rec.get("ota_attempts"))
+            restored += 1
+    if restored:
+        logging.info(f"[OTA] 從裝置紀錄還原 {restored} 台的 OTA 狀態")
+
+    def _persist(mac, state, target, attempts):
+        DEVICE_STORE.update(
+            _device_key("ZP2", mac), name="ZP2", mac=mac,
+            ota_state=state, ota_target=target, ota_attempts=attempts, ota_updated_at=time.time(),
+        )
+    OTA_TRACKER.add_listener(_persist)
 
-if not CURRENT_FW:
-    logging.error(f"[OTA] 找不到 FW profile：{ZP2_FW_PROFILE}，停用 OTA 功能")
-    ZP2_FW_VERSION = None
-    ZP2_FW_URL = None
+_warm_start_ota()
+# 裝置紀錄裡屬於自己的裝置連上就直接訂閱，不必等第 0 片轉發
+ROUTER.adopt(rec["mac"] for _, rec in DEVICE_STORE.items() if rec.get("mac"))
+# ------------------------------------------------------------
+# 📂 讀取 ota_index.yaml（檔案變更時自動重載，不用重開 add-on）
+# ------------------------------------------------------------
+OTA_INDEX_PATH = os.environ.get("OTA_INDEX", "/ota/ota_index.yaml")
+OTA_ROOT = os.environ.get("OTA_ROOT", "/ota/zp2_fw")
+OTA_ADVERTISE_INTEGRITY = bool(options.get("ota_advertise_integrity", False))
+# 差分 OTA 需要裝置端支援 bsdiff patch，預設關閉；gzip 由 OTA server 依 Accept-Encoding 自動選擇
+OTA_DELTA_UPDATES = bool(options.get("ota_delta_updates", False))
+# gzip / 差分檔由 OTA server 產生，這裡只查詢
+OTA_ARTIFACTS = ArtifactStore(os.environ.get("OTA_ARTIFACT_DIR", os.path.join(DATA_DIR, "ota_artifacts")))
+OTA_COMMANDS = REGISTRY.counter("ota_commands_total", "送出的 OTA 指令數（完整 / 差分）", ("kind",))
+OTA_INDEX = OtaIndexWatcher(
+    OTA_INDEX_PATH,
+    default_profiles={"ZP2": ZP2_FW_PROFILE},
+    interval=float(options.get("ota_index_poll_sec", 5)),
+    root_dir=OTA_ROOT,
+)
+DEFAULT_FW = OTA_INDEX.current.resolve("ZP2", "")
+if not DEFAULT_FW:
+    logging.error(f"[OTA] 找不到 FW profile：{ZP2_FW_PROFILE}，未設定 rollout 的 ZP2 將停用 OTA")
 else:
-    ZP2_FW_VERSION = CURRENT_FW.get("version")
-    rel_path = CURRENT_FW.get("path", "").lstrip("/")
-    ZP2_FW_URL = f"{OTA_BASE_URL}/{rel_path}"
     logging.info(
-        f"[OTA] 使用 profile={ZP2_FW_PROFILE}, version={ZP2_FW_VERSION}, url={ZP2_FW_URL}"
+        f"[OTA] 使用 profile={ZP2_FW_PROFILE}, version={DEFAULT_FW.get('version')}, "
+        f"url={firmware_url(DEFAULT_FW)}, sha256={DEFAULT_FW.get('sha256')}, size={DEFAULT_FW.get('size')}"
     )
 
 # ------------------------------------------------------------
@@ -92,6 +257,92 @@ unit_conditions = {
     "rpm": "rpm"
 }
 
+# ------------------------------------------------------------
+# 📊 感測值歷史（/history）
+# ------------------------------------------------------------
+# 記憶體上限 ≈ history_max_series × HISTORY.bytes_per_series()（預設約 28 MB）；0 = 不記錄
+# 分片時每片各記自己的裝置，上限平均分掉；只有第 0 片在 history_port 對外，
+# 其他片只聽 127.0.0.1:history_port + 分片編號，由第 0 片代查 / 合併清單（config.yaml 只需開放一個 port）
+# /history 沒有認證：config.yaml 預設不把 history_port 映射到 host，容器的 0.0.0.0 只有 add-on 內部網路連得到
+HISTORY = HistoryStore.shared(
+    raw_points=int(options.get("history_raw_points", 120)),
+    max_series=int(options.get("history_max_series", 10000)) // SHARD.count,
+)
+HISTORY_PORT = int(options.get("history_port", 8100))
+HISTORY_SERVER = None
+REGISTRY.gauge("history_series", "歷史緩衝區中的 series 數", fn=lambda: HISTORY.stats()["series"])
+REGISTRY.gauge("history_bytes", "歷史緩衝區已使用的 bytes（估計）", fn=lambda: HISTORY.stats()["bytes"])
+REGISTRY.counter(
+    "history_samples_total", "寫入歷史緩衝區的數值", ("result",),
+    fn=lambda: {
+        ("ok",): HISTORY.stats()["samples"],
+        ("out_of_order",): HISTORY.stats()["out_of_order"],
+    },
+)
+
+def _history_locate(device_mac):
+    """/history（第 0 片）查到別片的裝置時，回傳負責那一片的 port。"""
+    owner = SHARD.ring.owner(device_mac)
+    return None if owner == SHARD.index else HISTORY_PORT + owner
+
+# ------------------------------------------------------------
+# 📥 MQTT 收訊管線（on_message 只排隊，解析 / 分派在 worker）
+# ------------------------------------------------------------
+MQTT_CLIENT = None  # main() 建立後設定，INGEST worker 用它回發訊息
+# 同一個 topic 內容沒變的訊息不再解析、只走輕量處理（見 handle_repeated_message）；超過 max_age 仍會完整處理一次
+PAYLOAD_DEDUP = PayloadDedup(max_age=float(options.get("dedup_max_age_sec", 60)))
+# {"Update":"1"} 回覆每台裝置至少間隔這麼久
+CONTROL_THROTTLE = KeyedThrottle(min_interval=float(options.get("control_reply_min_interval_sec", 10)))
+INGEST = IngestPipeline(
+    lambda topic, message_json: handle_message(MQTT_CLIENT, topic, message_json),
+    workers=int(options.get("ingest_workers", 2)),
+    capacity=int(options.get("ingest_queue_size", 10000)),
+    batch_size=int(options.get("ingest_batch_size", 100)),
+    name="ingest",
+    dedup=PAYLOAD_DEDUP,
+    # 內容沒變的訊息仍要回覆控制指令、更新 last_seen 與歷史
+    on_duplicate=lambda topic, message_json: handle_repeated_message(MQTT_CLIENT, topic, message_json),
+)
+INGEST.register_metrics(REGISTRY)
+REGISTRY.counter(
+    "control_replies_throttled_total", "因節流沒有送出的 Update 回覆",
+    fn=lambda: CONTROL_THROTTLE.stats()["throttled"],
+)
+REGISTRY.gauge("ota_active_downloads", "目前 OTA 進行中的裝置數", fn=lambda: OTA_TRACKER.stats()["active"])
+REGISTRY.gauge(
+    "ota_devices", "各 OTA 狀態的裝置數", ("state",),
+    fn=lambda: {(k,): v for k, v in OTA_TRACKER.stats()["states"].items()},
+)
+REGISTRY.gauge("worker_queue_depth", "工作池佇列長度", fn=lambda: EXECUTOR.stats()["queue_depth"])
+REGISTRY.gauge("scheduler_pending", "排程器等待中的工作數", fn=lambda: SCHEDULER.stats()["pending"])
+REGISTRY.counter(
+    "scheduler_dropped_total", "到期時工作池已滿而沒有執行的排程工作數", fn=lambda: SCHEDULER.stats()["dropped"],
+)
+REGISTRY.counter(
+    "shard_messages_total", "依 MAC 分片判斷的訊息數", ("result",),
+    fn=lambda: {("owned",): SHARD.stats()["owned"], ("skipped",): SHARD.stats()["skipped"]},
+)
+REGISTRY.counter(
+    "shard_handoff_messages_total", "第 0 片轉發 / 其他片收到轉發 / 轉發與直接訂閱重疊而丟掉的新裝置訊息數", ("direction",),
+    fn=lambda: {
+        ("forwarded",): ROUTER.stats()["forwarded"],
+        ("received",): ROUTER.stats()["handoffs"],
+        ("overlap",): ROUTER.stats()["overlaps"],
+    },
+)
+REGISTRY.gauge("shard_device_subscriptions", "按裝置訂閱的 MAC 數（第 1 片以後）", fn=lambda: ROUTER.stats()["subscribed"])
+REGISTRY.gauge("rediscover_pending", "等待 rediscover 的裝置數", fn=lambda: REDISCOVERY.stats()["pending"])
+REGISTRY.counter(
+    "rediscover_requests_collapsed_total", "被合併掉的 rediscover 請求數",
+    fn=lambda: REDISCOVERY.stats()["collapsed"],
+)
+REGISTRY.gauge("devices_known", "裝置紀錄中的裝置數", fn=lambda: DEVICE_STORE.stats()["devices"])
+REGISTRY.gauge("ha_states_entities", "本地 HA state 索引的實體數", fn=lambda: STATE_INDEX.stats()["entities"])
+REGISTRY.gauge(
+    "ha_api_circuit_open", "HA API 斷路器是否開啟（1 = 暫停呼叫 HA）",
+    fn=lambda: int(HA_CLIENT.breaker.state != "closed"),
+)
+
 # ------------------------------------------------------------
 # 🔁 檢查是否需要回傳控制指令(for ZS2)
 # ------------------------------------------------------------
@@ -106,92 +357,189 @@ def check_and_respond_control(client, topic, message_json):
         message_json.get("MODEL") is not None
     )
 
-    if has_required_payload:
+    if has_required_payload and CONTROL_THROTTLE.allow(f"{device_name}/{device_mac}"):
         control_topic = f"{device_name}/{device_mac}/control"
         control_payload = json.dumps({ "Update": "1" })
         client.publish(control_topic, control_payload)
-        logging.info(f"Sent control message to {control_topic}: {control_payload}")
+        CONTROL_SENT.inc(reason="update")
+        LOG_SAMPLER.info("control", f"Sent control message to {control_topic}: {control_payload}")
 
 # ------------------------------------------------------------
 # 🔗 MQTT 連線成功
 # ------------------------------------------------------------
-def on_connect(client, userdata, flags, rc):
-    logging.info(f"Connected to MQTT broker with result code {rc}")
-    for topic in TOPICS:
+def _subscribe(client, topic):
+    if MQTT_PROTOCOL == "5":
+        client.subscribe(topic, options=SubscribeOptions(qos=0, noLocal=True))
+    else:
         client.subscribe(topic)
-        logging.info(f"Subscribed to topic: {topic}")
+
+def on_connect(client, userdata, flags, rc, properties=None):
+    logging.info(f"Connected to MQTT broker with result code {rc}")
+    ROUTER.bind(client.publish, lambda topic: _subscribe(client, topic))
+    topics = ROUTER.subscriptions()
+    for topic in topics:
+        _subscribe(client, topic)
+        if "+" in topic or "#" in topic:
+            logging.info(f"Subscribed to topic: {topic}")
+    if ROUTER.enabled and not ROUTER.front:
+        logging.info(f"[shard {SHARD.label()}] 按裝置訂閱 {ROUTER.stats()['subscribed']} 台裝置")
+    ROUTER.on_connect()
 
 # ------------------------------------------------------------
 # 📨 處理 MQTT 訊息
 # ------------------------------------------------------------
 def on_message(client, userdata, msg):
-    payload = msg.payload.decode()
-    # logging.info(f"Received message on {msg.topic}: {payload}")
+    # 在 paho 的 network loop thread 上：只放進佇列，解析與處理交給 INGEST worker
+    # 分片時不屬於自己的裝置只看 topic 就丟掉（第 0 片順便轉發給還沒認領的分片）
+    topic = ROUTER.route(msg.topic, msg.payload)
+    if topic is not None:
+        INGEST.offer(topic, msg.payload)
 
-    try:
-        # 先解析 JSON
-        message_json = json.loads(payload)
-        
-        # 自動回應
-        check_and_respond_control(client, msg.topic, message_json)
-        
-        # 提取 deviceName 和 deviceMac
-        topic_parts = msg.topic.split('/')
-        if len(topic_parts) < 3:
-            logging.warning(f"Invalid topic format: {msg.topic}")
-            return
-        device_name = topic_parts[0]    # "ZP2"
-        device_mac = topic_parts[1]     # number
-        message_type = topic_parts[2]   # "data" or "control"
+def handle_repeated_message(client, topic, message_json):
+    """INGEST worker 呼叫：內容跟上一筆一樣（PayloadDedup 判定），message_json 是上一筆解析好的 dict"""
+    _handle_every_frame(client, topic, message_json)
 
-        fw = message_json.get("FW")
+def _handle_every_frame(client, topic, message_json):
+    """
+    每一筆訊息（含重複的）都要做的便宜工作：控制回覆、裝置紀錄。
+    是 ZP2 data frame 就回傳 (device_name, device_mac, fw)，否則回傳 None。
+    """
+    # 自動回應
+    check_and_respond_control(client, topic, message_json)
+
+    # 提取 deviceName 和 deviceMac
+    topic_parts = topic.split('/')
+    if len(topic_parts) < 3:
+        logging.warning(f"Invalid topic format: {topic}")
+        return None
+    device_name = topic_parts[0]    # "ZP2"
+    device_mac = topic_parts[1]     # number
+    message_type = topic_parts[2]   # "data" or "control"
+
+    fw = message_json.get("FW")
+
+    if device_name != "ZP2" or message_type != "data":
+        return None
+
+    # 只更新記憶體，定期整批寫回 /data
+    DEVICE_STORE.touch(_device_key(device_name, device_mac), device_name, device_mac, fw, sorted(message_json))
+    return device_name, device_mac, fw
+
+def handle_message(client, topic, message_json):
+    """INGEST worker 呼叫：payload 已解析成 dict（解析失敗的在 ingest 就記錄並丟掉）"""
+    # logging.info(f"Received message on {topic}: {message_json}")
+    frame = _handle_every_frame(client, topic, message_json)
+    if frame is None:
+        return
+    device_name, device_mac, fw = frame
+    # 歷史只記內容有變的：重複的 frame（含分片轉發與直接訂閱重疊的那幾筆）不會重複記點
+    HISTORY.record(device_mac, message_json)
+
+    # 以下是 OTA 判斷 / Discovery 等比較重的處理，重複的內容在 max_age 內不再跑
+    if fw is None:
+        LOG_SAMPLER.info("no_fw", f"[ZP2] {device_name}/{device_mac} payload 無 FW，跳過")
+        return
+
+    target_version, target_fw = resolve_firmware(device_name, device_mac, message_json)
+    if target_version is None:
+        LOG_SAMPLER.info("no_profile", f"[ZP2] {device_name}/{device_mac} 沒有對應的 FW profile，跳過 OTA")
+        return
 
-        if device_name != "ZP2" or message_type != "data":
+    if fw != target_version:
+        # 同一台裝置每次嘗試只送一次 OTA（下載中、退避中、名額滿都先跳過）
+        if not OTA_TRACKER.observe(device_mac, fw, target_version):
             return
-        
-        if fw is None:
-            logging.info(f"[ZP2] {device_name}/{device_mac} payload 無 FW，跳過")
+        control_topic = f"{device_name}/{device_mac}/control"
+        ota_payload = build_ota_payload(target_fw, device_name, fw)
+        scheduled = send_later(
+            client, control_topic, ota_payload, fw, 3.0, "OTA",  # 3.0 是延遲秒數
+            on_sent=lambda: OTA_TRACKER.mark_sent(device_mac),
+            # 到期時工作池滿、指令沒送出：放掉 OTA 名額，下一筆 data 再試
+            on_dropped=lambda: OTA_TRACKER.abort(device_mac),
+        )
+        if not scheduled:
+            OTA_TRACKER.abort(device_mac)
             return
-
-        if fw != ZP2_FW_VERSION:
+    else:
+        OTA_TRACKER.observe(device_mac, fw, target_version)
+        LOG_SAMPLER.info("fw_ok", f"[ZP2] FW({fw}) == 設定({target_version})，無需更新")
+        if ZP2_OUTBOUND_SETUP:
             control_topic = f"{device_name}/{device_mac}/control"
-            ota_payload = json.dumps({"Ota": ZP2_FW_URL}, separators=(",", ":"))
-            threading.Thread(
-                target=send_later,
-                args=(client, control_topic, ota_payload, fw, 3.0, "OTA"),  # 最後的 1.0 是延遲秒數
-                daemon=True,
-            ).start()
-        else:
-            logging.info(f"[ZP2] FW({fw}) == 設定({ZP2_FW_VERSION})，無需更新")
-            if ZP2_OUTBOUND_SETUP:
-                control_topic = f"{device_name}/{device_mac}/control"
-                ota_payload = json.dumps({"System":"reset"}, separators=(",", ":"))
-                threading.Thread(
-                    target=send_later,
-                    args=(client, control_topic, ota_payload, fw, 3.0, "reset"),  # 最後的 1.0 是延遲秒數
-                    daemon=True,
-                ).start()
-            return
+            ota_payload = json.dumps({"System":"reset"}, separators=(",", ":"))
+            send_later(client, control_topic, ota_payload, fw, 3.0, "reset")  # 3.0 是延遲秒數
+        return
 
-        # # "ZP2" # number #"Action"
-        threading.Thread(
-            target=clear_and_rediscover,
-            args=(client, device_name, device_mac, message_json),
-            daemon=True
-        ).start()
+    # # "ZP2" # number #"Action"
+    REDISCOVERY.submit(
+        _device_key(device_name, device_mac), clear_and_rediscover, client, device_name, device_mac, message_json
+    )
 
-    except json.JSONDecodeError:
-        logging.error(f"Failed to decode payload: {payload}")
-    except Exception as e:
-        logging.error(f"Error processing message: {e}")
+def send_later(client, control_topic, ota_payload, fw, delay_sec=1.0, reason="OTA", on_sent=None, on_dropped=None):
+    """
+    延遲一段時間再送控制指令 (OTA 或 System reset 等)；交給排程器，不另開 thread。
+    回傳 True 只代表排進去了；到期時工作池滿沒送出的會記 log 並呼叫 on_dropped()。
+    """
+    def _dropped():
+        CONTROL_DROPPED.inc(reason=reason)
+        logging.warning(f"[ZP2] ({reason}) 工作池已滿，{control_topic} 的控制指令沒有送出 (FW={fw})")
+        if on_dropped:
+            on_dropped()
+
+    return SCHEDULER.call_later(
+        delay_sec, _publish_control, client, control_topic, ota_payload, fw, delay_sec, reason, on_sent,
+        on_reject=_dropped,
+    )
 
-def send_later(client, control_topic, ota_payload, fw, delay_sec=1.0, reason="OTA"):
-    """延遲一段時間再送控制指令 (OTA 或 System reset 等)"""
-    time.sleep(delay_sec)
+def _publish_control(client, control_topic, ota_payload, fw, delay_sec, reason, on_sent=None):
     client.publish(control_topic, ota_payload)
+    CONTROL_SENT.inc(reason=reason)
+    if on_sent:
+        on_sent()
+    LOG_SAMPLER.info(
+        reason, f"[ZP2] ({reason}) 延遲 {delay_sec} 秒後發送到 {control_topic}: {ota_payload} (FW={fw})"
+    )
+
+def log_worker_stats():
+    """定期印出工作池 / 排程器的 backpressure 統計"""
+    ex = EXECUTOR.stats()
+    sc = SCHEDULER.stats()
+    ota = OTA_TRACKER.stats()
+    logging.info(
+        f"[worker] busy={ex['busy']}/{ex['workers']} queue={ex['queue_depth']}/{ex['queue_max']} "
+        f"max_depth={ex['max_depth']} rejected={ex['rejected']} failed={ex['failed']} | "
+        f"[scheduler] pending={sc['pending']}/{sc['pending_max']} rejected={sc['rejected']} "
+        f"dropped={sc['dropped']} skipped_ticks={sc['skipped_ticks']} | "
+        f"[OTA] active={ota['active']}/{ota['max_concurrent']} states={ota['states']} "
+        f"deferred={ota['deferred']}"
+    )
+    rd = REDISCOVERY.stats()
     logging.info(
-        f"[ZP2] ({reason}) 延遲 {delay_sec} 秒後發送到 {control_topic}: {ota_payload} (FW={fw})"
+        f"[rediscover] pending={rd['pending']} running={rd['running']} waiting={rd['waiting']} "
+        f"executed={rd['executed']} collapsed={rd['collapsed']} failed={rd['failed']} rejected={rd['rejected']} "
+        f"deferred={rd['deferred']}"
+    )
+    ing = INGEST.stats()
+    logging.info(
+        f"[ingest] depth={ing['depth']}/{ing['capacity']} max_depth={ing['max_depth']} "
+        f"received={ing['received']} processed={ing['processed']} overflow={ing['overflow']} "
+        f"parse_errors={ing['parse_errors']} handler_errors={ing['handler_errors']} "
+        f"duplicates={ing['duplicates']} control_throttled={CONTROL_THROTTLE.stats()['throttled']} | "
+        f"queue p95={ing['queue']['p95_ms']}ms parse p95={ing['parse']['p95_ms']}ms "
+        f"dispatch p95={ing['dispatch']['p95_ms']}ms max={ing['dispatch']['max_ms']}ms"
+    )
+    if SHARD.enabled:
+        sh = SHARD.stats()
+        rt = ROUTER.stats()
+        logging.info(
+            f"[shard {sh['shard']}] owned={sh['owned']} skipped={sh['skipped']} "
+            f"per_device_subscribe={rt['enabled']} subscribed={rt['subscribed']} claimed={rt['claimed']} "
+            f"forwarded={rt['forwarded']} handoffs={rt['handoffs']} overlaps={rt['overlaps']}"
+        )
+    ha = HA_CLIENT.stats()
+    latency = " ".join(
+        f"{ep} n={v['count']} p95={v['p95_ms']}ms" for ep, v in ha["endpoints"].items() if v["count"]
     )
+    logging.info(f"[ha-api] breaker={ha['breaker']} opens={ha['breaker_opens']} {latency}")
 
 
 # ------------------------------------------------------------
@@ -228,6 +576,64 @@ def generate_mqtt_discovery_textconfig(device_name, device_mac, sensor_type, sen
 
     return config
 # ------------------------------------------------------------
+# 🏗️ 產生裝置層級 MQTT Discovery（discovery_mode: device）
+# ------------------------------------------------------------
+DISCOVERY_ORIGIN = {"name": "ZP2 integration"}
+# registry 裡用「device topic#元件 id」記錄每個元件，才知道下次哪些元件要移除（不會真的發佈）
+COMPONENT_SEP = "#"
+
+@functools.lru_cache(maxsize=1024)
+def _component_template(model, sensor_name):
+    """同一個 model 的同一個欄位，元件設定都一樣（unique_id 之外），算一次就好。"""
+    cmp = {
+        "p": "sensor",
+        "name": sensor_name,
+        "expire_after": 300,
+        "value_template": f"{{{{ value_json.{sensor_name} }}}}",
+    }
+    if sensor_name in unit_conditions:
+        cmp["unit_of_measurement"] = unit_conditions[sensor_name]
+    return cmp
+
+def device_discovery_topic_for(device_name, device_mac):
+    return f"homeassistant/device/{str(device_name).lower()}_{str(device_mac).lower()}/config"
+
+def generate_device_discovery_payloads(device_name, device_mac, sensor_names, format_version):
+    """
+    回傳 {device topic: 整台裝置的 config, "device topic#元件": 元件 config, ...}。
+    元件的 unique_id 跟 sensor 模式相同，兩種模式切換時 HA 的 entity 會沿用。
+    """
+    topic = device_discovery_topic_for(device_name, device_mac)
+    components = {}
+    for sensor in sensor_names:
+        cmp = dict(_component_template(device_name, sensor))
+        cmp["unique_id"] = f"{device_name}_{device_mac}_{sensor}"
+        components[str(sensor).lower()] = cmp
+    config = {
+        "device": {
+            "identifiers": f"{device_name}_{device_mac}",
+            "name": f"{device_name}_{device_mac}",
+            "model": device_name,
+            "manufacturer": device_name,
+            "hw_version": str(format_version) if format_version else "unknown",
+        },
+        "origin": DISCOVERY_ORIGIN,
+        "state_topic": f"{device_name}/{device_mac}/data",
+        "components": components,
+    }
+    payloads = {topic: compact_json(config)}
+    for cmp_id, cmp in components.items():
+        payloads[f"{topic}{COMPONENT_SEP}{cmp_id}"] = compact_json(cmp)
+    return payloads
+
+def _with_removed_components(payload, removed_ids):
+    """HA 規定：要移除的元件只留 platform（{"p": "sensor"}），整份 config 再發一次。"""
+    config = json.loads(payload)
+    for cmp_id in removed_ids:
+        config["components"].setdefault(cmp_id, {"p": "sensor"})
+    return compact_json(config)
+
+# ------------------------------------------------------------
 # 🔔 延遲 清除註冊 & 重新註冊
 # ------------------------------------------------------------
 def clear_and_rediscover(client, device_name, device_mac, message_json):
@@ -240,38 +646,114 @@ def clear_and_rediscover(client, device_name, device_mac, message_json):
     #     data_sensors.pop(k, None)
 
     format_version = data_sensors.get("FW")
+    device_key = _device_key(device_name, device_mac)
+
+    # ① 產生這次應該存在的 discovery（topic → 精簡 JSON）
+    if DISCOVERY_MODE == "device":
+        payloads = generate_device_discovery_payloads(device_name, device_mac, data_sensors, format_version)
+    else:
+        payloads = {}
+        for sensor in data_sensors:
+            cfg = generate_mqtt_discovery_textconfig(
+                device_name, device_mac, "data", sensor, format_version
+            )
+            payloads[discovery_topic_for(device_name, device_mac, cfg["name"])] = compact_json(cfg)
+
+    # ② 跟上次發佈的內容比對，只處理差異
+    stale = []
+    if DISCOVERY_REGISTRY.get(device_key) is None:
+        # 沒有紀錄（第一次看到這台）：從 HA 找出殘留的舊 entity，只清掉這次沒有的
+        stale = find_stale_discovery(device_name, device_mac, keep=payloads)
+        if stale is None:
+            # 查不到 HA 就不知道要清哪些，先不發佈也不記錄，稍後整輪重來
+            _retry_rediscover(client, device_name, device_mac, message_json)
+            return
+    added, changed, removed = DISCOVERY_REGISTRY.diff(device_key, payloads)
+    # 「topic#元件」只是紀錄：移除的元件要寫進 device config，其餘不發佈
+    removed_components = {}
+    for t in removed:
+        if COMPONENT_SEP in t:
+            topic, cmp_id = t.split(COMPONENT_SEP, 1)
+            removed_components.setdefault(topic, []).append(cmp_id)
+    clears = sorted((set(stale) | set(removed)) - {t for t in removed if COMPONENT_SEP in t})
+    publishes = [t for t in added + changed if COMPONENT_SEP not in t]
+
+    if not (publishes or clears):
+        REDISCOVERIES.inc(result="unchanged")
+        LOG_SAMPLER.info("rediscover_skip", f"[rediscover] {device_key} discovery 無變化，跳過")
+        return
 
-    # ① 清除舊的 discovery
-    clear_discovery_for_device(client, device_name, device_mac)
-
-    # ② 等一小下，給 HA 時間處理
-    time.sleep(0.7)
-
-    # ③ 再發新的 discovery
-    discovery_configs = []
+    # ③ 清除與發佈合成一批送出（同一個 topic 不會先清再發，不需要等 HA 處理清除）
+    batch = [(topic, "") for topic in clears]
+    for topic in publishes:
+        payload = payloads[topic]
+        if topic in removed_components:
+            payload = _with_removed_components(payload, removed_components[topic])
+        batch.append((topic, payload))
+    for topic, payload in batch:
+        logging.debug(f"[rediscover] {'publish' if payload else 'clear'} {topic}")
+    result = PUBLISHER.publish_many(client, batch)
+    DISCOVERY_PUBLISHES.inc(len(clears), kind="clear")
+    DISCOVERY_PUBLISHES.inc(len(publishes), kind="config")
+
+    if result["failed"]:
+        # 沒全部送達就不記錄，下次 rediscover 會整批重送（retained 重送無害）
+        REDISCOVERIES.inc(result="failed")
+        logging.warning(f"[rediscover] {device_key} 有 {result['failed']} 則 discovery 未送達，下次重送")
+        return
+    REDISCOVERIES.inc(result="updated")
+    DISCOVERY_REGISTRY.commit(device_key, payloads)
+    logging.info(
+        f"[rediscover] {device_key} 發佈 {len(publishes)}、清除 {len(clears)}"
+        f"（{result['elapsed_ms']} ms，{result['rate']} 則/秒）"
+    )
 
-    for sensor, value in data_sensors.items():
-        cfg = generate_mqtt_discovery_textconfig(
-            device_name, device_mac, "data", sensor, format_version
-        )
-        discovery_configs.append(cfg)
+REDISCOVER_RETRY_SEC = 60.0
+_REDISCOVER_RETRY = set()
+_REDISCOVER_RETRY_LOCK = threading.Lock()
 
-    for cfg in discovery_configs:
-        discovery_topic = (
-            f"homeassistant/sensor/"
-            f"{str(device_name).lower()}_{str(device_mac).lower()}_{str(cfg['name']).lower()}/config"
-        )
-        payload = json.dumps(cfg, indent=2)
-        client.publish(discovery_topic, payload, retain=True)
-        logging.info(f"[rediscover] publish {discovery_topic}")
+def _retry_rediscover(client, device_name, device_mac, message_json):
+    """同一台裝置同時只排一次重試（HA 斷線時不會越排越多）。"""
+    device_key = _device_key(device_name, device_mac)
+    with _REDISCOVER_RETRY_LOCK:
+        if device_key in _REDISCOVER_RETRY:
+            REDISCOVERIES.inc(result="deferred")
+            return
+        _REDISCOVER_RETRY.add(device_key)
+
+    def _again():
+        with _REDISCOVER_RETRY_LOCK:
+            _REDISCOVER_RETRY.discard(device_key)
+        REDISCOVERY.submit(device_key, clear_and_rediscover, client, device_name, device_mac, message_json)
+
+    def _dropped():
+        with _REDISCOVER_RETRY_LOCK:
+            _REDISCOVER_RETRY.discard(device_key)
+        REDISCOVERIES.inc(result="dropped")
+        logging.warning(f"[rediscover] {device_key} 重試到期時工作池已滿，等下一筆 data 再排")
+
+    if SCHEDULER.call_later(REDISCOVER_RETRY_SEC, _again, on_reject=_dropped):
+        REDISCOVERIES.inc(result="deferred")
+        logging.warning(f"[rediscover] {device_key} 暫時無法查詢 HA，{REDISCOVER_RETRY_SEC:.0f} 秒後重試")
+    else:
+        with _REDISCOVER_RETRY_LOCK:
+            _REDISCOVER_RETRY.discard(device_key)
+        REDISCOVERIES.inc(result="dropped")
+
+def discovery_topic_for(device_name, device_mac, sensor_name):
+    return (
+        f"homeassistant/sensor/"
+        f"{str(device_name).lower()}_{str(device_mac).lower()}_{str(sensor_name).lower()}/config"
+    )
 
 # ------------------------------------------------------------
 # 🔔 清除註冊
 # ------------------------------------------------------------
-def clear_discovery_for_device(client, device_name, device_mac):
+def find_stale_discovery(device_name, device_mac, keep=()):
     """
-    清掉 HA 裡面這台裝置所有對應的 MQTT Discovery config。
-    做法：查 HA 所有 state，找出 sensor.<dev>_<mac>_*，逐一發空的 retain。
+    找出 HA 裡面這台裝置所有對應的 MQTT Discovery config topic（keep 裡的 topic 除外）。
+    做法：從本地 HA state 索引找出 sensor.<dev>_<mac>_*，換回 discovery topic。
+    索引抓不到時改用 template 只查這台的 entity_id；兩者都失敗回 None。
     config 相關全部小寫
     """
     dev = str(device_name).lower()
@@ -280,30 +762,34 @@ def clear_discovery_for_device(client, device_name, device_mac):
     # mac = device_mac
     prefix = f"sensor.{dev}_{mac}_"
 
-    url = f"{BASE_URL}/states"
     try:
-        resp = requests.get(url, headers=HEADERS, timeout=5)
-        resp.raise_for_status()
-        states = resp.json()
+        entity_ids = [s.get("entity_id", "") for s in STATE_INDEX.with_prefix(prefix)]
     except Exception as e:
-        logging.error(f"[rediscover] 無法取得 HA states，改成只清本次欄位: {e}")
-        return False
-
-    cleared = 0
-    for s in states:
-        eid = s.get("entity_id", "")
-        if not eid.startswith(prefix):
-            continue
-
+        logging.warning(f"[rediscover] 無法取得 HA states（{e}），改用 template 查詢 {prefix}*")
+        try:
+            entity_ids = HA_CLIENT.entity_ids_with_prefix(prefix)
+        except Exception as e:
+            logging.error(f"[rediscover] 無法查詢 HA 的 {prefix}* entity: {e}")
+            return None
+
+    topics = []
+    for eid in entity_ids:
         # sensor.xxx_yyy_zzz -> zzz
         sensor_suffix = eid.split(prefix, 1)[1]
         disc_topic = f"homeassistant/sensor/{dev}_{mac}_{sensor_suffix}/config"
-        client.publish(disc_topic, "", retain=True)
-        logging.info(f"[rediscover] clear {disc_topic}")
-        cleared += 1
-
-    logging.info(f"[rediscover] 已清除 {cleared} 筆舊的 discovery")
-    return True
+        if disc_topic not in keep:
+            topics.append(disc_topic)
+    return topics
+
+def clear_discovery_for_device(client, device_name, device_mac, keep=()):
+    """清掉 HA 裡面這台裝置所有對應的 MQTT Discovery config（keep 裡的 topic 除外）；查不到 HA 時回 False。"""
+    topics = find_stale_discovery(device_name, device_mac, keep)
+    if topics is None:
+        return False
+    result = PUBLISHER.publish_many(client, [(topic, "") for topic in topics])
+    DISCOVERY_PUBLISHES.inc(len(topics), kind="clear")
+    logging.info(f"[rediscover] 已清除 {result['sent']} 筆舊的 discovery")
+    return not result["failed"]
     
 # ------------------------------------------------------------
 # 🧱 複製 MQTT 橋接設定檔(for 中控橋接觀察數據 預設路徑192.168.51.8)
@@ -329,21 +815,66 @@ def clear_discovery_for_device(client, device_name, device_mac):
 # ------------------------------------------------------------
 # 🚀 主程式
 # ------------------------------------------------------------
-def main():
-    logging.info("Add-on started")
-
-    # create_mqtt_bridge_conf()
-
-    client = mqtt.Client()
+def create_client():
+    if MQTT_PROTOCOL == "5":
+        client = mqtt.Client(protocol=mqtt.MQTTv5)
+    else:
+        client = mqtt.Client()
 
     if MQTT_USERNAME and MQTT_PASSWORD:
         client.username_pw_set(MQTT_USERNAME, MQTT_PASSWORD)
 
+    PUBLISHER.configure_client(client, MQTT_MAX_QUEUED)
     client.on_connect = on_connect
     client.on_message = on_message
+    return client
+
+def start_services(client):
+    """啟動背景工作（收訊管線、HA 索引、ota_index 監看、定期工作）；整個程序只呼叫一次。"""
+    global MQTT_CLIENT, HISTORY_SERVER
+    MQTT_CLIENT = client
+    if HISTORY_PORT and HISTORY.max_series:
+        if SHARD.index == 0:
+            HISTORY_SERVER = start_history_server(
+                HISTORY, "0.0.0.0", HISTORY_PORT,
+                locate=_history_locate if SHARD.enabled else None,
+                peers=[HISTORY_PORT + k for k in range(1, SHARD.count)],
+            )
+        else:
+            HISTORY_SERVER = start_history_server(HISTORY, "127.0.0.1", HISTORY_PORT + SHARD.index)
+    INGEST.start()
+    STATE_INDEX.start()
+    OTA_INDEX.start()
+    SCHEDULER.call_every(60.0, log_worker_stats)
+    SCHEDULER.call_every(10.0, OTA_TRACKER.expire)
+    SCHEDULER.call_every(5.0, DISCOVERY_REGISTRY.save_if_dirty)
+    SCHEDULER.call_every(10.0, REGISTRY.dump)
+
+def stop_services():
+    """結束前把紀錄寫回 /data。"""
+    INGEST.stop(drain=False)
+    if HISTORY_SERVER is not None:
+        HISTORY_SERVER.shutdown()
+    DISCOVERY_REGISTRY.save_if_dirty()
+    DEVICE_STORE.close()
+    REGISTRY.dump()
+
+def main():
+    logging.info(f"Add-on started（分片 {SHARD.label()}）" if SHARD.enabled else "Add-on started")
+
+    # create_mqtt_bridge_conf()
+
+    client = create_client()
+    start_services(client)
+
+    # launcher 用 SIGTERM 關閉：轉成正常結束，才會走到 finally 把紀錄寫回 /data
+    signal.signal(signal.SIGTERM, lambda sig, frame: sys.exit(0))
 
     client.connect(MQTT_BROKER, MQTT_PORT, 60)
-    client.loop_forever()  # 持續執行直到 Add-on 被 HA 關閉
+    try:
+        client.loop_forever()  # 持續執行直到 Add-on 被 HA 關閉
+    finally:
+        stop_services()
 
 if __name__ == "__main__":
     main()
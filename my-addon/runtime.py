@@ -0,0 +1,162 @@
+# runtime.py
+# ------------------------------------------------------------
+# 🧩 單一程序模式：MQTT、OTA server（以及有打包時的儀表板）跑在同一個程序
+# ------------------------------------------------------------
+# launcher.py 在 runtime_mode: single 時改執行這支。
+# 每個元件的阻塞迴圈（paho loop_forever / serve_forever）放在專屬 thread，
+# 由 asyncio event loop 負責監看：某個元件掛掉只重啟它自己（指數退避），其他繼續跑；
+# 收到 SIGTERM 時依序停止各元件，最後把紀錄寫回 /data。
+# 跟多程序模式相比：requests / yaml / paho 只載入一次，HA state 索引、ota_index 與韌體雜湊共用一份。
+import asyncio
+import importlib
+import logging
+import os
+import signal
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+import run
+import local_ota_server
+
+RESTART_BASE_SEC = 1.0
+RESTART_MAX_SEC = 60.0
+HEALTHY_AFTER_SEC = 60.0  # 跑超過這麼久才結束的，退避時間從頭算
+STOP_TIMEOUT_SEC = 10.0
+
+
+class Component:
+    """
+    run()  : 阻塞直到元件結束（正常結束或丟例外都會被重啟，除非正在關機）
+    stop() : 讓 run() 儘快返回（從 event loop thread 呼叫）
+    """
+    def __init__(self, name, run, stop):
+        self.name = name
+        self.run = run
+        self.stop = stop
+        self.restarts = 0
+
+
+async def supervise(comp, executor, stopping):
+    loop = asyncio.get_running_loop()
+    backoff = RESTART_BASE_SEC
+    while not stopping.is_set():
+        started = loop.time()
+        try:
+            await loop.run_in_executor(executor, comp.run)
+            if stopping.is_set():
+                break
+            logging.warning(f"[runtime] {comp.name} 結束了，{backoff:.0f} 秒後重啟")
+        except Exception as e:
+            if stopping.is_set():
+                break
+            logging.error(f"[runtime] {comp.name} 發生錯誤：{e}，{backoff:.0f} 秒後重啟")
+        if loop.time() - started >= HEALTHY_AFTER_SEC:
+            backoff = RESTART_BASE_SEC
+        try:
+            await asyncio.wait_for(stopping.wait(), backoff)
+            break
+        except asyncio.TimeoutError:
+            pass
+        comp.restarts += 1
+        backoff = min(backoff * 2, RESTART_MAX_SEC)
+
+
+# ---------------- 元件 ----------------
+def mqtt_component():
+    client = run.create_client()
+    run.start_services(client)
+
+    def _run():
+        # connect 失敗會丟例外 → 交給 supervise 退避重啟
+        client.connect(run.MQTT_BROKER, run.MQTT_PORT, 60)
+        client.loop_forever()
+
+    return Component("mqtt", _run, client.disconnect)
+
+
+def ota_component():
+    root = os.environ.get("OTA_ROOT", run.OTA_ROOT)
+    workers = int(os.environ.get("OTA_WORKERS", "16"))
+    max_conn = int(os.environ.get("OTA_MAX_CONNECTIONS", "64"))
+    # 跟 run.py 共用同一個 ota_index 監看（雜湊只算一次）
+    fw_cache, watcher = local_ota_server.prepare_firmware_cache(root, watcher=run.OTA_INDEX, artifacts=run.OTA_ARTIFACTS)
+    holder = {}
+
+    def _run():
+        httpd = local_ota_server.create_ota_server(root, run.OTA_PORT, fw_cache, watcher, workers, max_conn)
+        holder["httpd"] = httpd
+        try:
+            httpd.serve_forever()
+        finally:
+            holder.pop("httpd", None)
+            httpd.server_close()
+
+    def _stop():
+        httpd = holder.get("httpd")
+        if httpd is not None:
+            httpd.shutdown()
+
+    return Component("ota", _run, _stop)
+
+
+def dashboard_component():
+    """映像檔裡有 3drp_show.py 才啟動儀表板；它跟 run.py 共用 StateIndex.shared() 的索引。"""
+    try:
+        dashboard = importlib.import_module("3drp_show")
+    except ImportError:
+        return None
+    from werkzeug.serving import make_server
+    holder = {}
+
+    def _run():
+        server = make_server(dashboard.HTTP_HOST, dashboard.HTTP_PORT, dashboard.app, threaded=True)
+        holder["server"] = server
+        try:
+            server.serve_forever()
+        finally:
+            holder.pop("server", None)
+            server.server_close()
+
+    def _stop():
+        server = holder.get("server")
+        if server is not None:
+            server.shutdown()
+
+    return Component("dashboard", _run, _stop)
+
+
+async def main():
+    logging.info("Add-on started（單一程序模式）")
+    components = [c for c in (mqtt_component(), ota_component(), dashboard_component()) if c]
+    executor = ThreadPoolExecutor(len(components), thread_name_prefix="runtime")
+
+    loop = asyncio.get_running_loop()
+    stopping = asyncio.Event()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stopping.set)
+
+    tasks = [asyncio.create_task(supervise(c, executor, stopping), name=c.name) for c in components]
+    logging.info(f"[runtime] 已啟動：{', '.join(c.name for c in components)}")
+
+    await stopping.wait()
+    logging.info("[runtime] 收到停止訊號，關閉各元件...")
+    # stop() 可能會等 socket / thread 結束，放到預設 executor，不卡住 event loop（訊號、其他元件的 supervise）
+    for c in components:
+        try:
+            await loop.run_in_executor(None, c.stop)
+        except Exception as e:
+            logging.error(f"[runtime] 停止 {c.name} 失敗：{e}")
+    done, pending = await asyncio.wait(tasks, timeout=STOP_TIMEOUT_SEC)
+    for t in pending:
+        logging.warning(f"[runtime] {t.get_name()} 沒有在 {STOP_TIMEOUT_SEC:.0f} 秒內停止")
+    await loop.run_in_executor(None, run.stop_services)
+    executor.shutdown(wait=False)
+    return not pending
+
+
+if __name__ == "__main__":
+    if not asyncio.run(main()):
+        # 有元件卡住：紀錄已經寫回，不等 executor thread，直接結束
+        logging.shutdown()
+        os._exit(0)
+    sys.exit(0)
@@ -0,0 +1,374 @@
+import collections
+import heapq
+import itertools
+import logging
+import queue
+import threading
+import time
+
+# ------------------------------------------------------------
+# 🧵 固定數量 worker 的執行池（有佇列上限）
+# ------------------------------------------------------------
+class BoundedExecutor:
+    """
+    固定 worker 數量的執行池。
+    佇列滿了就直接拒絕（回傳 False），不會無限堆積 thread 或工作。
+    """
+    def __init__(self, max_workers=4, max_queue=1000, name="worker"):
+        self.name = name
+        self.max_workers = max(1, int(max_workers))
+        self.max_queue = max(1, int(max_queue))
+        self._q = queue.Queue(maxsize=self.max_queue)
+        self._lock = threading.Lock()
+        self._stopped = False
+
+        # backpressure 統計
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.busy = 0
+        self.max_depth = 0
+
+        self._threads = []
+        for i in range(self.max_workers):
+            t = threading.Thread(target=self._worker, name=f"{name}-{i}", daemon=True)
+            t.start()
+            self._threads.append(t)
+
+    def submit(self, fn, *args, **kwargs):
+        """丟一個工作進佇列；佇列滿或已關閉時回傳 False。"""
+        if self._stopped:
+            return False
+        try:
+            self._q.put_nowait((fn, args, kwargs))
+        except queue.Full:
+            with self._lock:
+                self.rejected += 1
+                rejected = self.rejected
+            # 每 100 筆才印一次，避免 log 本身變成負擔
+            if rejected == 1 or rejected % 100 == 0:
+                logging.warning(
+                    f"[{self.name}] 佇列已滿({self.max_queue})，已拒絕 {rejected} 筆工作"
+                )
+            return False
+
+        depth = self._q.qsize()
+        with self._lock:
+            self.submitted += 1
+            if depth > self.max_depth:
+                self.max_depth = depth
+        return True
+
+    def _worker(self):
+        while True:
+            item = self._q.get()
+            if item is None:
+                self._q.task_done()
+                return
+            fn, args, kwargs = item
+            with self._lock:
+                self.busy += 1
+            try:
+                fn(*args, **kwargs)
+                ok = True
+            except Exception as e:
+                ok = False
+                logging.error(f"[{self.name}] 工作執行失敗 {getattr(fn, '__name__', fn)}: {e}")
+            finally:
+                with self._lock:
+                    self.busy -= 1
+                    if ok:
+                        self.completed += 1
+                    else:
+                        self.failed += 1
+                self._q.task_done()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "workers": self.max_workers,
+                "busy": self.busy,
+                "queue_depth": self._q.qsize(),
+                "queue_max": self.max_queue,
+                "max_depth": self.max_depth,
+                "submitted": self.submitted,
+                "completed": self.completed,
+                "failed": self.failed,
+                "rejected": self.rejected,
+            }
+
+    def shutdown(self, wait=True, timeout=5.0):
+        """停止收新工作；wait=True 時等佇列內的工作做完（最多 timeout 秒）。"""
+        self._stopped = True
+        for _ in self._threads:
+            # 用 blocking put，確保每個 worker 都收到結束訊號
+            try:
+                self._q.put(None, timeout=timeout)
+            except queue.Full:
+                break
+        if wait:
+            deadline = time.monotonic() + timeout
+            for t in self._threads:
+                t.join(max(0.0, deadline - time.monotonic()))
+
+
+# ------------------------------------------------------------
+# ⏰ 延遲工作排程器（單一 thread + heap）
+# ------------------------------------------------------------
+class DelayedScheduler:
+    """
+    用一個 heap 管理所有延遲工作，只用一條 thread 等待到期。
+    到期的工作交給 executor 執行，所以延遲期間不會占用任何 worker。
+    到期時 executor 佇列滿了會丟掉該工作（dropped 計數＋記 log），有給 on_reject 的改呼叫它，
+    讓呼叫端把自己的狀態收回來（例如 OTA 名額、等待中的 key）。
+    """
+    def __init__(self, executor, max_pending=10000, name="scheduler"):
+        self.executor = executor
+        self.name = name
+        self.max_pending = max(1, int(max_pending))
+        self._heap = []
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._stopped = False
+
+        self.scheduled = 0
+        self.dispatched = 0
+        self.rejected = 0
+        self.dropped = 0         # 到期了但 executor 拒收
+        self.skipped_ticks = 0   # call_every 因 executor 拒收而跳過的次數
+        self.max_pending_seen = 0
+
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+
+    def call_later(self, delay_sec, fn, *args, on_reject=None, **kwargs):
+        """
+        delay_sec 秒後把 fn 交給 executor；待執行數量超過上限時回傳 False。
+        到期時 executor 拒收就在排程 thread 上呼叫 on_reject()（要很快、不能阻塞）。
+        """
+        return self._push(delay_sec, fn, args, kwargs, on_reject)
+
+    def _push(self, delay_sec, fn, args, kwargs, on_reject=None, force=False):
+        due = time.monotonic() + max(0.0, float(delay_sec))
+        with self._cond:
+            if self._stopped:
+                return False
+            if not force and len(self._heap) >= self.max_pending:
+                self.rejected += 1
+                if self.rejected == 1 or self.rejected % 100 == 0:
+                    logging.warning(
+                        f"[{self.name}] 延遲工作已達上限({self.max_pending})，已拒絕 {self.rejected} 筆"
+                    )
+                return False
+            entry = (due, next(self._seq), fn, args, kwargs, on_reject)
+            heapq.heappush(self._heap, entry)
+            self.scheduled += 1
+            if len(self._heap) > self.max_pending_seen:
+                self.max_pending_seen = len(self._heap)
+            # 只有新工作變成最早到期時才需要叫醒等待中的 thread
+            if self._heap[0] is entry:
+                self._cond.notify()
+        return True
+
+    def call_every(self, interval_sec, fn, *args, **kwargs):
+        """
+        每 interval_sec 秒執行一次 fn（下次排程在本次執行完之後）。
+        executor 滿了這一輪就跳過、照樣排下一輪；週期工作不受 max_pending 限制，
+        不會因為一時塞滿就永遠停掉（統計、寫檔、OTA 逾時檢查都靠它們）。
+        """
+        name = getattr(fn, "__name__", repr(fn))
+
+        def _next():
+            self._push(interval_sec, _tick, (), {}, _skipped, force=True)
+
+        def _tick():
+            try:
+                fn(*args, **kwargs)
+            finally:
+                _next()
+
+        def _skipped():
+            with self._cond:
+                self.skipped_ticks += 1
+            logging.warning(f"[{self.name}] 工作池已滿，{name} 這一輪跳過")
+            _next()
+
+        return self._push(interval_sec, _tick, (), {}, _skipped, force=True)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._stopped:
+                    if not self._heap:
+                        self._cond.wait()
+                        continue
+                    wait = self._heap[0][0] - time.monotonic()
+                    if wait <= 0:
+                        break
+                    self._cond.wait(wait)
+                if self._stopped:
+                    return
+                _, _, fn, args, kwargs, on_reject = heapq.heappop(self._heap)
+            if self.executor.submit(fn, *args, **kwargs):
+                with self._cond:
+                    self.dispatched += 1
+                continue
+            with self._cond:
+                self.dropped += 1
+                dropped = self.dropped
+            if on_reject is not None:
+                try:
+                    on_reject()
+                except Exception as e:
+                    logging.error(f"[{self.name}] on_reject 執行失敗 {getattr(fn, '__name__', fn)}: {e}")
+            elif dropped == 1 or dropped % 100 == 0:
+                logging.warning(
+                    f"[{self.name}] 工作池已滿，到期工作 {getattr(fn, '__name__', fn)} 被丟掉（累計 {dropped} 筆）"
+                )
+
+    def pending(self):
+        with self._cond:
+            return len(self._heap)
+
+    def stats(self):
+        with self._cond:
+            return {
+                "pending": len(self._heap),
+                "pending_max": self.max_pending,
+                "max_pending_seen": self.max_pending_seen,
+                "scheduled": self.scheduled,
+                "dispatched": self.dispatched,
+                "rejected": self.rejected,
+                "dropped": self.dropped,
+                "skipped_ticks": self.skipped_ticks,
+            }
+
+    def shutdown(self):
+        with self._cond:
+            self._stopped = True
+            self._heap.clear()
+            self._cond.notify_all()
+        self._thread.join(2.0)
+
+
+# ------------------------------------------------------------
+# 🔑 依 key 合併 / 序列化的工作（例如每台裝置的 rediscover）
+# ------------------------------------------------------------
+class KeyedWorkQueue:
+    """
+    submit(key, fn, *args)：
+      - 同一個 key 已經有等待中的工作時不再排新的，只把參數換成最新一份（debounce 期間的請求合併成一次）
+      - 第一次 submit 後等 debounce_sec 才執行
+      - 同一個 key 同時最多一個在跑；跑的期間又有新請求，跑完後再等一次 debounce
+      - 全部 key 同時執行的數量不超過 max_concurrent，其餘依到期順序排隊
+      - 到期時 executor 滿了，隔 retry_sec 秒再排一次；連排程器都排不進去才丟掉這個 key
+    延遲交給 scheduler，執行交給 scheduler 的 executor，不另開 thread。
+    """
+    def __init__(self, scheduler, debounce_sec=5.0, max_concurrent=2, max_keys=10000, name="keyed",
+                 retry_sec=1.0):
+        self.scheduler = scheduler
+        self.debounce_sec = max(0.0, float(debounce_sec))
+        self.retry_sec = max(0.1, float(retry_sec))
+        self.max_concurrent = max(1, int(max_concurrent))
+        self.max_keys = max(1, int(max_keys))
+        self.name = name
+        self._lock = threading.Lock()
+        self._pending = {}            # key -> (fn, args, kwargs)，最新一份
+        self._running = set()
+        self._ready = collections.deque()  # 已到期、等執行名額的 key
+
+        self.submitted = 0
+        self.collapsed = 0
+        self.executed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.deferred = 0   # 到期時 executor 拒收、延後重排的次數
+
+    def submit(self, key, fn, *args, **kwargs):
+        """回傳 False 代表沒排進去（key 太多或排程器滿了）。"""
+        with self._lock:
+            self.submitted += 1
+            if key in self._pending:
+                self._pending[key] = (fn, args, kwargs)
+                self.collapsed += 1
+                return True
+            if len(self._pending) >= self.max_keys:
+                self.rejected += 1
+                return False
+            self._pending[key] = (fn, args, kwargs)
+            if key in self._running:
+                return True  # 跑完時會再排
+        return self._schedule(self.debounce_sec, key)
+
+    def _schedule(self, delay_sec, key):
+        if self.scheduler.call_later(delay_sec, self._due, key, on_reject=lambda: self._deferred(key)):
+            return True
+        # 排程器滿了：丟掉這個 key 的等待工作，之後的 submit 可以重新排
+        with self._lock:
+            self._pending.pop(key, None)
+            self.rejected += 1
+        return False
+
+    def _deferred(self, key):
+        """排程 thread 呼叫：_due 到期時 executor 拒收，key 還留在 _pending，不重排的話之後的 submit 都會被合併掉。"""
+        with self._lock:
+            if key not in self._pending or key in self._running:
+                return
+            self.deferred += 1
+            deferred = self.deferred
+        if deferred == 1 or deferred % 100 == 0:
+            logging.warning(f"[{self.name}] 工作池已滿，{key} 延後 {self.retry_sec:g} 秒再排（累計 {deferred} 次）")
+        self._schedule(self.retry_sec, key)
+
+    def _due(self, key):
+        with self._lock:
+            if key not in self._pending or key in self._running:
+                return
+            if len(self._running) >= self.max_concurrent:
+                if key not in self._ready:
+                    self._ready.append(key)
+                return
+            job = self._pending.pop(key)
+            self._running.add(key)
+        self._run(key, job)
+
+    def _run(self, key, job):
+        fn, args, kwargs = job
+        try:
+            fn(*args, **kwargs)
+            ok = True
+        except Exception as e:
+            ok = False
+            logging.error(f"[{self.name}] {key} 執行失敗：{e}")
+        with self._lock:
+            self._running.discard(key)
+            if ok:
+                self.executed += 1
+            else:
+                self.failed += 1
+            again = key in self._pending
+            nxt = None
+            while self._ready:
+                k = self._ready.popleft()
+                if k in self._pending and k not in self._running:
+                    nxt = k
+                    break
+        if nxt is not None:
+            self._schedule(0, nxt)
+        if again:
+            self._schedule(self.debounce_sec, key)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "pending": len(self._pending),
+                "running": len(self._running),
+                "waiting": len(self._ready),
+                "submitted": self.submitted,
+                "collapsed": self.collapsed,
+                "executed": self.executed,
+                "failed": self.failed,
+                "rejected": self.rejected,
+                "deferred": self.deferred,
+            }
@@ -0,0 +1,235 @@
+import bisect
+import hashlib
+import threading
+from collections import Counter
+
+# ------------------------------------------------------------
+# 🧩 依裝置 MAC 分片（多個 run.py 程序分攤同一批裝置）
+# ------------------------------------------------------------
+# 第 0 片訂閱萬用字元 topic，在 on_message 只看 topic 就決定這則是不是自己的；
+# 其他片只訂閱自己裝置的 topic（ShardRouter），新裝置由第 0 片轉發一次後再各自訂閱。
+# 同一台裝置永遠落在同一個分片，所以訊息順序、OTA 狀態、discovery 紀錄都只在那個分片內。
+
+
+def _point(key):
+    # crc32 對相近的字串（shard-0-1、shard-0-2…）分布很不平均，改用 blake2b 的前 8 bytes
+    return int.from_bytes(hashlib.blake2b(key.encode("utf-8"), digest_size=8).digest(), "big")
+
+
+class HashRing:
+    """
+    一致性雜湊：每個分片在環上放 vnodes 個點，key 歸順時針遇到的第一個點。
+    分片數從 N 改成 N+1 時只有大約 1/(N+1) 的裝置換分片（取餘數的話幾乎全部會換）。
+    """
+    def __init__(self, shards, vnodes=128):
+        self.shards = max(1, int(shards))
+        points = sorted((_point(f"shard-{s}-{v}"), s) for s in range(self.shards) for v in range(vnodes))
+        self._keys = [p for p, _ in points]
+        self._owners = [s for _, s in points]
+
+    def owner(self, key):
+        if self.shards == 1:
+            return 0
+        i = bisect.bisect(self._keys, _point(key))
+        return self._owners[i % len(self._owners)]
+
+
+class ShardFilter:
+    """
+    owns(topic)：<device>/<mac>/<type> 的 MAC 屬於這個分片才回 True。
+    分片數 1 時全部都收（原本的行為）；topic 格式不對的也收，交給後面照原本的方式處理。
+    """
+    def __init__(self, index=0, count=1, vnodes=128):
+        self.count = max(1, int(count))
+        self.index = int(index) % self.count
+        self.ring = HashRing(self.count, vnodes)
+        self._lock = threading.Lock()
+        self.owned = 0
+        self.skipped = 0
+
+    @property
+    def enabled(self):
+        return self.count > 1
+
+    def owns_mac(self, mac):
+        return self.ring.owner(str(mac).lower()) == self.index
+
+    def owns(self, topic):
+        if self.count == 1:
+            return True
+        parts = topic.split("/", 2)
+        mine = len(parts) < 3 or self.owns_mac(parts[1])
+        with self._lock:
+            if mine:
+                self.owned += 1
+            else:
+                self.skipped += 1
+        return mine
+
+    def label(self):
+        return f"{self.index}/{self.count}"
+
+    def stats(self):
+        with self._lock:
+            return {"shard": self.label(), "owned": self.owned, "skipped": self.skipped}
+
+
+class ShardRouter:
+    """
+    分片時讓第 1..N-1 片只收到自己裝置的訊息，不必每片都收全部再丟掉：
+      - 第 0 片照原本訂閱 topics；別片的裝置在那片認領之前，原封不動轉發到 <prefix>/<k>/<原 topic>
+      - 第 k 片訂閱 <prefix>/<k>/#；收到轉發就直接訂閱那台裝置的 topic（topics 的 MAC 層換成實際 MAC），
+        並發布 <prefix>/claimed/<mac>，第 0 片收到後不再轉發，並發布 <prefix>/<k>/done/<mac> 收尾
+      - 交接期間同一筆會從轉發和直接訂閱各收到一次：第 k 片按 payload 把兩邊配對，後到的那份丟掉，
+        收到 done（排在第 0 片最後一筆轉發之後）才結束這台的交接。直接訂閱生效後，直接收到的一定比轉發早到，
+        所以不會處理兩次；只有內容完全相同的幾筆可能被當成同一筆（本來也會被 PayloadDedup 當成重複）
+      - 第 k 片每次連上都發布 <prefix>/hello/<k>：第 0 片清掉 k 的認領，重新轉發到再次認領為止
+        （k 重啟後訂閱沒了也不會漏收；已訂閱的裝置重新進入交接）
+    需要 MQTT v5 的 noLocal（run.py 分片時強制使用），否則每片都會收到自己發出的 control。
+    第 0 片仍要收全部訊息才能發現新裝置。topics 的 MAC 層不是 + 時（例如 #）無法按裝置訂閱，
+    維持每片都收全部、只看 ShardFilter 決定要不要處理。
+    publish(topic, payload) / subscribe(topic) 由 bind() 在連線後給。
+    """
+    def __init__(self, shard, topics, prefix="zp2/_shard"):
+        self.shard = shard
+        self.topics = [t.strip() for t in topics if t.strip()]
+        self.prefix = f"{prefix}/{shard.count}"
+        self.enabled = shard.enabled and bool(self.topics) and all(
+            len(t.split("/")) == 3 and t.split("/")[1] == "+" for t in self.topics
+        )
+        self._publish = None
+        self._subscribe = None
+        self._lock = threading.Lock()
+        self._claimed = set()     # 第 0 片：已被別片認領的 MAC（小寫）
+        self._subscribed = {}     # 第 k 片：小寫 MAC → topic 裡的原始寫法（訂閱要大小寫一致）
+        self._handoff = {}        # 第 k 片：交接中的 MAC → (只從轉發收到的 payload, 只從直接訂閱收到的 payload)
+
+        self.forwarded = 0
+        self.handoffs = 0
+        self.claims = 0
+        self.overlaps = 0
+
+    @property
+    def front(self):
+        return self.shard.index == 0
+
+    def bind(self, publish, subscribe):
+        self._publish = publish
+        self._subscribe = subscribe
+
+    def device_topics(self, mac):
+        return [f"{a}/{mac}/{c}" for a, _, c in (t.split("/") for t in self.topics)]
+
+    def adopt(self, macs):
+        """第 k 片啟動時先認領已知的裝置（例如裝置紀錄裡屬於自己的 MAC），連上就直接訂閱。"""
+        with self._lock:
+            for mac in macs:
+                if self.shard.owns_mac(mac):
+                    self._subscribed.setdefault(str(mac).lower(), str(mac))
+
+    def subscriptions(self):
+        """連線（含重連）後要訂閱的 topic。"""
+        if not self.enabled:
+            return list(self.topics)
+        if self.front:
+            return self.topics + [f"{self.prefix}/claimed/+", f"{self.prefix}/hello/+"]
+        with self._lock:
+            macs = sorted(self._subscribed.values())
+        return [f"{self.prefix}/{self.shard.index}/#"] + [t for mac in macs for t in self.device_topics(mac)]
+
+    def on_connect(self):
+        """訂閱完成後呼叫：第 k 片通知第 0 片重新轉發，直到每台裝置再次認領。"""
+        if self.enabled and not self.front:
+            with self._lock:
+                self._handoff = {mac: (Counter(), Counter()) for mac in self._subscribed}
+            self._publish(f"{self.prefix}/hello/{self.shard.index}", b"")
+
+    def route(self, topic, payload):
+        """on_message 呼叫：回傳要交給 INGEST 的 topic（轉發的訊息會還原成原 topic），不用處理就回 None。"""
+        if not self.enabled:
+            return topic if self.shard.owns(topic) else None
+        if topic.startswith(self.prefix + "/"):
+            return self._control(topic[len(self.prefix) + 1:], payload)
+        if self.shard.owns(topic):
+            if self.front:
+                return topic
+            return topic if self._first_copy(topic.split("/", 2)[1], payload, direct=True) else None
+        if self.front:
+            mac = topic.split("/", 2)[1].lower()
+            with self._lock:
+                claimed = mac in self._claimed
+                if not claimed:
+                    self.forwarded += 1
+            if not claimed:
+                self._publish(f"{self.prefix}/{self.shard.ring.owner(mac)}/{topic}", payload)
+        return None
+
+    def _first_copy(self, mac, payload, direct):
+        """交接中的 MAC：另一條路已經收過同樣的 payload 就回 False（配對後丟掉），否則記下來回 True。"""
+        with self._lock:
+            pending = self._handoff.get(mac.lower())
+            if pending is None:
+                return True
+            mine, other = (pending[1], pending[0]) if direct else pending
+            if other[payload]:
+                other[payload] -= 1
+                if not other[payload]:
+                    del other[payload]
+                self.overlaps += 1
+                return False
+            mine[payload] += 1
+            return True
+
+    def _control(self, rest, payload=b""):
+        kind, _, tail = rest.partition("/")
+        if self.front:
+            done = None
+            with self._lock:
+                if kind == "claimed":
+                    mac = tail.lower()
+                    if mac not in self._claimed:
+                        self._claimed.add(mac)
+                        done = f"{self.prefix}/{self.shard.ring.owner(mac)}/done/{mac}"
+                elif kind == "hello" and tail.isdigit():
+                    owner = int(tail)
+                    self._claimed = {m for m in self._claimed if self.shard.ring.owner(m) != owner}
+            if done:
+                # 排在這台最後一筆轉發之後送到，第 k 片收到就知道不會再有轉發
+                self._publish(done, b"")
+            return None
+        if kind != str(self.shard.index):
+            return None
+        parts = tail.split("/", 2)
+        if len(parts) == 2 and parts[0] == "done":
+            with self._lock:
+                self._handoff.pop(parts[1].lower(), None)
+            return None
+        if len(parts) < 3 or not self.shard.owns_mac(parts[1]):
+            return None
+        mac = parts[1]
+        with self._lock:
+            self.handoffs += 1
+            new = mac.lower() not in self._subscribed
+            if new:
+                self._subscribed[mac.lower()] = mac
+                self._handoff.setdefault(mac.lower(), (Counter(), Counter()))
+                self.claims += 1
+        if new:
+            for t in self.device_topics(mac):
+                self._subscribe(t)
+        # 第 0 片還在轉發就代表它不知道（或忘了）這次認領，每次都回覆
+        self._publish(f"{self.prefix}/claimed/{mac.lower()}", b"")
+        return tail if self._first_copy(mac, payload, direct=False) else None
+
+    def stats(self):
+        with self._lock:
+            return {
+                "enabled": self.enabled,
+                "claimed": len(self._claimed),
+                "subscribed": len(self._subscribed),
+                "forwarded": self.forwarded,
+                "handoffs": self.handoffs,
+                "claims": self.claims,
+                "overlaps": self.overlaps,
+                "handing_off": len(self._handoff),
+            }
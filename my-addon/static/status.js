@@ -113,6 +113,7 @@ const DISPLAY_OVERRIDES = {
 };
 /**
  * ✅ 自動刷新間隔（毫秒）
+ * 即時推送（/devices/stream）連線中時不會輪詢；只有瀏覽器不支援或連線中斷時才用這個間隔
  */
 const REFRESH_MS = 60000;
 
@@ -121,11 +122,13 @@ const REFRESH_MS = 60000;
    prefix   = 要查的 entity 開頭
    suffixes = 自動從 COLUMN_CONFIG 取出所有 key
    DEVICES_URL = /devices?prefix=...&suffix=...
+   輪詢時另外帶 format=columnar&fields=<目前顯示的欄位>，只抓畫面上用得到的欄位
    ========================================================== */
 const DEFAULT_PREFIX = `sensor.${LOWER_DEVICE_NAME}_`;  // 自動轉成小寫
 // const DEFAULT_PREFIX ="sensor.testprint_";
 const SUFFIX_LIST = COLUMN_CONFIG.map(c => c.key).join(",");
 const DEVICES_URL = `/devices?prefix=${encodeURIComponent(DEFAULT_PREFIX)}&suffix=${encodeURIComponent(SUFFIX_LIST)}`;
+const STREAM_URL  = `/devices/stream?prefix=${encodeURIComponent(DEFAULT_PREFIX)}&suffix=${encodeURIComponent(SUFFIX_LIST)}`;
 
 // 初始化畫面上顯示資訊
 document.getElementById("srcText").textContent = DEVICES_URL;
@@ -234,6 +237,55 @@ function toRows(payload){
   return rows;
 }
 
+// 目前畫面上的裝置資料（device_id → {device_id, metrics}），推送的差異直接套在這裡
+let devicesById = new Map();
+
+function setSnapshot(payload){
+  devicesById = new Map();
+  const devices = Array.isArray(payload?.devices) ? payload.devices : [];
+  for (const d of devices) {
+    devicesById.set(d.device_id, { device_id: d.device_id, metrics: { ...(d.metrics || {}) } });
+  }
+  renderAll();
+}
+
+function renderAll(){
+  const devices = [...devicesById.values()]
+    .sort((a, b) => (a.device_id < b.device_id ? -1 : a.device_id > b.device_id ? 1 : 0));
+  renderHead();
+  renderBody(toRows({ devices }));
+  elUpdated.textContent = new Date().toLocaleString();
+}
+
+// 套用 /devices/stream 的 delta；已存在的格子就地更新，有新裝置才整張重畫
+function applyDelta(delta){
+  let needFull = false;
+  const devices = Array.isArray(delta?.devices) ? delta.devices : [];
+  for (const d of devices) {
+    let cur = devicesById.get(d.device_id);
+    if (!cur) {
+      cur = { device_id: d.device_id, metrics: {} };
+      devicesById.set(d.device_id, cur);
+      needFull = true;
+    }
+    for (const [key, metric] of Object.entries(d.metrics || {})) {
+      if (metric === null) delete cur.metrics[key];
+      else cur.metrics[key] = metric;
+      if (!needFull) patchCell(d.device_id, key, metric?.value ?? "");
+    }
+  }
+  if (needFull) renderAll();
+  else elUpdated.textContent = new Date().toLocaleString();
+}
+
+function patchCell(deviceId, key, value){
+  const td = elBody.querySelector(`tr[data-id="${CSS.escape(deviceId)}"] td[data-key="${CSS.escape(key)}"]`);
+  if (!td) return;  // 欄位沒顯示
+  const rawVal = fmt(value);
+  td.textContent = DISPLAY_OVERRIDES[rawVal] || rawVal;
+  td.className = getCellClass(key, rawVal);
+}
+
 function renderBody(rows){
   if(!rows.length){
     elBody.innerHTML = `<tr><td colspan="${1+currentColumns().length}" style="text-align:center;color:#9fb3c8;padding:18px">無資料</td></tr>`;
@@ -253,10 +305,10 @@ function renderBody(rows){
       const rawVal = fmt(r[col.key]);                     // 原始值 (unavailable)
       const showVal = DISPLAY_OVERRIDES[rawVal] || rawVal; // 要顯示的文字 (軟體離線)
       const cls = getCellClass(col.key, rawVal);          // 顏色用原值判斷
-      cells.push(`<td class="${cls}">${showVal}</td>`);
+      cells.push(`<td class="${cls}" data-key="${col.key}">${showVal}</td>`);
     }
 
-    return `<tr>${cells.join("")}</tr>`;
+    return `<tr data-id="${fmt(r.device)}">${cells.join("")}</tr>`;
   }).join("");
 
   elCount.textContent = String(rows.length);
@@ -266,24 +318,67 @@ function renderBody(rows){
 /* ==========================================================
    🧩 資料請求
    ========================================================== */
+// 欄位式回應 → 跟 /devices/stream snapshot 一樣的 {devices:[{device_id, metrics}]}
+function fromColumnar(payload){
+  const ids = Array.isArray(payload?.devices) ? payload.devices : [];
+  const columns = Object.entries(payload?.columns || {});
+  const devices = ids.map((id, i) => {
+    const metrics = {};
+    for (const [key, col] of columns) {
+      if (col.v[i] === null) continue;
+      metrics[key] = { value: col.v[i], last_updated: col.t[i] };
+    }
+    return { device_id: id, metrics };
+  });
+  return { devices };
+}
+
+// 目前輪詢抓回來的欄位（打開其他欄位時要重抓）
+let loadedFields = new Set();
+
 async function loadLive(){
-  const res = await fetch(DEVICES_URL, { headers:{ "Accept":"application/json" }});
+  const fields = currentColumns().map(c => c.key);
+  const url = `${DEVICES_URL}&format=columnar&fields=${encodeURIComponent(fields.join(","))}`;
+  const res = await fetch(url, { headers:{ "Accept":"application/json" }});  // 壓縮由瀏覽器自動協商
   if(!res.ok) throw new Error("HTTP "+res.status);
-  return res.json();
+  const data = fromColumnar(await res.json());
+  loadedFields = new Set(fields);
+  return data;
 }
 
 async function refresh(){
   elMsg.textContent = "";
   try{
     const data = await loadLive();
-    renderHead();
-    renderBody(toRows(data));
-    elUpdated.textContent = new Date().toLocaleString();
+    setSnapshot(data);
   }catch(e){
     elMsg.textContent = "讀取失敗："+e.message;
   }
 }
 
+/* ==========================================================
+   🧩 即時推送（SSE）：先收 snapshot，之後只收有變動的欄位
+   ========================================================== */
+let streaming = false;
+
+function startStream(){
+  if (!window.EventSource) return false;
+  const es = new EventSource(STREAM_URL);
+  es.addEventListener("snapshot", (e) => {
+    streaming = true;
+    loadedFields = new Set(COLUMN_CONFIG.map(c => c.key));  // snapshot 帶全部欄位
+    elMsg.textContent = "";
+    setSnapshot(JSON.parse(e.data));
+  });
+  es.addEventListener("delta", (e) => applyDelta(JSON.parse(e.data)));
+  es.onerror = () => {
+    // EventSource 會自己重連；這段期間改回輪詢
+    streaming = false;
+    elMsg.textContent = "即時連線中斷，重新連線中…";
+  };
+  return true;
+}
+
 /* ==========================================================
    🧩 欄位過濾面板
    ========================================================== */
@@ -305,7 +400,9 @@ window.toggleField = function(key, on){
   if(on) visibleSet.add(key);
   else   visibleSet.delete(key);
   saveVisibleSet(visibleSet);
-  refresh();
+  // 即時推送帶全部欄位；輪詢只抓了顯示中的欄位，打開沒抓過的才重抓
+  if (on && !loadedFields.has(key)) refresh();
+  else renderAll();
 };
 
 document.getElementById('btnFilter').addEventListener('click', ()=>{
@@ -328,19 +425,20 @@ document.getElementById('btnAllOn').addEventListener('click', ()=>{
   visibleSet = new Set(COLUMN_CONFIG.map(c => c.key));
   saveVisibleSet(visibleSet);
   rebuildFilterList();
-  refresh();
+  if (COLUMN_CONFIG.some(c => !loadedFields.has(c.key))) refresh();
+  else renderAll();
 });
 
 document.getElementById('btnAllOff').addEventListener('click', ()=>{
   visibleSet = new Set();
   saveVisibleSet(visibleSet);
   rebuildFilterList();
-  refresh();
+  renderAll();
 });
 
 /* ==========================================================
    🧩 啟動程序
    ========================================================== */
 document.getElementById('btnRefresh').addEventListener('click', refresh);
-refresh();
-setInterval(refresh, REFRESH_MS);
+if (!startStream()) refresh();
+setInterval(() => { if (!streaming) refresh(); }, REFRESH_MS);
@@ -0,0 +1,48 @@
+from functools import lru_cache
+
+# ------------------------------------------------------------
+# 🔚 entity_id 後綴比對（反轉字串 trie，依 suffix 組合快取）
+# ------------------------------------------------------------
+class SuffixMatcher:
+    """
+    把 suffixes 反轉後建成 trie，entity_id 從尾巴往前走一次就能找到所有命中的 suffix。
+    語意與逐一 endswith 相同：多個命中時取 suffixes 清單中最前面的那一個；
+    尾端若是 "_"+suffix，trailing 就包含那個底線。
+    """
+    __slots__ = ("suffixes", "_root")
+
+    def __init__(self, suffixes):
+        self.suffixes = tuple(suffixes)
+        root = {}
+        for i, s in enumerate(self.suffixes):
+            if not s:
+                continue
+            node = root
+            for ch in reversed(s):
+                node = node.setdefault(ch, {})
+            node.setdefault(None, i)  # 重複的 suffix 保留最前面的位置
+        self._root = root
+
+    def match(self, entity_id):
+        """回傳 (matched_suffix, trailing)；無命中回 (None, None)。"""
+        node = self._root
+        best = None
+        for ch in reversed(entity_id):
+            node = node.get(ch)
+            if node is None:
+                break
+            i = node.get(None)
+            if i is not None and (best is None or i < best):
+                best = i
+        if best is None:
+            return None, None
+        s = self.suffixes[best]
+        if entity_id.endswith("_" + s):
+            return s, "_" + s
+        return s, s
+
+
+@lru_cache(maxsize=64)
+def compile_suffixes(suffixes):
+    """suffixes 必須是 tuple；同樣的組合（例如 status.js 每次帶的欄位）只建一次 trie。"""
+    return SuffixMatcher(suffixes)
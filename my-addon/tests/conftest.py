@@ -0,0 +1,5 @@
+import os
+import sys
+
+# add-on 的模組都放在 my-addon/ 最上層（Dockerfile 逐一 COPY 到 /），測試直接 import
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
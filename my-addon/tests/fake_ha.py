@@ -0,0 +1,134 @@
+import base64
+import hashlib
+import json
+import socketserver
+import struct
+import threading
+
+WS_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+
+
+class FakeHA:
+    """
+    測試用的假 Home Assistant：同一個 port 提供
+      GET <base>/api/states     → states（rest_calls 計數）
+      <base>/websocket          → auth → subscribe_events → 之後可以 push_event()；
+                                  answer_pings=False 時不回 pong（模擬半開的連線）
+    base_url 屬性就是 StateIndex / HAClient 要用的 http://127.0.0.1:<port>/core/api。
+    """
+    def __init__(self, states):
+        self.states = list(states)
+        self.rest_calls = 0
+        self.pings = 0
+        self.answer_pings = True
+        self.ws_connections = 0
+        self._clients = []
+        self._lock = threading.Lock()
+        fake = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                fake._handle(self)
+
+        self.server = socketserver.ThreadingTCPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        self.port = self.server.server_address[1]
+        self.base_url = f"http://127.0.0.1:{self.port}/core/api"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    # ---------------- HTTP ----------------
+    def _handle(self, h):
+        request_line = h.rfile.readline().decode("latin-1").strip()
+        headers = {}
+        while True:
+            line = h.rfile.readline().decode("latin-1").strip()
+            if not line:
+                break
+            k, _, v = line.partition(":")
+            headers[k.strip().lower()] = v.strip()
+        path = request_line.split(" ")[1] if " " in request_line else ""
+        if headers.get("upgrade", "").lower() == "websocket":
+            return self._websocket(h, headers)
+        if path.endswith("/api/states"):
+            with self._lock:
+                self.rest_calls += 1
+                body = json.dumps(self.states).encode()
+            status = "200 OK"
+        else:
+            body, status = b"{}", "404 Not Found"
+        h.wfile.write(
+            f"HTTP/1.1 {status}\r\nContent-Type: application/json\r\n"
+            f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body
+        )
+
+    # ---------------- websocket ----------------
+    def _websocket(self, h, headers):
+        accept = base64.b64encode(hashlib.sha1((headers["sec-websocket-key"] + WS_GUID).encode()).digest())
+        h.wfile.write(
+            b"HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n"
+            b"Sec-WebSocket-Accept: " + accept + b"\r\n\r\n"
+        )
+        with self._lock:
+            self.ws_connections += 1
+        self._send(h, {"type": "auth_required"})
+        if self._recv(h).get("type") != "auth":
+            return
+        self._send(h, {"type": "auth_ok"})
+        sub = self._recv(h)
+        self._send(h, {"id": sub.get("id"), "type": "result", "success": True})
+        with self._lock:
+            self._clients.append(h)
+        try:
+            while True:
+                msg = self._recv(h)
+                if msg is None:
+                    return
+                if msg.get("type") == "ping":
+                    with self._lock:
+                        self.pings += 1
+                    if self.answer_pings:
+                        self._send(h, {"id": msg.get("id"), "type": "pong"})
+        finally:
+            with self._lock:
+                if h in self._clients:
+                    self._clients.remove(h)
+
+    def push_event(self, entity_id, new_state):
+        msg = {"type": "event", "event": {"data": {"entity_id": entity_id, "new_state": new_state}}}
+        with self._lock:
+            clients = list(self._clients)
+        for h in clients:
+            self._send(h, msg)
+
+    @staticmethod
+    def _send(h, obj):
+        data = json.dumps(obj).encode()
+        if len(data) < 126:
+            head = struct.pack("!BB", 0x81, len(data))
+        else:
+            head = struct.pack("!BBH", 0x81, 126, len(data))
+        try:
+            h.wfile.write(head + data)
+            h.wfile.flush()
+        except OSError:
+            pass
+
+    @staticmethod
+    def _recv(h):
+        head = h.rfile.read(2)
+        if len(head) < 2:
+            return None
+        opcode, n = head[0] & 0x0F, head[1] & 0x7F
+        if n == 126:
+            n = struct.unpack("!H", h.rfile.read(2))[0]
+        elif n == 127:
+            n = struct.unpack("!Q", h.rfile.read(8))[0]
+        mask = h.rfile.read(4) if head[1] & 0x80 else b"\0\0\0\0"
+        data = bytes(b ^ mask[i % 4] for i, b in enumerate(h.rfile.read(n)))
+        if opcode == 0x8:
+            return None
+        return json.loads(data)
@@ -0,0 +1,66 @@
+import importlib
+import json
+import os
+
+import pytest
+
+os.environ.setdefault("SUPERVISOR_TOKEN", "test")
+dashboard = importlib.import_module("3drp_show")
+
+PREFIX = "sensor.zp2_"
+
+
+def state(dev, value):
+    return {"entity_id": f"{PREFIX}{dev}_action", "state": value, "last_updated": "2026-10-17T00:00:00+00:00"}
+
+
+def events(chunks):
+    """SSE 字串 chunk → (event, data)，略過 retry / 心跳。"""
+    for chunk in chunks:
+        text = chunk.decode() if isinstance(chunk, bytes) else chunk
+        if not text.startswith("event:"):
+            continue
+        head, data = text.strip().split("\n", 1)
+        yield head.split(":", 1)[1].strip(), json.loads(data.split(":", 1)[1])
+
+
+@pytest.fixture
+def stream(monkeypatch):
+    states = [state("a", "idle"), state("b", "idle")]
+    monkeypatch.setattr(dashboard, "_get_all_states", lambda prefix="": states)
+    monkeypatch.setattr(dashboard.STATE_INDEX, "is_live", lambda: True)  # 不要背景輪詢 HA
+    client = dashboard.app.test_client()
+    resp = client.get(f"/devices/stream?prefix={PREFIX}&suffix=_action&limit=3", buffered=False)
+    it = events(resp.response)
+    yield it
+    resp.close()
+
+
+def push(*pairs):
+    dashboard.STREAM_HUB._on_changes([(f"{PREFIX}{dev}_action", s) for dev, s in pairs])
+
+
+def test_delta_respects_limit(stream):
+    kind, snap = next(stream)
+    assert kind == "snapshot"
+    assert [d["device_id"] for d in snap["devices"]] == ["zp2_a", "zp2_b"]
+
+    # 已知裝置照常更新；新裝置在 limit（3）內才加入，之後的新裝置不送
+    push(("a", state("a", "printing")), ("c", state("c", "idle")), ("d", state("d", "idle")))
+    kind, delta = next(stream)
+    assert kind == "delta"
+    assert [d["device_id"] for d in delta["devices"]] == ["zp2_a", "zp2_c"]
+
+    # 已滿：只剩未知裝置的變動整筆不送；已知裝置的變動照送
+    push(("e", state("e", "idle")))
+    push(("b", state("b", "printing")))
+    kind, delta = next(stream)
+    assert [d["device_id"] for d in delta["devices"]] == ["zp2_b"]
+
+
+def test_removed_unknown_device_is_not_sent(stream):
+    next(stream)
+    push(("x", None))
+    push(("a", None))
+    kind, delta = next(stream)
+    assert delta["devices"] == [{"device_id": "zp2_a", "metrics": {"_action": None}}]
@@ -0,0 +1,107 @@
+import importlib
+import json
+import os
+import tempfile
+
+import pytest
+
+from device_store import DeviceStore
+from discovery_registry import DiscoveryRegistry, compact_json, fingerprint
+
+# run.py 在 import 時讀 <ZP2_DATA_DIR>/options.json，並在那裡開裝置資料庫
+_DATA_DIR = tempfile.mkdtemp(prefix="zp2-test-")
+with open(os.path.join(_DATA_DIR, "options.json"), "w") as f:
+    json.dump({"local_ip": "127.0.0.1", "zp2_fw_profile": "test", "mqtt_topics": "+/+/data"}, f)
+os.environ.setdefault("ZP2_DATA_DIR", _DATA_DIR)
+os.environ.setdefault("SUPERVISOR_TOKEN", "test")
+run = importlib.import_module("run")
+
+PAYLOADS = {"t/a": compact_json({"name": "a"}), "t/b": compact_json({"name": "b"})}
+
+
+def test_diff_reports_only_changes():
+    reg = DiscoveryRegistry(path=os.path.join(tempfile.mkdtemp(), "reg.json"))
+    assert reg.diff("zp2_aa", PAYLOADS) == (["t/a", "t/b"], [], [])
+    reg.commit("zp2_aa", PAYLOADS)
+    assert reg.diff("zp2_aa", PAYLOADS) == ([], [], [])
+    changed = {"t/a": compact_json({"name": "a2"}), "t/c": compact_json({"name": "c"})}
+    assert reg.diff("zp2_aa", changed) == (["t/c"], ["t/a"], ["t/b"])
+
+
+def test_json_registry_reloads_from_disk(tmp_path):
+    path = str(tmp_path / "reg.json")
+    reg = DiscoveryRegistry(path=path)
+    reg.commit("zp2_aa", PAYLOADS)
+    assert reg.save_if_dirty() and not reg.save_if_dirty()
+    again = DiscoveryRegistry(path=path)
+    assert again.get("zp2_aa") == {t: fingerprint(p) for t, p in PAYLOADS.items()}
+    assert again.diff("zp2_aa", PAYLOADS) == ([], [], [])
+
+
+def test_store_registry_imports_legacy_json_once_and_reloads(tmp_path):
+    legacy = DiscoveryRegistry(path=str(tmp_path / "reg.json"))
+    legacy.commit("zp2_aa", PAYLOADS)
+    legacy.save_if_dirty()
+
+    db = str(tmp_path / "devices.db")
+    store = DeviceStore(db)
+    reg = DiscoveryRegistry(path=str(tmp_path / "reg.json"), store=store)
+    assert reg.diff("zp2_aa", PAYLOADS) == ([], [], [])
+    reg.forget("zp2_aa")
+    reg.commit("zp2_bb", PAYLOADS)
+    reg.save_if_dirty()
+
+    reloaded = DiscoveryRegistry(path=str(tmp_path / "reg.json"), store=DeviceStore(db))
+    assert reloaded.get("zp2_aa") is None  # 資料庫已有紀錄：不再匯入舊 JSON
+    assert reloaded.get("zp2_bb") == {t: fingerprint(p) for t, p in PAYLOADS.items()}
+
+
+@pytest.fixture
+def published(monkeypatch):
+    sent = []
+
+    def _publish_many(client, batch, retain=True):
+        sent.append(list(batch))
+        return {"sent": len(batch), "failed": 0, "elapsed_ms": 0, "rate": 0}
+
+    monkeypatch.setattr(run, "DISCOVERY_MODE", "sensor")
+    monkeypatch.setattr(run.PUBLISHER, "publish_many", _publish_many)
+    monkeypatch.setattr(run, "find_stale_discovery", lambda name, mac, keep=(): [])
+    return sent
+
+
+def rediscover(mac, fields):
+    run.clear_and_rediscover(None, "ZP2", mac, fields)
+
+
+def test_rediscover_publishes_only_differences(published):
+    mac = "a0b0c0000001"
+    rediscover(mac, {"FW": "1", "T": 20, "H": 50})
+    assert sorted(t for t, p in published[-1] if p) == [
+        run.discovery_topic_for("ZP2", mac, s) for s in ("fw", "h", "t")
+    ]
+
+    # 內容一樣：什麼都不發
+    rediscover(mac, {"FW": "1", "T": 21, "H": 51})
+    assert len(published) == 1
+
+    # 換了 FW（discovery 內容變了）：重發
+    rediscover(mac, {"FW": "2", "T": 21, "H": 51})
+    assert len(published) == 2 and all(p for _, p in published[-1]) and len(published[-1]) == 3
+
+    # 少了一個欄位：對那個 entity 發清除（空 payload），其他不動
+    rediscover(mac, {"FW": "2", "T": 21})
+    assert published[-1] == [(run.discovery_topic_for("ZP2", mac, "H"), "")]
+    assert sorted(run.DISCOVERY_REGISTRY.get(run._device_key("ZP2", mac))) == [
+        run.discovery_topic_for("ZP2", mac, s) for s in ("fw", "t")
+    ]
+
+
+def test_failed_publish_is_not_recorded(published, monkeypatch):
+    mac = "a0b0c0000002"
+    monkeypatch.setattr(
+        run.PUBLISHER, "publish_many",
+        lambda client, batch, retain=True: {"sent": 0, "failed": len(batch), "elapsed_ms": 0, "rate": 0},
+    )
+    rediscover(mac, {"FW": "1", "T": 20})
+    assert run.DISCOVERY_REGISTRY.get(run._device_key("ZP2", mac)) is None
@@ -0,0 +1,91 @@
+import pytest
+import requests
+
+from ha_client import CircuitBreaker, CircuitOpenError, HAClient
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class Resp:
+    def __init__(self, status_code):
+        self.status_code = status_code
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.HTTPError(f"HTTP {self.status_code}", response=self)
+
+
+def test_breaker_opens_after_threshold_and_probes_once():
+    clock = Clock()
+    b = CircuitBreaker(threshold=2, reset_sec=10, clock=clock)
+    b.failure()
+    assert b.allow()
+    b.failure()
+    assert b.state == b.OPEN and not b.allow()
+    clock.now = 10
+    assert b.allow()          # half-open：只放一個
+    assert not b.allow()
+    b.failure()               # 試的那個也失敗：重新開路
+    assert b.state == b.OPEN and not b.allow()
+    clock.now = 20
+    assert b.allow()
+    b.success()
+    assert b.state == b.CLOSED and b.allow() and b.failures == 0
+
+
+def make_client(clock, responses, threshold=1):
+    client = HAClient("http://ha.invalid/core/api", "token", retries=1, backoff_base=0)
+    client.breaker = CircuitBreaker(threshold=threshold, reset_sec=10, clock=clock)
+    calls = []
+
+    def _request(method, url, **kwargs):
+        calls.append(url)
+        r = responses.pop(0)
+        if isinstance(r, Exception):
+            raise r
+        return r
+
+    client.session.request = _request
+    return client, calls
+
+
+@pytest.mark.parametrize("exc", [
+    requests.exceptions.ChunkedEncodingError("cut"),
+    requests.exceptions.ContentDecodingError("gzip"),
+    requests.exceptions.TooManyRedirects("loop"),
+    requests.exceptions.InvalidURL("bad"),
+])
+def test_other_request_errors_resolve_half_open_probe(exc):
+    clock = Clock()
+    client, calls = make_client(clock, [requests.ConnectionError("down"), exc, Resp(200)])
+    with pytest.raises(requests.ConnectionError):
+        client.request("GET", "states", "states")
+    assert client.breaker.state == CircuitBreaker.OPEN
+    with pytest.raises(CircuitOpenError):
+        client.request("GET", "states", "states")
+
+    clock.now = 10
+    with pytest.raises(type(exc)):
+        client.request("GET", "states", "states")  # half-open 的試探請求：不重試，算失敗
+    assert len(calls) == 2
+    assert client.breaker.state == CircuitBreaker.OPEN  # 不能卡在 half-open
+
+    clock.now = 20
+    assert client.request("GET", "states", "states").status_code == 200
+    assert client.breaker.state == CircuitBreaker.CLOSED
+
+
+def test_client_errors_do_not_trip_breaker_and_5xx_is_retried():
+    clock = Clock()
+    client, calls = make_client(clock, [Resp(404), Resp(503), Resp(200)], threshold=3)
+    with pytest.raises(requests.HTTPError):
+        client.request("GET", "states/x", "state")
+    assert client.breaker.state == CircuitBreaker.CLOSED
+    assert client.request("GET", "states", "states").status_code == 200  # 503 重試一次
+    assert len(calls) == 3
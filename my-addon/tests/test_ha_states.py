@@ -0,0 +1,106 @@
+import time
+
+import pytest
+
+from ha_client import HAClient
+from ha_states import StateIndex
+from fake_ha import FakeHA
+
+pytest.importorskip("websocket")
+
+
+def wait_until(cond, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if cond():
+            return True
+        time.sleep(0.02)
+    return cond()
+
+
+def state(eid, value, updated="2026-10-17T00:00:00+00:00"):
+    return {"entity_id": eid, "state": value, "last_updated": updated}
+
+
+@pytest.fixture
+def ha():
+    fake = FakeHA([state("sensor.zp2_a_t", "1"), state("sensor.zp2_b_t", "2")])
+    yield fake
+    fake.close()
+
+
+def make_index(ha, **kw):
+    client = HAClient(ha.base_url, "token", retries=0)
+    index = StateIndex(ha.base_url, "token", client=client, **kw)
+    index.start()
+    assert wait_until(index.is_live)
+    return index
+
+
+def test_websocket_events_update_index_without_rest(ha):
+    index = make_index(ha, ttl=0.1, ping_interval=0.5)
+    try:
+        assert ha.rest_calls == 1
+        ha.push_event("sensor.zp2_a_t", state("sensor.zp2_a_t", "42"))
+        assert wait_until(lambda: index.get("sensor.zp2_a_t")["state"] == "42")
+        ha.push_event("sensor.zp2_b_t", None)
+        assert wait_until(lambda: [s["entity_id"] for s in index.with_prefix("sensor.zp2_")] == ["sensor.zp2_a_t"])
+        assert ha.rest_calls == 1
+    finally:
+        index.stop()
+
+
+def test_events_older_than_snapshot_are_dropped(ha):
+    ha.states[0] = state("sensor.zp2_a_t", "new", "2026-10-17T00:00:05+00:00")
+    index = make_index(ha, ttl=60)
+    seen = []
+    index.add_listener(seen.extend)
+    try:
+        # 整份載入期間送出、晚到的舊事件（時區寫法不同也照時間比）：不能把實體倒回去
+        ha.push_event("sensor.zp2_a_t", state("sensor.zp2_a_t", "old", "2026-10-17T08:00:01+08:00"))
+        ha.push_event("sensor.zp2_a_t", state("sensor.zp2_a_t", "newer", "2026-10-17T00:00:06+00:00"))
+        assert wait_until(lambda: index.get("sensor.zp2_a_t")["state"] == "newer")
+        assert [s["state"] for _, s in seen] == ["newer"]
+        assert index.stats()["stale_events"] == 1
+    finally:
+        index.stop()
+
+
+def test_idle_websocket_is_kept_alive_with_pings(ha):
+    index = make_index(ha, ttl=0.1, ping_interval=0.2)
+    try:
+        time.sleep(1.0)
+        assert ha.pings >= 2
+        assert index.is_live()
+        index.get("sensor.zp2_a_t")
+        assert ha.rest_calls == 1  # pong 也算活著，不用回頭打 REST
+    finally:
+        index.stop()
+
+
+def test_half_open_websocket_falls_back_to_rest_and_reconnects(ha):
+    ha.answer_pings = False
+    index = make_index(ha, ttl=0.1, ping_interval=0.2)
+    try:
+        # 沒有任何訊息超過 2 × ping_interval：查詢改走 REST
+        time.sleep(0.5)
+        index.get("sensor.zp2_a_t")
+        assert ha.rest_calls >= 2
+        # ping 沒有回應 → 中斷並重連
+        assert wait_until(lambda: not index.is_live(), 2.0)
+        assert wait_until(lambda: ha.ws_connections >= 2, 5.0)
+    finally:
+        index.stop()
+
+
+def test_max_age_forces_rest_refresh_while_live(ha):
+    index = make_index(ha, ttl=0.05, ping_interval=0.1, max_age=0.3)
+    try:
+        index.get("sensor.zp2_a_t")
+        assert ha.rest_calls == 1
+        time.sleep(0.4)
+        assert index.is_live()
+        index.get("sensor.zp2_a_t")
+        assert ha.rest_calls == 2
+    finally:
+        index.stop()
@@ -0,0 +1,123 @@
+import json
+import math
+import urllib.error
+import urllib.request
+
+import pytest
+
+from history import DT_MAX, HistoryStore, start_history_server
+
+T0 = 1_800_000_000  # 3600 的倍數，各 tier 的格子都從這裡開始
+
+
+def test_raw_ring_keeps_latest_points():
+    h = HistoryStore(raw_points=5)
+    for i in range(8):
+        h.record("AA", {"t": i}, ts=T0 + i)
+    q = h.query("aa", start=T0 - 10, end=T0 + 100, tier="raw")
+    assert q["series"]["t"] == {"t": [T0 + 3, T0 + 4, T0 + 5, T0 + 6, T0 + 7], "v": [3.0, 4.0, 5.0, 6.0, 7.0]}
+
+
+def test_raw_gap_over_dt_max_drops_older_points():
+    h = HistoryStore(raw_points=10)
+    h.record("aa", {"t": 1}, ts=T0)
+    h.record("aa", {"t": 2}, ts=T0 + 10)
+    h.record("aa", {"t": 3}, ts=T0 + 10 + DT_MAX + 1)
+    q = h.query("aa", start=0, end=T0 + 10 * DT_MAX, tier="raw")
+    assert q["series"]["t"] == {"t": [T0 + 10 + DT_MAX + 1], "v": [3.0]}
+    # 被清掉的 raw 還在 1h / 24h
+    q = h.query("aa", start=T0, end=T0 + 3600, tier="24h")
+    assert q["series"]["t"]["v"] == [1.5]
+
+
+def test_tier_averages_bucket_and_fills_gap_with_nan():
+    h = HistoryStore()
+    h.record("aa", {"t": 1}, ts=T0)
+    h.record("aa", {"t": 3}, ts=T0 + 30)
+    h.record("aa", {"t": 10}, ts=T0 + 300)
+    q = h.query("aa", start=T0, end=T0 + 300, tier="1h")
+    assert q["step"] == 60
+    assert q["series"]["t"] == {"t": [T0, T0 + 300], "v": [2.0, 10.0]}  # 中間 4 格是 NaN，不輸出
+    k = [name for name, _, _ in h.tiers].index("1h")
+    _, _, slots = h.tiers[k]
+    assert all(math.isnan(h._tier_v[k][b % slots]) for b in range(T0 // 60 + 1, T0 // 60 + 5))
+
+
+def test_24h_ring_wraps_without_leaking_old_buckets():
+    h = HistoryStore()
+    step, slots = 300, 288
+    h.record("aa", {"t": 1}, ts=T0)
+    h.record("aa", {"t": 2}, ts=T0 + 100 * step)
+    h.record("aa", {"t": 3}, ts=T0 + 300 * step)  # 超過一圈：T0 那格已被蓋掉
+    q = h.query("aa", start=T0, end=T0 + 300 * step, tier="24h")
+    assert q["series"]["t"] == {"t": [T0 + 100 * step, T0 + 300 * step], "v": [2.0, 3.0]}
+    # T0 + 288 格跟 T0 同一個位置：中間沒有資料，不能讀到舊的 1
+    q = h.query("aa", start=T0 + slots * step, end=T0 + slots * step, tier="24h")
+    assert q["series"]["t"] == {"t": [], "v": []}
+
+
+def test_full_store_recycles_least_recently_updated_series():
+    h = HistoryStore(max_series=2)
+    h.record("aa", {"t": 1}, ts=T0)
+    h.record("bb", {"t": 1}, ts=T0 + 1)
+    h.record("cc", {"t": 1}, ts=T0 + 2)
+    assert h.devices() == {"bb": ["t"], "cc": ["t"]}
+    assert h.stats()["evicted"] == 1
+    assert h.query("aa") is None
+
+    h.record("bb", {"t": 2}, ts=T0 + 3)  # bb 剛寫過：下一個回收的是 cc
+    h.record("dd", {"t": 1}, ts=T0 + 4)
+    assert sorted(h.devices()) == ["bb", "dd"]
+    assert h.stats()["evicted"] == 2
+
+
+def get(port, path):
+    try:
+        with urllib.request.urlopen(f"http://127.0.0.1:{port}{path}", timeout=5) as r:
+            return r.status, json.loads(r.read())
+    except urllib.error.HTTPError as e:
+        return e.code, json.loads(e.read())
+
+
+@pytest.fixture
+def shards():
+    """第 0 片（對外）＋第 1 片（只聽 127.0.0.1）；bb 屬於第 1 片。"""
+    front_store, peer_store = HistoryStore(), HistoryStore()
+    front_store.record("aa", {"t": 1}, ts=T0)
+    peer_store.record("bb", {"t": 2, "h": 50}, ts=T0)
+    peer = start_history_server(peer_store, "127.0.0.1", 0)
+    peer_port = peer.server_address[1]
+    front = start_history_server(
+        front_store, "127.0.0.1", 0,
+        locate=lambda mac: peer_port if mac == "bb" else None, peers=[peer_port],
+    )
+    yield front.server_address[1], peer
+    front.shutdown()
+    peer.shutdown()
+
+
+def test_front_shard_proxies_device_query(shards):
+    port, _ = shards
+    code, body = get(port, f"/history?device=BB&metric=t&start={T0}&end={T0 + 10}&tier=raw")
+    assert code == 200
+    assert body["series"] == {"t": {"t": [T0], "v": [2.0]}}
+    code, body = get(port, f"/history?device=aa&start={T0}&end={T0 + 10}&tier=raw")
+    assert code == 200 and body["series"]["t"]["v"] == [1.0]
+    code, body = get(port, "/history?device=bb&tier=nope")
+    assert code == 400  # 錯誤也原樣轉回
+
+
+def test_front_shard_merges_listing_and_reports_unavailable(shards):
+    port, peer = shards
+    code, body = get(port, "/history")
+    assert code == 200
+    assert body["devices"] == {"aa": ["t"], "bb": ["h", "t"]}
+    assert body["stats"]["series"] == 3 and body["stats"]["devices"] == 2
+    assert "unavailable" not in body
+
+    peer.shutdown()
+    peer.server_close()
+    code, body = get(port, "/history")
+    assert code == 200 and body["devices"] == {"aa": ["t"]} and body["unavailable"]
+    code, body = get(port, "/history?device=bb")
+    assert code == 502
@@ -0,0 +1,54 @@
+from dedup import PayloadDedup
+from ingest import IngestPipeline
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def make_pipeline(clock, on_duplicate=True):
+    calls = []
+    pipe = IngestPipeline(
+        lambda topic, msg: calls.append(("full", topic, msg)),
+        workers=1,
+        dedup=PayloadDedup(max_age=60, clock=clock),
+        on_duplicate=(lambda topic, msg: calls.append(("repeat", topic, msg))) if on_duplicate else None,
+    )
+    return pipe, calls
+
+
+def run(pipe, *frames):
+    pipe._process([(topic, payload, 0.0) for topic, payload in frames])
+
+
+def test_duplicate_frames_take_the_light_path_with_cached_json():
+    clock = Clock()
+    pipe, calls = make_pipeline(clock)
+    run(pipe, ("ZP2/aa/data", b'{"FW":"1","T":20}'), ("ZP2/aa/data", b'{"FW":"1","T":20}'))
+    assert [c[0] for c in calls] == ["full", "repeat"]
+    assert calls[1][2] == {"FW": "1", "T": 20}
+
+    # 內容變了 → 完整處理；超過 max_age 的重複也完整處理一次
+    run(pipe, ("ZP2/aa/data", b'{"FW":"1","T":21}'))
+    clock.now = 61
+    run(pipe, ("ZP2/aa/data", b'{"FW":"1","T":21}'))
+    assert [c[0] for c in calls] == ["full", "repeat", "full", "full"]
+    assert pipe.duplicates == 1 and pipe.processed == 3
+
+
+def test_duplicate_of_unparseable_payload_is_dropped():
+    pipe, calls = make_pipeline(Clock())
+    run(pipe, ("ZP2/aa/data", b"{oops"), ("ZP2/aa/data", b"{oops"))
+    assert calls == []
+    assert pipe.parse_errors == 1 and pipe.duplicates == 1
+
+
+def test_without_on_duplicate_repeats_are_skipped():
+    pipe, calls = make_pipeline(Clock(), on_duplicate=False)
+    run(pipe, ("ZP2/aa/data", b'{"T":1}'), ("ZP2/aa/data", b'{"T":1}'))
+    assert [c[0] for c in calls] == ["full"]
+    assert pipe.dedup.value("ZP2/aa/data") is None  # 沒有輕量處理就不必留著解析結果
@@ -0,0 +1,107 @@
+import hashlib
+import http.client
+import json
+import os
+import threading
+
+import pytest
+
+from local_ota_server import create_ota_server, prepare_firmware_cache
+
+FW = bytes(range(256)) * 40  # 10240 bytes
+ETAG = f'"{hashlib.sha256(FW).hexdigest()}"'
+
+
+@pytest.fixture
+def server(tmp_path):
+    root = tmp_path / "fw"
+    (root / "ZP2").mkdir(parents=True)
+    (root / "ZP2" / "fw.bin").write_bytes(FW)
+    (root / "ZP2" / "plain.bin").write_bytes(FW)  # 不在 ota_index：走一般磁碟讀取
+    index = tmp_path / "ota_index.yaml"
+    index.write_text(json.dumps({
+        "firmwares": [{"id": "v1", "model": "ZP2", "version": "1", "path": "ZP2/fw.bin"}],
+    }))
+    fw_cache, watcher = prepare_firmware_cache(str(root), str(index), default_profiles={"ZP2": "v1"})
+    httpd = create_ota_server(str(root), 0, fw_cache, watcher, max_workers=2, max_connections=4)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+    watcher.stop()
+
+
+def get(server, path, **headers):
+    conn = http.client.HTTPConnection("127.0.0.1", server.server_address[1], timeout=5)
+    try:
+        conn.request("GET", path, headers=headers)
+        resp = conn.getresponse()
+        return resp.status, dict(resp.getheaders()), resp.read()
+    finally:
+        conn.close()
+
+
+@pytest.fixture(params=["/ZP2/fw.bin", "/ZP2/plain.bin"], ids=["cached", "disk"])
+def path(request):
+    return request.param
+
+
+def test_full_download_has_strong_etag(server, path):
+    status, headers, body = get(server, path)
+    assert status == 200 and body == FW
+    assert headers["ETag"] == ETAG and headers["Accept-Ranges"] == "bytes"
+    assert headers["Content-Length"] == str(len(FW))
+    assert headers["X-Firmware-SHA256"] == ETAG.strip('"')
+
+
+@pytest.mark.parametrize("spec, start, end", [
+    ("bytes=100-199", 100, 199),
+    ("bytes=10000-", 10000, len(FW) - 1),
+    ("bytes=-40", len(FW) - 40, len(FW) - 1),   # 後綴
+    ("bytes=10200-99999", 10200, len(FW) - 1),  # 結尾超過檔案大小就截到最後
+])
+def test_partial_ranges(server, path, spec, start, end):
+    status, headers, body = get(server, path, Range=spec)
+    assert status == 206
+    assert headers["Content-Range"] == f"bytes {start}-{end}/{len(FW)}"
+    assert body == FW[start:end + 1]
+
+
+@pytest.mark.parametrize("spec", ["bytes=20000-", "bytes=-0"])
+def test_unsatisfiable_range(server, path, spec):
+    status, headers, body = get(server, path, Range=spec)
+    assert status == 416
+    assert headers["Content-Range"] == f"bytes */{len(FW)}" and body == b""
+
+
+@pytest.mark.parametrize("spec", ["items=0-1", "bytes=0-1,5-6", "bytes=abc"])
+def test_unsupported_range_sends_whole_file(server, spec):
+    status, _, body = get(server, "/ZP2/fw.bin", Range=spec)
+    assert status == 200 and body == FW
+
+
+def test_if_none_match_returns_304(server, path):
+    status, headers, body = get(server, path, **{"If-None-Match": f'"other", {ETAG}'})
+    assert status == 304 and body == b"" and headers["ETag"] == ETAG
+    assert get(server, path, **{"If-None-Match": '"other"'})[0] == 200
+
+
+def test_if_range_resumes_only_for_same_etag(server, path):
+    status, _, body = get(server, path, Range="bytes=5-9", **{"If-Range": ETAG})
+    assert status == 206 and body == FW[5:10]
+    # 檔案已換過（ETag 不同）：改回整個檔案，不能把新舊內容接在一起
+    status, _, body = get(server, path, Range="bytes=5-9", **{"If-Range": '"stale"'})
+    assert status == 200 and body == FW
+
+
+def test_cache_serves_replaced_firmware(server):
+    assert server.fw_cache.count() == 1
+    new = FW[::-1] + b"x"
+    fw_path = os.path.join(server.fw_cache.root_dir, "ZP2", "fw.bin")
+    tmp = fw_path + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(new)
+    os.replace(tmp, fw_path)
+    status, headers, body = get(server, "/ZP2/fw.bin")
+    assert status == 200 and body == new
+    assert headers["ETag"] == f'"{hashlib.sha256(new).hexdigest()}"'
@@ -0,0 +1,84 @@
+import os
+import random
+import threading
+
+import pytest
+
+import ota_artifacts
+from ota_artifacts import ArtifactStore
+from ota_index import OtaIndex
+
+pytest.importorskip("bsdiff4")
+
+
+@pytest.fixture
+def index(tmp_path):
+    root = tmp_path / "fw"
+    root.mkdir()
+    rnd = random.Random(1)
+    base = bytes(rnd.getrandbits(8) for _ in range(20000))
+    images = {
+        "v1": base,
+        "v2": base[:5000] + b"v2" * 50 + base[5100:],
+        "v3": base[:9000] + b"v3" * 50 + base[9100:],
+        "zs": bytes(rnd.getrandbits(8) for _ in range(20000)),
+    }
+    for name, data in images.items():
+        (root / f"{name}.bin").write_bytes(data)
+    data = {
+        "firmwares": [
+            {"id": "v1", "model": "ZP2", "version": "1", "path": "v1.bin"},
+            {"id": "v2", "model": "ZP2", "version": "2", "path": "v2.bin"},
+            {"id": "v3", "model": "ZP2", "version": "3", "path": "v3.bin"},
+            {"id": "zs", "model": "ZS2", "version": "1", "path": "zs.bin"},
+        ],
+        "rollouts": [{"model": "ZP2", "macs": ["aabbccddeeff"], "profile": "v2"}],
+    }
+    return OtaIndex(data, default_profiles={"ZP2": "v3"}, root_dir=str(root))
+
+
+def deltas(store, index):
+    sha = {pid: fw["sha256"] for pid, fw in index.profiles.items()}
+    return {
+        (a, b) for a in sha for b in sha
+        if a != b and store.delta_for(sha[a], sha[b]) is not None
+    }
+
+
+def test_deltas_only_toward_target_profiles(tmp_path, index):
+    assert index.target_profiles() == {"v2", "v3"}
+    store = ArtifactStore(str(tmp_path / "art"))
+    store.build(index)
+    # 目標只有 v2（canary rollout）與 v3（預設），不會做到 v1，也不跨 model
+    assert deltas(store, index) == {("v1", "v2"), ("v3", "v2"), ("v1", "v3"), ("v2", "v3")}
+
+
+def test_failed_diff_is_skipped_not_raised(tmp_path, index, monkeypatch):
+    def _boom(old, new):
+        raise MemoryError("bsdiff")
+
+    monkeypatch.setattr(ota_artifacts.bsdiff4, "diff", _boom)
+    store = ArtifactStore(str(tmp_path / "art"))
+    store.build(index)
+    assert deltas(store, index) == set()
+    skips = [n for n in os.listdir(tmp_path / "art" / "delta") if n.endswith(".skip")]
+    assert len(skips) == 4
+    assert len(os.listdir(tmp_path / "art" / "gz")) == 4  # gzip 照常處理（隨機內容壓不小，記成 .skip）
+
+
+def test_build_async_runs_off_thread_and_calls_back(tmp_path, index, monkeypatch):
+    gate = threading.Event()
+    real_diff = ota_artifacts.bsdiff4.diff
+
+    def _slow(old, new):
+        gate.wait(5)
+        return real_diff(old, new)
+
+    monkeypatch.setattr(ota_artifacts.bsdiff4, "diff", _slow)
+    store = ArtifactStore(str(tmp_path / "art"))
+    done = threading.Event()
+    store.build_async(index, on_done=lambda idx: done.set())
+    assert not store.idle() and not done.is_set()  # 呼叫端不用等 bsdiff
+    gate.set()
+    assert done.wait(10)
+    assert len(deltas(store, index)) == 4
@@ -0,0 +1,105 @@
+from ota_state import COMMANDED, DOWNLOADING, FAILED, IDLE, VERIFIED, OtaTracker
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def make_tracker(clock, **kw):
+    kw.setdefault("max_concurrent", 10)
+    kw.setdefault("timeout_sec", 100)
+    kw.setdefault("retry_base_sec", 60)
+    kw.setdefault("retry_max_sec", 1000)
+    kw.setdefault("cooldown_sec", 30)
+    tracker = OtaTracker(clock=clock, **kw)
+    changes = []
+    tracker.add_listener(lambda mac, state, target, attempts: changes.append((mac, state)))
+    return tracker, changes
+
+
+def test_progress_from_command_to_verified():
+    clock = Clock()
+    t, changes = make_tracker(clock)
+    assert t.observe("aa", "1", "2")
+    assert not t.observe("aa", "1", "2")  # 同一次嘗試只送一次
+    t.mark_sent("aa")
+    assert t.get("aa")["state"] == DOWNLOADING
+    clock.now = 50
+    assert not t.observe("aa", "2", "2")
+    assert t.get("aa")["state"] == VERIFIED and t.get("aa")["attempts"] == 0
+    assert changes == [("aa", COMMANDED), ("aa", DOWNLOADING), ("aa", VERIFIED)]
+    assert t.stats()["active"] == 0 and t.stats()["verified"] == 1
+
+
+def test_timeout_fails_and_retries_with_backoff():
+    clock = Clock()
+    t, changes = make_tracker(clock)
+    assert t.observe("aa", "1", "2")
+    t.mark_sent("aa")
+    clock.now = 99
+    assert t.expire() == 0
+    clock.now = 100
+    assert t.expire() == 1
+    assert t.get("aa")["state"] == FAILED and t.stats()["active"] == 0  # 名額放掉
+    clock.now = 159
+    assert not t.observe("aa", "1", "2")
+    clock.now = 160  # 退避 retry_base_sec
+    assert t.observe("aa", "1", "2") and t.get("aa")["attempts"] == 2
+    # 第二次失敗：退避加倍（由 data frame 發現逾時也算）
+    t.mark_sent("aa")
+    clock.now = 260
+    assert not t.observe("aa", "1", "2")
+    assert t.get("aa")["state"] == FAILED
+    assert t.get("aa")["next_attempt_at"] == 260 + 120
+    assert changes.count(("aa", FAILED)) == 2 and t.stats()["failed"] == 2
+
+
+def test_cooldown_between_commands():
+    clock = Clock()
+    t, _ = make_tracker(clock, timeout_sec=10, retry_base_sec=1, cooldown_sec=30)
+    assert t.observe("aa", "1", "2")
+    t.mark_sent("aa")
+    clock.now = 10
+    t.expire()
+    clock.now = 29  # 退避只要 1 秒，但距離上次指令還不到 cooldown_sec
+    assert not t.observe("aa", "1", "2")
+    clock.now = 30
+    assert t.observe("aa", "1", "2")
+
+
+def test_concurrency_cap_defers_until_a_slot_is_released():
+    clock = Clock()
+    t, _ = make_tracker(clock, max_concurrent=2)
+    assert t.observe("aa", "1", "2")
+    t.mark_sent("aa")
+    assert t.observe("bb", "1", "2")
+    assert not t.observe("cc", "1", "2")
+    assert t.stats()["deferred"] == 1 and t.get("cc")["state"] == IDLE
+
+    t.abort("bb")  # 指令沒送出：回到 idle，不算一次嘗試
+    assert t.get("bb")["state"] == IDLE and t.get("bb")["attempts"] == 0
+    clock.now = 50
+    assert t.observe("cc", "1", "2")
+    assert not t.observe("bb", "1", "2")
+
+    clock.now = 100  # aa 逾時：名額釋放給 bb
+    assert t.expire() == 1
+    assert t.observe("bb", "1", "2")
+    assert t.stats()["active"] == 2 and t.stats()["commands"] == 3
+
+
+def test_restore_keeps_in_flight_ota_without_resending():
+    clock = Clock()
+    t, changes = make_tracker(clock)
+    t.restore("aa", DOWNLOADING, "2", attempts=1)
+    t.restore("bb", FAILED, "2", attempts=2)
+    assert not t.observe("aa", "1", "2") and not t.observe("bb", "1", "2")
+    assert t.stats()["active"] == 1 and changes == []
+    clock.now = 100
+    assert t.expire() == 1
+    clock.now = 120  # bb：重開後照第 2 次失敗的退避
+    assert t.observe("bb", "1", "2") and t.get("bb")["attempts"] == 3
@@ -0,0 +1,152 @@
+import threading
+import time
+
+from scheduler import BoundedExecutor, DelayedScheduler, KeyedWorkQueue
+
+
+def wait_until(cond, timeout=3.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if cond():
+            return True
+        time.sleep(0.01)
+    return cond()
+
+
+class Saturated:
+    """讓 BoundedExecutor(1, 1) 的 worker 卡住、佇列塞滿，release() 之後恢復。"""
+    def __init__(self, executor):
+        self.gate = threading.Event()
+        self.started = threading.Event()
+
+        def _block():
+            self.started.set()
+            self.gate.wait(5)
+
+        assert executor.submit(_block)
+        assert self.started.wait(2)
+        assert executor.submit(self.gate.wait, 5)  # 佔滿唯一的佇列位置
+
+    def release(self):
+        self.gate.set()
+
+
+def test_call_later_runs_on_executor():
+    ex = BoundedExecutor(2, 10)
+    sc = DelayedScheduler(ex)
+    done = threading.Event()
+    assert sc.call_later(0.01, done.set)
+    assert done.wait(2)
+    assert sc.stats()["dispatched"] == 1
+    sc.shutdown()
+    ex.shutdown()
+
+
+def test_rejected_job_calls_on_reject_and_is_counted():
+    ex = BoundedExecutor(1, 1)
+    sc = DelayedScheduler(ex)
+    sat = Saturated(ex)
+    ran, rejected = threading.Event(), threading.Event()
+    assert sc.call_later(0.01, ran.set, on_reject=rejected.set)
+    assert rejected.wait(2)
+    sat.release()
+    time.sleep(0.1)
+    assert not ran.is_set()
+    assert sc.stats()["dropped"] == 1
+    sc.shutdown()
+    ex.shutdown()
+
+
+def test_call_every_survives_saturation():
+    ex = BoundedExecutor(1, 1)
+    sc = DelayedScheduler(ex)
+    ticks = []
+    sat = Saturated(ex)
+    sc.call_every(0.02, lambda: ticks.append(1))
+    assert wait_until(lambda: sc.stats()["skipped_ticks"] >= 2)
+    assert not ticks
+    assert sc.pending() == 1  # 下一輪仍在排程中
+    sat.release()
+    assert wait_until(lambda: len(ticks) >= 3)
+    sc.shutdown()
+    ex.shutdown()
+
+
+def test_call_every_not_limited_by_max_pending():
+    ex = BoundedExecutor(1, 10)
+    sc = DelayedScheduler(ex, max_pending=1)
+    ticks = []
+    assert sc.call_later(10, lambda: None)  # 佔滿 max_pending
+    assert sc.call_every(0.02, lambda: ticks.append(1))
+    assert not sc.call_later(10, lambda: None)
+    assert wait_until(lambda: len(ticks) >= 3)
+    sc.shutdown()
+    ex.shutdown()
+
+
+def test_call_every_keeps_running_after_exception():
+    ex = BoundedExecutor(1, 10)
+    sc = DelayedScheduler(ex)
+    calls = []
+
+    def _boom():
+        calls.append(1)
+        raise RuntimeError("boom")
+
+    sc.call_every(0.02, _boom)
+    assert wait_until(lambda: len(calls) >= 3)
+    sc.shutdown()
+    ex.shutdown()
+
+
+def test_keyed_queue_retries_key_rejected_at_due():
+    ex = BoundedExecutor(1, 1)
+    sc = DelayedScheduler(ex)
+    kq = KeyedWorkQueue(sc, debounce_sec=0.01, retry_sec=0.1)
+    runs = []
+    sat = Saturated(ex)
+    assert kq.submit("dev", runs.append, 1)
+    assert wait_until(lambda: kq.stats()["deferred"] >= 1)
+    assert kq.stats()["pending"] == 1 and sc.pending() == 1  # 還在排程，不是卡在 _pending
+    assert kq.submit("dev", runs.append, 2)  # 合併成最新一份
+    sat.release()
+    assert wait_until(lambda: runs == [2])
+    assert kq.submit("dev", runs.append, 3)
+    assert wait_until(lambda: runs == [2, 3])
+    assert kq.stats()["pending"] == 0
+    sc.shutdown()
+    ex.shutdown()
+
+
+def test_keyed_queue_handoff_survives_rejection():
+    ex = BoundedExecutor(2, 10)
+    accept = threading.Event()
+    accept.set()
+
+    class Gated:
+        """accept 清掉時拒收所有工作（模擬 a 結束的那一刻工作池剛好滿了）。"""
+        def submit(self, fn, *args, **kwargs):
+            return accept.is_set() and ex.submit(fn, *args, **kwargs)
+
+    sc = DelayedScheduler(Gated())
+    kq = KeyedWorkQueue(sc, debounce_sec=0.01, max_concurrent=1, retry_sec=0.1)
+    gate, started, runs = threading.Event(), threading.Event(), []
+
+    def _slow():
+        started.set()
+        gate.wait(5)
+        runs.append("a")
+        accept.clear()
+
+    assert kq.submit("a", _slow)
+    assert started.wait(2)
+    assert kq.submit("b", runs.append, "b")
+    assert wait_until(lambda: kq.stats()["waiting"] == 1)  # b 到期但名額被 a 佔著
+    gate.set()
+    assert wait_until(lambda: kq.stats()["deferred"] >= 1)  # a 結束時交棒給 b 的 _due 被拒收
+    assert runs == ["a"]
+    accept.set()
+    assert wait_until(lambda: runs == ["a", "b"])
+    assert kq.stats()["pending"] == 0 and kq.stats()["running"] == 0
+    sc.shutdown()
+    ex.shutdown()
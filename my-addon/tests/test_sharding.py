@@ -0,0 +1,175 @@
+import random
+from collections import Counter, deque
+
+from paho.mqtt.client import topic_matches_sub
+
+from sharding import HashRing, ShardFilter, ShardRouter
+
+MACS = [f"a0b0c0{i:06x}" for i in range(4000)]
+TOPICS = ["+/+/data", "+/+/control"]
+
+
+def test_ring_is_balanced():
+    ring = HashRing(4)
+    counts = [0] * 4
+    for mac in MACS:
+        counts[ring.owner(mac)] += 1
+    assert min(counts) > len(MACS) / 4 * 0.75
+
+
+def test_ring_moves_few_keys_when_adding_a_shard():
+    before, after = HashRing(4), HashRing(5)
+    moved = sum(before.owner(m) != after.owner(m) for m in MACS)
+    assert moved < len(MACS) * 0.3  # 理想是 1/5；取餘數的話約 4/5
+    # 換分片的只會換到新加的那片
+    assert all(after.owner(m) == 4 for m in MACS if before.owner(m) != after.owner(m))
+
+
+def test_filter_owns_by_mac_case_insensitively():
+    shards = [ShardFilter(i, 3) for i in range(3)]
+    for mac in MACS[:200]:
+        owners = [s.index for s in shards if s.owns(f"ZP2/{mac.upper()}/data")]
+        assert owners == [shards[0].ring.owner(mac)]
+    assert all(s.owns("bad-topic") for s in shards)  # 格式不對的每片都收（照原本方式處理）
+    assert ShardFilter(0, 1).owns("ZP2/x/data")
+
+
+class Bus:
+    """記錄 router 發布 / 訂閱的內容。"""
+    def __init__(self, router):
+        self.published, self.subscribed = [], []
+        router.bind(lambda t, p: self.published.append((t, p)), self.subscribed.append)
+
+
+def mac_of(shard, count=2):
+    ring = HashRing(count)
+    return next(m for m in MACS if ring.owner(m) == shard).upper()
+
+
+def test_front_forwards_until_claimed_and_hello_resets():
+    front = ShardRouter(ShardFilter(0, 2), TOPICS)
+    bus = Bus(front)
+    mine, theirs = mac_of(0), mac_of(1)
+    assert front.route(f"ZP2/{mine}/data", b"1") == f"ZP2/{mine}/data"
+    assert front.route(f"ZP2/{theirs}/data", b"2") is None
+    assert bus.published == [(f"zp2/_shard/2/1/ZP2/{theirs}/data", b"2")]
+
+    assert front.route(f"zp2/_shard/2/claimed/{theirs.lower()}", b"") is None
+    assert bus.published[-1] == (f"zp2/_shard/2/1/done/{theirs.lower()}", b"")  # 排在最後一筆轉發之後
+    front.route(f"zp2/_shard/2/claimed/{theirs.lower()}", b"")
+    assert front.route(f"ZP2/{theirs}/data", b"3") is None
+    assert len(bus.published) == 2  # 已認領：不再轉發，重複的認領也不再送 done
+
+    front.route("zp2/_shard/2/hello/1", b"")  # 第 1 片重連
+    front.route(f"ZP2/{theirs}/data", b"4")
+    assert bus.published[-1] == (f"zp2/_shard/2/1/ZP2/{theirs}/data", b"4")
+    assert "zp2/_shard/2/claimed/+" in front.subscriptions()
+
+
+def test_other_shard_subscribes_device_on_handoff():
+    shard = ShardRouter(ShardFilter(1, 2), TOPICS)
+    bus = Bus(shard)
+    mac = mac_of(1)
+    assert shard.subscriptions() == ["zp2/_shard/2/1/#"]
+    shard.on_connect()
+    assert bus.published == [("zp2/_shard/2/hello/1", b"")]
+
+    assert shard.route(f"zp2/_shard/2/1/ZP2/{mac}/data", b"x") == f"ZP2/{mac}/data"
+    assert bus.subscribed == [f"+/{mac}/data", f"+/{mac}/control"]  # MAC 大小寫照 topic
+    assert bus.published[-1] == (f"zp2/_shard/2/claimed/{mac.lower()}", b"")
+    # 再收到轉發（第 0 片還不知道）：不重複訂閱，但再回覆一次認領
+    shard.route(f"zp2/_shard/2/1/ZP2/{mac}/data", b"y")
+    assert len(bus.subscribed) == 2 and bus.published[-1][0].endswith(mac.lower())
+    assert shard.route(f"ZP2/{mac}/data", b"z") == f"ZP2/{mac}/data"
+    # 直接訂閱已經收過的那筆，晚到的轉發不再處理
+    assert shard.route(f"zp2/_shard/2/1/ZP2/{mac}/data", b"z") is None
+    assert shard.stats()["overlaps"] == 1
+    # 重連時連同已認領的裝置一起訂閱；轉發錯片的不收
+    assert f"+/{mac}/data" in shard.subscriptions()
+    assert shard.route(f"zp2/_shard/2/1/ZP2/{mac_of(0)}/data", b"") is None
+
+
+def test_adopt_only_keeps_own_devices():
+    shard = ShardRouter(ShardFilter(1, 2), TOPICS)
+    shard.adopt([mac_of(0), mac_of(1)])
+    assert shard.subscriptions() == ["zp2/_shard/2/1/#", f"+/{mac_of(1)}/data", f"+/{mac_of(1)}/control"]
+
+
+def test_router_disabled_for_unshardable_topics():
+    shard = ShardRouter(ShardFilter(1, 2), ["#"])
+    assert not shard.enabled
+    assert shard.subscriptions() == ["#"]
+    assert shard.route(f"ZP2/{mac_of(1)}/data", b"") == f"ZP2/{mac_of(1)}/data"
+    assert shard.route(f"ZP2/{mac_of(0)}/data", b"") is None
+    assert not ShardRouter(ShardFilter(0, 1), TOPICS).enabled
+
+
+class Broker:
+    """記憶體裡的 broker：每個 client 一條 FIFO；分片強制 MQTT v5，所有訂閱都是 noLocal。"""
+    def __init__(self):
+        self.subs, self.queues = {}, {}
+
+    def connect(self, name, router):
+        self.subs[name], self.queues[name] = set(), deque()
+        router.bind(lambda t, p: self.publish(name, t, p), self.subs[name].add)
+        self.subs[name].update(router.subscriptions())
+        router.on_connect()
+
+    def publish(self, sender, topic, payload):
+        for name, filters in self.subs.items():
+            if name != sender and any(topic_matches_sub(f, topic) for f in filters):
+                self.queues[name].append((topic, payload))
+
+
+def test_each_frame_is_processed_once_across_shards():
+    rnd = random.Random(7)
+    n = 3
+    broker = Broker()
+    routers = [ShardRouter(ShardFilter(i, n), TOPICS) for i in range(n)]
+    for i, r in enumerate(routers):
+        broker.connect(i, r)
+    macs = [m.upper() for m in MACS[:20]]
+    sent, processed = Counter(), Counter()
+    seq = iter(range(10 ** 6))
+
+    def deliver(name):
+        topic, payload = broker.queues[name].popleft()
+        out = routers[name].route(topic, payload)
+        if out is not None:
+            assert routers[name].shard.owns_mac(out.split("/")[1])
+            processed[(phase, out, payload)] += 1
+
+    def run(steps):
+        for _ in range(steps):
+            busy = [name for name, q in broker.queues.items() if q]
+            if busy and rnd.random() < 0.5:
+                deliver(rnd.choice(busy))
+                continue
+            mac = rnd.choice(macs)
+            # 一般每筆內容都不同；偶爾送一模一樣的內容（交接時可能被當成同一筆，但絕不會處理兩次）
+            payload = b'{"T":1}' if rnd.random() < 0.1 else f'{{"seq":{next(seq)}}}'.encode()
+            broker.publish("device", f"ZP2/{mac}/data", payload)
+            sent[(phase, f"ZP2/{mac}/data", payload)] += 1
+        while any(broker.queues.values()):
+            deliver(rnd.choice([name for name, q in broker.queues.items() if q]))
+
+    def exactly_once(phase):
+        unique = {k: v for k, v in sent.items() if k[0] == phase and b"seq" in k[2]}
+        assert {k: v for k, v in processed.items() if k in unique} == unique
+        assert all(processed[k] <= v for k, v in sent.items())
+
+    phase = 1
+    run(3000)
+    exactly_once(1)
+    assert sum(r.stats()["overlaps"] for r in routers) > 0  # 交接重疊確實發生過
+    assert all(r.stats()["handing_off"] == 0 for r in routers[1:])
+
+    # 第 2 片重連（佇列裡的訊息丟失）：重新交接期間也不會重複處理
+    phase = 2
+    run(500)
+    broker.connect(2, routers[2])
+    run(2000)
+    assert all(processed[k] <= v for k, v in sent.items())
+    phase = 3
+    run(2000)
+    exactly_once(3)